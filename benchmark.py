@@ -0,0 +1,278 @@
+import importlib.util
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Tuple
+
+import click
+import numpy as np
+import scipy
+
+import instrumentation
+import ode_solving
+from ensemble import ensemble_bands, gaussian_samples
+from model_fitting import FitProblem, LossFunction, get_optimal_parameters
+from ode_solving import solve_ode, solve_ode_batch, solve_ode_quarantine_ends
+from parameter_sets import solve_kwargs, state_and_par
+from partitioned_model import PartitionedModel
+
+
+# Paths are relative to this file, so the suite runs from any directory.
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+TRAIN_DATA_PATH = os.path.join(PACKAGE_DIR, 'data', 'spain_multi_phase_partitioned_train.json')
+PARAMETERS_PATH = os.path.join(PACKAGE_DIR, 'data', 'spain_trained_parameters.json')
+MAIN_PATH = os.path.join(PACKAGE_DIR, 'main.py')
+
+
+# Count right hand side evaluations. Every integrator path, the compiled and batched ones included, wraps its right hand
+# side with instrumentation.wrap_rhs, which counts calls while a profiler is active. The count is set when the block
+# ends.
+@contextmanager
+def count_rhs_evaluations():
+    counter = [0]
+    with instrumentation.profiling() as profiler:
+        try:
+            yield counter
+        finally:
+            counter[0] = profiler.counters['rhs_evaluations']
+
+
+def _load_parameters() -> Dict:
+    with open(PARAMETERS_PATH) as data_file:
+        return json.load(data_file)
+
+
+# Every benchmark is a (name, factory, repeats) tuple. The factory does the setup and returns the callable being timed,
+# so loading data never counts towards the measurements.
+def _solve_ode_benchmark(simulation_duration: int, piecewise: bool, **solver_options) -> Callable[[], Callable]:
+    def factory():
+        kwargs = solve_kwargs(_load_parameters(), simulation_duration, piecewise=piecewise)
+        return lambda: solve_ode(**dict(kwargs, quarantine_2_duration=78), **solver_options)
+    return factory
+
+
+def _solve_ode_batch_benchmark(simulation_duration: int, scenarios: int) -> Callable[[], Callable]:
+    def factory():
+        state0, par = state_and_par(solve_kwargs(_load_parameters(), simulation_duration))
+        initial_states, parameters = np.tile(state0, (scenarios, 1)), np.tile(par, (scenarios, 1))
+        # Spread gamma so the scenarios differ.
+        parameters[:, 0] *= np.linspace(0.9, 1.1, scenarios)
+        return lambda: solve_ode_batch(initial_states, parameters, simulation_duration)
+    return factory
+
+
+# The trained parameters integrated through the vectorized right hand side of PartitionedModel, which every model but
+# the original one uses. test_partitioned_model checks that it reproduces the scalar right hand sides.
+def _partitioned_benchmark(simulation_duration: int, piecewise: bool) -> Callable[[], Callable]:
+    def factory():
+        parameters = dict(_load_parameters(), quarantine_2_duration=78)
+        model = PartitionedModel.from_parameters(parameters).vectorized()
+        initial_state = model.initial_state_from_parameters(parameters)
+        return lambda: model.solve(initial_state, simulation_duration, piecewise=piecewise)
+    return factory
+
+
+# Gaussian ensemble bands around the trained parameters. test_ensemble checks that they stay around the trajectory of
+# the parameters.
+def _ensemble_benchmark(members: int) -> Callable[[], Callable]:
+    def factory():
+        problem = FitProblem.from_path(TRAIN_DATA_PATH)
+        x = problem.vector(_load_parameters())
+        simulation_duration = problem.simulation_duration - 1
+        return lambda: ensemble_bands(problem, gaussian_samples(problem, x, members, seed=0), simulation_duration)
+    return factory
+
+
+def _loss_function_benchmark(evaluations: int) -> Callable[[], Callable]:
+    def factory():
+        problem = FitProblem.from_path(TRAIN_DATA_PATH)
+        predict_list = solve_ode(**problem.solve_kwargs(problem.initial))
+        loss = LossFunction(gt_list=problem.epidemic_evolution, fictional_total=problem.total, total=problem.n)
+
+        def run():
+            for _ in range(evaluations):
+                loss(predict_list)
+        return run
+    return factory
+
+
+def _objective_function_benchmark(evaluations: int, piecewise: bool) -> Callable[[], Callable]:
+    def factory():
+        problem = FitProblem.from_path(TRAIN_DATA_PATH, piecewise=piecewise, memo_size=0)
+        initial = np.array(problem.initial)
+
+        def run():
+            # Perturb the vector so every call integrates the model.
+            for evaluation in range(evaluations):
+                problem.objective_function(initial * (1 + 1e-9 * evaluation))
+        return run
+    return factory
+
+
+def _fit_benchmark(piecewise: bool) -> Callable[[], Callable]:
+    def factory():
+        return lambda: get_optimal_parameters(data_path=TRAIN_DATA_PATH, verbose=False, piecewise=piecewise)
+    return factory
+
+
+def _quarantine_end_benchmark(simulation_duration: int, piecewise: bool) -> Callable[[], Callable]:
+    def factory():
+        parameters = _load_parameters()
+        kwargs = solve_kwargs(parameters, simulation_duration, piecewise=piecewise)
+        del kwargs['quarantine_2_duration']
+        durations = [duration for duration, _ in parameters['quarantine_2_duration_list']]
+        return lambda: solve_ode_quarantine_ends(quarantine_2_durations=durations, **kwargs)
+    return factory
+
+
+# Start the CLI with args in a fresh interpreter, so the imports made at startup are measured. The factory first checks
+# with -X importtime that none of the forbidden top-level packages gets imported.
+def _startup_benchmark(args: List[str], forbidden: Tuple[str, ...] = ()) -> Callable[[], Callable]:
+    def factory():
+        command = [sys.executable, MAIN_PATH] + args
+        import_log = subprocess.run([sys.executable, '-X', 'importtime'] + command[1:], check=True,
+                                    stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True).stderr
+        imported = {line.split('|')[-1].strip().split('.')[0] for line in import_log.splitlines() if '|' in line}
+        assert not imported & set(forbidden), f'{" ".join(args)} imports {", ".join(imported & set(forbidden))}.'
+        return lambda: subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+    return factory
+
+
+def get_benchmarks(include_fit: bool = True) -> List[Tuple[str, Callable[[], Callable], int]]:
+    benchmarks = [
+        ('startup/help', _startup_benchmark(['--help'], forbidden=('scipy', 'matplotlib', 'numba')), 5),
+        ('startup/sweep', _startup_benchmark(['sweep', '--help'], forbidden=('matplotlib', 'numba')), 5),
+    ]
+    for simulation_duration in (100, 1000, 5000):
+        for piecewise in (False, True):
+            mode = 'piecewise' if piecewise else 'stepwise'
+            benchmarks.append((f'solve_ode/{simulation_duration}/{mode}',
+                               _solve_ode_benchmark(simulation_duration, piecewise), 5))
+    for integrator in ode_solving.INTEGRATORS[1:]:
+        benchmarks.append((f'solve_ode/1000/stepwise/{integrator}',
+                           _solve_ode_benchmark(1000, False, integrator=integrator), 5))
+    # Without numba jit=True runs the ordinary right hand side, which has its own entry.
+    if importlib.util.find_spec('numba') is not None:
+        benchmarks.append(('solve_ode/1000/stepwise/jit', _solve_ode_benchmark(1000, False, jit=True), 5))
+    benchmarks.append(('solve_ode_batch/100/256', _solve_ode_batch_benchmark(100, 256), 3))
+    for piecewise in (False, True):
+        mode = 'piecewise' if piecewise else 'stepwise'
+        benchmarks.append((f'partitioned/1000/{mode}', _partitioned_benchmark(1000, piecewise), 5))
+    benchmarks.append(('loss_function/1000', _loss_function_benchmark(1000), 5))
+    benchmarks.append(('ensemble/gaussian/1000', _ensemble_benchmark(1000), 3))
+    for piecewise in (False, True):
+        mode = 'piecewise' if piecewise else 'stepwise'
+        benchmarks.append((f'objective_function/100/{mode}', _objective_function_benchmark(100, piecewise), 3))
+        benchmarks.append((f'quarantine_end/1000/{mode}', _quarantine_end_benchmark(1000, piecewise), 3))
+    if include_fit:
+        benchmarks.append(('get_optimal_parameters/stepwise', _fit_benchmark(False), 1))
+    return benchmarks
+
+
+# Best wall time over repeats, RHS evaluations of one run and peak traced memory of one more run.
+def measure(factory: Callable[[], Callable], repeats: int) -> Dict:
+    run = factory()
+    wall_times = []
+    for _ in range(repeats):
+        with count_rhs_evaluations() as counter:
+            start = time.perf_counter()
+            run()
+            wall_times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        run()
+        _, peak_memory = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {
+        'wall_time': min(wall_times),
+        'wall_time_mean': sum(wall_times) / len(wall_times),
+        'repeats': repeats,
+        'rhs_evaluations': counter[0],
+        'peak_memory_bytes': peak_memory,
+    }
+
+
+def run_benchmarks(include_fit: bool = True, name_filter: Optional[str] = None, verbose: bool = True) -> Dict:
+    results = {}
+    for name, factory, repeats in get_benchmarks(include_fit=include_fit):
+        if name_filter is not None and name_filter not in name:
+            continue
+        results[name] = measure(factory, repeats)
+        if verbose:
+            print(f'{name:40s}\t{results[name]["wall_time"]:.4f} s\t'
+                  f'{results[name]["rhs_evaluations"]} rhs\t{results[name]["peak_memory_bytes"] / 2 ** 20:.2f} MiB')
+    return {
+        'meta': {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'scipy': scipy.__version__,
+            'machine': platform.machine(),
+            'processor': platform.processor(),
+        },
+        'benchmarks': results,
+    }
+
+
+# Regressions of current with respect to baseline: relative increases in wall time or peak memory above threshold, and
+# any increase in RHS evaluations above count_threshold (they are deterministic).
+def compare_results(baseline: Dict, current: Dict, threshold: float = 0.25,
+                    count_threshold: float = 0.01) -> List[Dict]:
+    rows = []
+    for name, current_result in current['benchmarks'].items():
+        baseline_result = baseline['benchmarks'].get(name)
+        if baseline_result is None:
+            continue
+        for metric, metric_threshold in (('wall_time', threshold), ('peak_memory_bytes', threshold),
+                                         ('rhs_evaluations', count_threshold)):
+            before, after = baseline_result[metric], current_result[metric]
+            change = (after - before) / before if before else 0.
+            rows.append({'benchmark': name, 'metric': metric, 'baseline': before, 'current': after,
+                         'change': change, 'regression': change > metric_threshold})
+    return rows
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command('run')
+@click.option('--output', default='bench_output.json', help='Where the results json is written.')
+@click.option('--skip-fit', is_flag=True, help='Skip the full get_optimal_parameters run.')
+@click.option('--filter', 'name_filter', help='Only run benchmarks whose name contains this string.')
+def click_run_benchmarks(output: str, skip_fit: bool = False, name_filter: Optional[str] = None):
+    results = run_benchmarks(include_fit=not skip_fit, name_filter=name_filter)
+    with open(output, 'w') as output_file:
+        json.dump(results, output_file, indent=2)
+
+
+@cli.command('compare')
+@click.option('--baseline', 'baseline_path', required=True, help='Results json of the reference run.')
+@click.option('--current', 'current_path', required=True, help='Results json of the run being checked.')
+@click.option('--threshold', default=0.25, help='Allowed relative increase of wall time and peak memory.')
+def click_compare_results(baseline_path: str, current_path: str, threshold: float = 0.25):
+    with open(baseline_path) as baseline_file:
+        baseline = json.load(baseline_file)
+    with open(current_path) as current_file:
+        current = json.load(current_file)
+
+    rows = compare_results(baseline, current, threshold=threshold)
+    for row in rows:
+        flag = 'REGRESSION' if row['regression'] else ''
+        print(f'{row["benchmark"]:40s}\t{row["metric"]:18s}\t{row["baseline"]:.6g}\t{row["current"]:.6g}\t'
+              f'{row["change"]:+.1%}\t{flag}')
+    if any(row['regression'] for row in rows):
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,103 @@
+import functools
+import warnings
+
+import numpy as np
+
+# numba is optional. Without it jit_enabled warns and the ordinary right hand sides are used, since these functions
+# run slower uncompiled than the ordinary ones.
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+JIT_AVAILABLE = njit is not None
+
+
+# Whether compiled right hand sides can be used, warning on the first call if numba is missing.
+@functools.lru_cache(maxsize=None)
+def jit_enabled() -> bool:
+    if not JIT_AVAILABLE:
+        warnings.warn('numba is not installed, the ordinary right hand sides are used instead of compiled ones.',
+                      RuntimeWarning)
+    return JIT_AVAILABLE
+
+
+# diff_equations and phase_equations written for a compiler: par is a float array and the result an array. They keep
+# the behaviour of the Python versions, including delta being taken from the deceased state.
+def _phase_equations(t, y, par):
+    gamma_m, gamma_e, gamma_o, al, s, ri, rq, di, dq = par[0], par[1], par[2], par[3], par[5], par[6], par[7], \
+        par[8], par[9]
+    sm, se, so, e, i, q, r, d = y[0], y[1], y[2], y[3], y[4], y[5], y[6], y[7]
+    n = sm + se + so + e + i + q + r + d
+    delta = d
+
+    dy = np.empty(8)
+    dy[0] = -sm * (gamma_m * i + delta * q) / n
+    dy[1] = -se * (gamma_e * i) / n
+    dy[2] = -so * (gamma_o * i) / n
+    dy[3] = -(dy[0] + dy[1] + dy[2]) - s * e
+    dy[4] = s * e - (al + ri + di) * i
+    dy[5] = al * i - (rq + dq) * q
+    dy[6] = ri * i + rq * q
+    dy[7] = di * i + dq * q
+    return dy
+
+
+def _diff_equations(t, y, par):
+    g, start, dur_1, dur_2 = par[0], par[14], par[15], par[16]
+    phase_par = np.empty(10)
+    if start <= t < start + dur_1:
+        phase_par[0] = g / par[1]
+        phase_par[1] = g / par[2]
+        phase_par[2] = g / par[3]
+    elif start + dur_1 <= t < start + dur_1 + dur_2:
+        phase_par[0] = g / par[1] / par[4]
+        phase_par[1] = g / par[2] / par[5]
+        phase_par[2] = g / par[3] / par[6]
+    else:
+        phase_par[0] = g
+        phase_par[1] = g
+        phase_par[2] = g
+    phase_par[3:] = par[7:14]
+    return phase_equations(t, y, phase_par)
+
+
+# PartitionedModel.phase_rhs and rhs written for a compiler. gammas is the (K, P + 1) table of contact rates, whose
+# column is the phase, and rates holds alpha, delta, sigma, r_i, r_q, d_i and d_q.
+def _partitioned_phase_equations(t, y, column, gammas, quarantine_contact, rates):
+    k = gammas.shape[0]
+    al, s, ri, rq, di, dq = rates[0], rates[2], rates[3], rates[4], rates[5], rates[6]
+    e, i, q, r, d = y[k], y[k + 1], y[k + 2], y[k + 3], y[k + 4]
+    n = 0.
+    for group in range(k):
+        n += y[group]
+    n += e + i + q + r + d
+
+    dy = np.empty(k + 5)
+    infected = 0.
+    for group in range(k):
+        dy[group] = -y[group] * (gammas[group, column] * i + quarantine_contact[group] * d * q) / n
+        infected -= dy[group]
+    dy[k] = infected - s * e
+    dy[k + 1] = s * e - (al + ri + di) * i
+    dy[k + 2] = al * i - (rq + dq) * q
+    dy[k + 3] = ri * i + rq * q
+    dy[k + 4] = di * i + dq * q
+    return dy
+
+
+def _partitioned_equations(t, y, gammas, phase_boundaries, quarantine_contact, rates):
+    column = 0
+    for boundary in phase_boundaries:
+        if boundary <= t:
+            column += 1
+    if column == phase_boundaries.size:
+        column = 0
+    return partitioned_phase_equations(t, y, column, gammas, quarantine_contact, rates)
+
+
+if JIT_AVAILABLE:
+    phase_equations = njit(cache=True)(_phase_equations)
+    diff_equations = njit(cache=True)(_diff_equations)
+    partitioned_phase_equations = njit(cache=True)(_partitioned_phase_equations)
+    partitioned_equations = njit(cache=True)(_partitioned_equations)
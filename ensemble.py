@@ -0,0 +1,236 @@
+import copy
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from model_fitting import FitProblem, LossFunction
+from ode_solving import solve_ode_batch
+from parameter_sets import state_and_par
+from trajectory import COMPARTMENT_INDEX
+
+QUANTILES = (0.05, 0.25, 0.5, 0.75, 0.95)
+BAND_SERIES = ('quarantined', 'deceased')
+
+
+# Streaming estimate of several quantiles of every cell of an array, with the P-square algorithm of Jain and Chlamtac:
+# five markers per quantile and cell are adjusted as observations arrive, so memory does not grow with their number.
+# The first buffer_size observations are kept and give exact quantiles, then the markers start from them.
+class P2Quantiles:
+    def __init__(self, quantiles: Sequence[float], shape: Tuple[int, ...], buffer_size: int = 100):
+        assert buffer_size >= 5
+        self.quantiles = tuple(quantiles)
+        self.shape = tuple(shape)
+        self.buffer_size = buffer_size
+        probabilities = np.array(self.quantiles, dtype=np.float64).reshape((-1,) + (1,) * len(self.shape))
+        # Increments of the desired marker positions per observation.
+        self.increments = np.stack([np.zeros_like(probabilities), probabilities / 2, probabilities,
+                                    (1 + probabilities) / 2, np.ones_like(probabilities)], axis=-1)
+        self.count = 0
+        self._buffer = []
+        self.heights = None
+        self.positions = None
+
+    def _initialize_markers(self):
+        positions = np.round(1 + (self.count - 1) * self.increments)
+        for i in range(1, 5):
+            positions[..., i] = np.maximum(positions[..., i], positions[..., i - 1] + 1)
+        positions = np.minimum(positions, self.count - np.arange(4, -1, -1))
+        observations = np.sort(np.stack(self._buffer), axis=0)
+        ranks = (positions - 1).astype(int).reshape(len(self.quantiles), 5)
+        self.heights = np.moveaxis(observations[ranks], 1, -1).copy()
+        self.positions = np.broadcast_to(positions, self.heights.shape).copy()
+        self._buffer = []
+
+    def update(self, x: np.ndarray):
+        x = np.asarray(x, dtype=np.float64)
+        assert x.shape == self.shape
+        self.count += 1
+        if self.heights is None:
+            self._buffer.append(x)
+            if self.count == self.buffer_size:
+                self._initialize_markers()
+            return
+
+        x = np.broadcast_to(x, self.heights.shape[:-1])
+        heights, positions = self.heights, self.positions
+        heights[..., 0] = np.minimum(heights[..., 0], x)
+        heights[..., 4] = np.maximum(heights[..., 4], x)
+        cell = (x[..., None] >= heights[..., 1:4]).sum(axis=-1)
+        positions += np.arange(5) > cell[..., None]
+        desired = 1 + (self.count - 1) * self.increments
+        for i in (1, 2, 3):
+            offset = desired[..., i] - positions[..., i]
+            up = (offset >= 1) & (positions[..., i + 1] - positions[..., i] > 1)
+            down = (offset <= -1) & (positions[..., i - 1] - positions[..., i] < -1)
+            move = up | down
+            if not move.any():
+                continue
+            step = np.where(up, 1., -1.)
+            h, h_below, h_above = heights[..., i], heights[..., i - 1], heights[..., i + 1]
+            n, n_below, n_above = positions[..., i], positions[..., i - 1], positions[..., i + 1]
+            parabolic = h + step / (n_above - n_below) * ((n - n_below + step) * (h_above - h) / (n_above - n)
+                                                          + (n_above - n - step) * (h - h_below) / (n - n_below))
+            h_next = np.where(up, h_above, h_below)
+            n_next = np.where(up, n_above, n_below)
+            linear = h + step * (h_next - h) / (n_next - n)
+            adjusted = np.where((h_below < parabolic) & (parabolic < h_above), parabolic, linear)
+            heights[..., i] = np.where(move, adjusted, h)
+            positions[..., i] += np.where(move, step, 0)
+
+    # Quantile estimates, an array of shape (len(quantiles),) + shape.
+    def result(self) -> np.ndarray:
+        if self.heights is None:
+            assert self.count > 0, 'No observations.'
+            return np.quantile(np.stack(self._buffer), self.quantiles, axis=0)
+        return self.heights[..., 2].copy()
+
+
+# Daily states of the fitted vectors in the rows of xs, in the units of the real population, for the medical, essential
+# and others groups with two phases that solve_ode_batch takes. If the batch integration fails, the days axis ends on
+# the last day reached.
+def solve_fitted_batch(problem: FitProblem, xs: np.ndarray, simulation_duration: int) -> np.ndarray:
+    initial_states, parameters = [], []
+    for x in xs:
+        state0, par = state_and_par(problem.solve_kwargs(x))
+        initial_states.append(state0)
+        parameters.append(par)
+    return (solve_ode_batch(initial_states, parameters, simulation_duration, on_failure='ignore')
+            * problem.n / problem.total)
+
+
+# Daily compartment values of the fitted vector x through its PartitionedModel, in the units of the real population,
+# for any groups and phases. If the integration fails, the days axis ends on the last day reached.
+def solve_fitted(problem: FitProblem, x: np.ndarray, simulation_duration: int) -> np.ndarray:
+    model = problem.model(x)
+    states = model.solve(problem.initial_state(x), simulation_duration, piecewise=problem.piecewise,
+                         rtol=problem.rtol, atol=problem.atol, integrator=problem.integrator, jit=problem.jit,
+                         on_failure='ignore')
+    return model.compartment_values(states) * problem.n / problem.total
+
+
+# Residual standard deviations of the quarantined and deceased fit at x, in fictional units.
+def residual_scales(problem: FitProblem, x: np.ndarray) -> Tuple[float, float]:
+    predicted = problem.solve(x)
+    scales = []
+    for series, gt, mask in (('quarantined', problem.loss.gt_quarantined, problem.loss.quarantined_mask),
+                             ('deceased', problem.loss.gt_deceased, problem.loss.deceased_mask)):
+        n = min(len(predicted), len(gt))
+        residuals = (predicted[series][:n] - gt[:n])[mask[:n] > 0]
+        scales.append(float(np.sqrt(np.mean(residuals ** 2))) if residuals.size else 1.)
+    return scales[0], scales[1]
+
+
+# Covariance of the logarithm of the fitted vector from the Gauss-Newton approximation of the Hessian of a Gaussian
+# likelihood, with the exact sensitivities of the quarantined and deceased series and their residual scales. The fitted
+# parameters are non-negative, and e0 and i0 are orders of magnitude below their bounds, so a log scale keeps draws
+# within range without clipping. Several parameters are barely identifiable from two series, so a Gaussian prior on
+# the logarithms, centred on x with standard deviation prior_scale, keeps the directions the data does not constrain
+# within a factor of about exp(prior_scale). The model bends away from the fit along those directions, quadratically,
+# so a wide prior drags the ensemble median below the fitted trajectory. Entries of x that are zero keep a zero
+# variance.
+def gauss_newton_covariance(problem: FitProblem, x: np.ndarray, prior_scale: float = 0.1) -> np.ndarray:
+    x = np.asarray(x, dtype=np.float64)
+    predicted, sensitivities = problem.solve_sensitivity(x)
+    # Times x, they are the sensitivities with respect to the logarithms.
+    sensitivities = sensitivities * x
+    positive = x > 0
+    quarantined_scale, deceased_scale = residual_scales(problem, x)
+    information = np.eye(positive.sum()) / prior_scale ** 2
+    for series, mask, scale in (('quarantined', problem.loss.quarantined_mask, quarantined_scale),
+                                ('deceased', problem.loss.deceased_mask, deceased_scale)):
+        n = min(len(predicted), len(mask))
+        jacobian = sensitivities[:n, COMPARTMENT_INDEX[series]][mask[:n] > 0][:, positive]
+        information += jacobian.T @ jacobian / max(scale, 1e-12) ** 2
+    covariance = np.zeros((x.size, x.size))
+    covariance[np.ix_(positive, positive)] = np.linalg.inv(information)
+    return covariance
+
+
+# Chunks of n_samples fitted vectors drawn from the log-normal distribution around x of gauss_newton_covariance. Its
+# median is x.
+def gaussian_samples(problem: FitProblem, x: np.ndarray, n_samples: int, seed: Optional[int] = None,
+                     chunk_size: int = 256, prior_scale: float = 0.1) -> Iterator[np.ndarray]:
+    eigenvalues, eigenvectors = np.linalg.eigh(gauss_newton_covariance(problem, x, prior_scale=prior_scale))
+    factor = eigenvectors * np.sqrt(np.clip(eigenvalues, 0, None))
+    rng = np.random.default_rng(seed)
+    for start in range(0, n_samples, chunk_size):
+        draws = rng.standard_normal((min(chunk_size, n_samples - start), len(x)))
+        yield np.asarray(x, dtype=np.float64) * np.exp(draws @ factor.T)
+
+
+def _bootstrap_fit(problem: FitProblem, x: np.ndarray, gt_list: List[Dict[str, float]], method: str,
+                   tol: Optional[float]) -> np.ndarray:
+    replicate = copy.copy(problem)
+    replicate._memo = OrderedDict()
+    replicate.loss = LossFunction(gt_list=gt_list, fictional_total=problem.total, total=problem.n,
+                                  time_weighting=problem.time_weighting)
+    return replicate.minimize(x, method=method, tol=tol, disp=False).x
+
+
+# Parametric bootstrap: n_samples synthetic ground truths are drawn as the fitted trajectory plus Gaussian noise with
+# the residual scales of the fit, and each one is refitted starting from x. Every refit is a full optimization, so
+# this is meant for tens of members, spread over workers processes.
+def bootstrap_samples(problem: FitProblem, x: np.ndarray, n_samples: int, seed: Optional[int] = None,
+                      workers: int = 1, method: str = '', tol: Optional[float] = 1e-4) -> Iterator[np.ndarray]:
+    predicted = problem.solve(x)
+    scales = residual_scales(problem, x)
+    masks = problem.loss.quarantined_mask, problem.loss.deceased_mask
+    to_real = problem.n / problem.total
+    rng = np.random.default_rng(seed)
+    gt_lists = []
+    for _ in range(n_samples):
+        gt_list = [{} for _ in range(len(problem.epidemic_evolution))]
+        for series, mask, scale in zip(BAND_SERIES, masks, scales):
+            n = min(len(predicted), len(mask))
+            noisy = np.clip(predicted[series][:n] + rng.normal(0, scale, n), 0, None) * to_real
+            for day in np.flatnonzero(mask[:n]):
+                gt_list[day][series] = float(noisy[day])
+        gt_lists.append(gt_list)
+
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(_bootstrap_fit, problem, x, gt_list, method, tol) for gt_list in gt_lists]
+            yield np.array([future.result() for future in futures])
+    else:
+        for gt_list in gt_lists:
+            yield np.array([_bootstrap_fit(problem, x, gt_list, method, tol)])
+
+
+# Per-day quantile bands of the quarantined and deceased individuals over an ensemble given as chunks of fitted
+# vectors. Each chunk is integrated and folded into streaming quantile estimators, so the ensemble is never stored.
+# For the original model a chunk is integrated as a batch whose members share the steps of one integration, so a
+# single member the solver cannot handle fails the whole batch; its members are then integrated one at a time. Other
+# models are integrated one member at a time through solve_fitted. Members that fail or have non finite values are
+# dropped and counted, and a ValueError is raised if every member is. Returns a dict with the quantiles, the number of
+# members kept and dropped and, for each series, a (quantiles, days) array in the units of the real population.
+def ensemble_bands(problem: FitProblem, samples: Iterator[np.ndarray], simulation_duration: int,
+                   quantiles: Sequence[float] = QUANTILES) -> Dict:
+    aggregator = P2Quantiles(quantiles, (len(BAND_SERIES), simulation_duration + 1))
+    columns = [COMPARTMENT_INDEX[series] for series in BAND_SERIES]
+    members = failed = non_finite = 0
+    for chunk in samples:
+        if problem.legacy:
+            states = solve_fitted_batch(problem, chunk, simulation_duration)
+            if states.shape[1] != simulation_duration + 1:
+                states = [solve_fitted_batch(problem, x[None], simulation_duration)[0] for x in chunk]
+        else:
+            states = [solve_fitted(problem, x, simulation_duration) for x in chunk]
+        for member in states:
+            values = member[:, columns].T
+            if values.shape[1] != simulation_duration + 1:
+                failed += 1
+            elif not np.isfinite(values).all():
+                non_finite += 1
+            else:
+                aggregator.update(values)
+                members += 1
+    if members == 0:
+        raise ValueError(f'All {failed + non_finite} members of the ensemble were dropped: {failed} failed to '
+                         f'integrate and {non_finite} had non finite values.')
+    bands = aggregator.result()
+    result = {'quantiles': list(quantiles), 'members': members, 'dropped': failed + non_finite}
+    for k, series in enumerate(BAND_SERIES):
+        result[series] = bands[:, k]
+    return result
@@ -0,0 +1,57 @@
+import hashlib
+import json
+import os
+from typing import Dict, Optional
+
+import numpy as np
+
+
+# On-disk store of fitted parameter vectors. Entries are keyed by a hash of the training data file together with every
+# setting that changes the fit (initial guesses, bounds, method, tolerance, ...), so editing any of them triggers a
+# refit while re-running an unchanged fit is a file read.
+class FitCache:
+    def __init__(self, cache_dir: str = '.fit_cache'):
+        self.cache_dir = cache_dir
+
+    def key(self, data_path: str, **settings) -> str:
+        digest = hashlib.sha256()
+        with open(data_path, 'rb') as data_file:
+            digest.update(data_file.read())
+        digest.update(json.dumps(settings, sort_keys=True, default=_to_json).encode())
+        return digest.hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f'{key}.json')
+
+    def load(self, key: str) -> Optional[Dict]:
+        try:
+            with open(self._path(key)) as cache_file:
+                return json.load(cache_file)
+        except (OSError, ValueError):
+            return None
+
+    def store(self, key: str, entry: Dict):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # Write to a temporary file first so concurrent readers never see a partial entry.
+        tmp_path = f'{self._path(key)}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as cache_file:
+            json.dump(entry, cache_file, default=_to_json)
+        os.replace(tmp_path, self._path(key))
+
+    def clear(self) -> int:
+        if not os.path.isdir(self.cache_dir):
+            return 0
+        removed = 0
+        for file_name in os.listdir(self.cache_dir):
+            if file_name.endswith('.json'):
+                os.remove(os.path.join(self.cache_dir, file_name))
+                removed += 1
+        return removed
+
+
+def _to_json(value):
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f'{type(value)} is not JSON serializable')
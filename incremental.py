@@ -0,0 +1,130 @@
+import json
+import time
+from typing import Dict, List, Optional
+
+import click
+import numpy as np
+
+from model_fitting import FitProblem, LossFunction
+from parameter_sets import STATE_ARGUMENTS
+from partitioned_model import PartitionedModel
+
+
+@click.command('refit-parameters')
+@click.option('--data-path', prompt='Path to json data.')
+@click.option('--previous-path', prompt='Path to the previous parameters json.',
+              help='Parameters of the previous fit, used as starting point.')
+@click.option('--output-path', default='trained_parameters.json', help='Where the refitted parameters are written.')
+@click.option('--window', type=int, help='Only fit the last days, with the trajectory before them held fixed. The '
+                                         'output then only holds the rates, which cannot be simulated from day 0.')
+@click.option('--method', default='L-BFGS-B', help='scipy.optimize.minimize method. A quasi-Newton method suits a '
+                                                   'start that is already close to the optimum.')
+@click.option('--tol', type=float, help='Tolerance of the optimizer.')
+@click.option('--gradient', is_flag=True, help='Use exact gradients from the forward sensitivity equations.')
+@click.option('--piecewise', is_flag=True, help='Integrate each quarantine phase in a single solver call.')
+@click.option('--time-weighting', type=click.Choice(['constant', 'linear', 'quadratic']), default='constant',
+              help='Weight of each day in the loss.')
+@click.option('--drift-path', help='Json file where the parameter drift is written.')
+def click_refit_parameters(data_path: str, previous_path: str, output_path: str = 'trained_parameters.json',
+                           window: Optional[int] = None, method: str = 'L-BFGS-B', tol: Optional[float] = None,
+                           gradient: bool = False, piecewise: bool = False, time_weighting: str = 'constant',
+                           drift_path: Optional[str] = None):
+    with open(previous_path) as previous_file:
+        previous = json.load(previous_file)
+    start = time.perf_counter()
+    parameters, drift = refit_parameters(data_path, previous, window=window, method=method, tol=tol,
+                                         gradient=gradient, piecewise=piecewise, time_weighting=time_weighting)
+    print(f'\nRefitted in {time.perf_counter() - start:.1f} s.')
+    print('\nparameter\tprevious\trefitted\trelative change')
+    for row in drift:
+        print(f'{row["parameter"]}\t{row["previous"]:.6g}\t{row["refitted"]:.6g}\t{row["relative_change"]:+.2%}')
+
+    with open(output_path, 'w') as output_file:
+        json.dump(parameters, output_file, indent=2)
+    if drift_path is not None:
+        with open(drift_path, 'w') as drift_file:
+            json.dump(drift, drift_file, indent=2)
+
+
+# Fit of the last window days only. The state on the first day of the window is taken once from the previous fit, and
+# every evaluation integrates from there, so the prefix is neither refitted nor integrated again. The initial exposed
+# and infected individuals only act through that state, so the fitted vector is reduced to the 14 rates. The state on
+# the first day does not depend on them either, so exact gradients come from sensitivities that start at zero there.
+class WindowFitProblem(FitProblem):
+    def __init__(self, gt_data: Dict, previous: np.ndarray, window: int, **kwargs):
+        super().__init__(gt_data, **kwargs)
+        self.previous = np.asarray(previous, dtype=np.float64)
+        self.window_start = max(self.simulation_duration - window, 0)
+        prefix = super().model(self.previous).solve(super().initial_state(self.previous), self.window_start,
+                                                    piecewise=self.piecewise, rtol=self.rtol, atol=self.atol,
+                                                    integrator=self.integrator, jit=self.jit)
+        assert len(prefix) == self.window_start + 1, 'The previous parameters do not integrate up to the window.'
+        self.window_state = prefix[-1]
+        self.t0 = self.window_start
+        self.loss = LossFunction(gt_list=self.epidemic_evolution[self.window_start:], fictional_total=self.total,
+                                 total=self.n, time_weighting=self.time_weighting)
+        self.initial = list(self.previous[2:])
+        self.bounds = self.bounds[2:]
+        self.initial_state_jacobian = np.zeros((len(self.window_state), 0))
+
+    def full_vector(self, pars: List[float]) -> np.ndarray:
+        return np.concatenate([self.previous[:2], pars])
+
+    def model(self, pars: List[float]) -> PartitionedModel:
+        return super().model(self.full_vector(pars))
+
+    def initial_state(self, pars: List[float]) -> np.ndarray:
+        return self.window_state
+
+    def solve_kwargs(self, pars: List[float]) -> Dict[str, float]:
+        kwargs = super().solve_kwargs(self.full_vector(pars))
+        kwargs.update(zip(STATE_ARGUMENTS, self.window_state.tolist()), t0=self.window_start)
+        return kwargs
+
+
+def parameter_drift(previous: Dict[str, float], refitted: Dict[str, float]) -> List[Dict]:
+    drift = []
+    for name, value in refitted.items():
+        if name in previous and isinstance(value, float):
+            change = value - previous[name]
+            drift.append({'parameter': name, 'previous': previous[name], 'refitted': value, 'change': change,
+                          'relative_change': change / previous[name] if previous[name] else 0.})
+    return drift
+
+
+# Refit the data in data_path starting from the previous parameters instead of the guesses in the data. With window,
+# only the last window days are fitted (see WindowFitProblem). Returns the refitted result dict, with the ground truth
+# under gt_data, and the drift of every fitted parameter. Parameters outside the fit bounds are clipped into them. The
+# rates of a window fit only hold from window_start on, so its result is the parameters dict with window_start and
+# without the initial state and quarantine schedule: it can start a full refit, but another window refit, whose prefix
+# would be integrated from day 0 with those rates, raises a ValueError and PartitionedModel.from_parameters refuses it
+# as well.
+def refit_parameters(data_path: str, previous: Dict, window: Optional[int] = None, method: str = 'L-BFGS-B',
+                     tol: Optional[float] = None, gradient: bool = False, total: int = 10000, piecewise: bool = False,
+                     time_weighting: str = 'constant'):
+    if window is not None and 'window_start' in previous:
+        raise ValueError(f'The previous parameters are a window refit, whose rates only hold from day '
+                         f'{previous["window_start"]}. Refit without a window first.')
+    with open(data_path) as data_file:
+        gt_data = json.load(data_file)
+    problem = FitProblem(gt_data, total=total, piecewise=piecewise, time_weighting=time_weighting)
+    lower, upper = np.array(problem.bounds, dtype=np.float64).T
+    initial = np.clip(problem.vector(previous), lower, upper)
+    if window is not None:
+        problem = WindowFitProblem(gt_data, initial, window, total=total, piecewise=piecewise,
+                                   time_weighting=time_weighting)
+        initial = initial[2:]
+
+    res = problem.minimize(initial, method=method, gradient=gradient, tol=tol, disp=False).x
+    drift = parameter_drift(previous, problem.parameters_dict(res))
+    if window is not None:
+        parameters = problem.parameters_dict(res)
+        parameters['window_start'] = problem.window_start
+    else:
+        parameters = problem.result_dict(res)
+    parameters['gt_data'] = problem.epidemic_evolution
+    return parameters, drift
+
+
+if __name__ == '__main__':
+    click_refit_parameters()
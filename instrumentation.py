@@ -0,0 +1,134 @@
+import json
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from functools import wraps
+from typing import Callable, Dict, Optional
+
+
+# Counters and timers of a profiled run. Solver, loss and optimizer code report to the active profiler, if any, so
+# nothing is measured (and next to nothing is paid) outside a profiling() block. Per-iteration traces are written as
+# JSON lines to trace_path.
+# The solver work is measured by rhs_evaluations, every call of a right hand side on any integrator path, and
+# integrator_failures, every integration that stopped before its end. Steps are not counted: scipy.integrate.ode
+# keeps the accepted and rejected steps of dopri5 in the private work arrays of its integrator only, LSODA reports no
+# rejected steps, solve_ivp returns evaluation counts but no step counts, and rk4 never rejects a step.
+class Profiler:
+    def __init__(self, trace_path: Optional[str] = None):
+        self.counters = Counter()
+        self.timers = defaultdict(float)
+        self.start_time = time.perf_counter()
+        self.trace_path = trace_path
+        self._trace_file = open(trace_path, 'w') if trace_path is not None else None
+
+    def count(self, name: str, value: int = 1):
+        self.counters[name] += value
+
+    def add_time(self, name: str, seconds: float):
+        self.timers[name] += seconds
+
+    def wrap_rhs(self, rhs: Callable) -> Callable:
+        @wraps(rhs)
+        def profiled_rhs(*args):
+            start = time.perf_counter()
+            try:
+                return rhs(*args)
+            finally:
+                self.counters['rhs_evaluations'] += 1
+                self.timers['rhs_evaluations'] += time.perf_counter() - start
+        return profiled_rhs
+
+    def record_iteration(self, loss: float):
+        self.count('optimizer_iterations')
+        if self._trace_file is not None:
+            self._trace_file.write(json.dumps({
+                'iteration': self.counters['optimizer_iterations'],
+                'loss': float(loss),
+                'elapsed': time.perf_counter() - self.start_time,
+                'solves': self.counters['solve_ode'],
+                'rhs_evaluations': self.counters['rhs_evaluations'],
+                'loss_evaluations': self.counters['loss'],
+                'integrator_failures': self.counters['integrator_failures'],
+            }) + '\n')
+            self._trace_file.flush()
+
+    def report(self) -> Dict:
+        names = sorted(set(self.counters) | set(self.timers))
+        return {
+            'elapsed': time.perf_counter() - self.start_time,
+            'counters': {name: {'count': self.counters[name], 'time': self.timers.get(name)} for name in names},
+        }
+
+    def close(self):
+        if self._trace_file is not None:
+            self._trace_file.close()
+            self._trace_file = None
+
+
+_profiler: Optional[Profiler] = None
+
+
+def current() -> Optional[Profiler]:
+    return _profiler
+
+
+@contextmanager
+def profiling(trace_path: Optional[str] = None):
+    global _profiler
+    previous = _profiler
+    _profiler = Profiler(trace_path)
+    try:
+        yield _profiler
+    finally:
+        _profiler.close()
+        _profiler = previous
+
+
+def count(name: str, value: int = 1):
+    if _profiler is not None:
+        _profiler.count(name, value)
+
+
+def wrap_rhs(rhs: Callable) -> Callable:
+    if _profiler is None:
+        return rhs
+    return _profiler.wrap_rhs(rhs)
+
+
+# Decorator counting and timing the calls of a function under name while a profiler is active.
+def timed(name: str) -> Callable:
+    def decorator(function: Callable) -> Callable:
+        @wraps(function)
+        def timed_function(*args, **kwargs):
+            profiler = _profiler
+            if profiler is None:
+                return function(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                profiler.count(name)
+                profiler.add_time(name, time.perf_counter() - start)
+        return timed_function
+    return decorator
+
+
+def print_report(profiler: Profiler):
+    report = profiler.report()
+    print(f'\nProfile ({report["elapsed"]:.2f} s):')
+    for name, values in report['counters'].items():
+        timing = '' if values['time'] is None else f'\t{values["time"]:.3f} s'
+        print(f'\t{name}:\t{values["count"]}{timing}')
+    if profiler.trace_path is not None:
+        print(f'\tper-iteration trace written to {profiler.trace_path}')
+
+
+# Profiles the block when enabled, or when a trace is requested, and prints the report at its end.
+@contextmanager
+def maybe_profiling(enabled: bool, trace_path: Optional[str] = None):
+    if not enabled and trace_path is None:
+        yield None
+        return
+    with profiling(trace_path) as profiler:
+        yield profiler
+    print_report(profiler)
@@ -1,14 +1,49 @@
+import importlib
 import json
 from typing import Optional
 
 import click
 
-from model_fitting import click_get_optimal_parameters, get_optimal_parameters
-from ode_solving import run_model
-from quarantine_end import simulate_quarantine_end
 
+# Subcommands defined in other modules, as name: (module, command attribute, short help). They are imported only when
+# invoked, so starting the CLI, --help and every command import just what they need. SciPy, matplotlib and numba
+# take most of a run's startup otherwise.
+LAZY_COMMANDS = {
+    'fit-parameters': ('model_fitting', 'click_get_optimal_parameters', 'Fit the model to a dataset.'),
+    'fit-staged': ('model_fitting', 'click_get_staged_parameters', 'Global coarse fit, then local refinement.'),
+    'quarantine-end-prediction': ('quarantine_end', 'simulate_quarantine_end',
+                                  'Predict several quarantine end dates.'),
+    'partitioned-prediction': ('partitioned_model', 'run_partitioned_model', 'Predict with the partitioned model.'),
+    'sweep': ('sweep', 'run_sweep', 'Run scenarios over grids and sampled ranges.'),
+    'fit-regions': ('regions', 'click_fit_regions', 'Fit several regions concurrently.'),
+    'refit-parameters': ('incremental', 'click_refit_parameters', 'Refit starting from previous parameters.'),
+    'serve': ('server', 'click_serve', 'Serve scenario queries and fits over HTTP.'),
+    'stochastic': ('stochastic', 'click_simulate_stochastic', 'Simulate stochastic realizations by tau-leaping.'),
+}
 
-@click.group()
+
+class LazyGroup(click.Group):
+    def list_commands(self, ctx: click.Context):
+        return sorted(set(super().list_commands(ctx)) | set(LAZY_COMMANDS))
+
+    def get_command(self, ctx: click.Context, cmd_name: str) -> Optional[click.Command]:
+        if cmd_name in LAZY_COMMANDS:
+            module_name, attribute, _ = LAZY_COMMANDS[cmd_name]
+            return getattr(importlib.import_module(module_name), attribute)
+        return super().get_command(ctx, cmd_name)
+
+    # Same listing as click.Group, with the short help of lazy commands taken from LAZY_COMMANDS instead of importing
+    # every module.
+    def format_commands(self, ctx: click.Context, formatter: click.HelpFormatter):
+        rows = [(name, LAZY_COMMANDS[name][2] if name in LAZY_COMMANDS else
+                 self.commands[name].get_short_help_str(formatter.width))
+                for name in self.list_commands(ctx)]
+        if rows:
+            with formatter.section('Commands'):
+                formatter.write_dl(rows)
+
+
+@click.group(cls=LazyGroup)
 def cli():
     pass
 
@@ -17,51 +52,72 @@ def cli():
 @click.option('--train-data-path', prompt='Path to json data used for training', required=True)
 @click.option('--gt-data-path', prompt='Path to json with ground truth data', default=None)
 @click.option('--simulation-duration', type=int)
+@click.option('--cache-dir', default='.fit_cache', help='Directory where fitted parameters are cached.')
+@click.option('--no-cache', is_flag=True, help='Refit even if the same fit is cached.')
+@click.option('--clear-cache', is_flag=True, help='Remove every cached fit before fitting.')
+@click.option('--profile', is_flag=True, help='Report solver, loss and optimizer counters and timings of the fit.')
+@click.option('--profile-trace', help='JSON lines file where the loss and timings of every iteration are written.')
+@click.option('--output-path', help='Write the figure to this png, svg or pdf file instead of showing it.')
+@click.option('--ensemble-size', default=0, help='Number of parameter vectors drawn around the fit for uncertainty '
+                                                 'bands. 0 draws no bands.')
+@click.option('--ensemble-method', type=click.Choice(['gaussian', 'bootstrap']), default='gaussian',
+              help='Gaussian from the Gauss-Newton Hessian, or parametric bootstrap refits (slow, one fit each).')
+@click.option('--ensemble-seed', type=int, help='Seed of the ensemble draws.')
+@click.option('--workers', default=1, help='Number of processes running the bootstrap refits.')
+@click.option('--no-plot', is_flag=True, help='Only fit and print the parameters, without predicting or plotting.')
 def fit_and_predict(train_data_path: str, gt_data_path: Optional[str] = None,
-                    simulation_duration: Optional[int] = None):
+                    simulation_duration: Optional[int] = None, cache_dir: str = '.fit_cache',
+                    no_cache: bool = False, clear_cache: bool = False, profile: bool = False,
+                    profile_trace: Optional[str] = None, output_path: Optional[str] = None,
+                    ensemble_size: int = 0, ensemble_method: str = 'gaussian', ensemble_seed: Optional[int] = None,
+                    workers: int = 1, no_plot: bool = False):
+    from fit_cache import FitCache
+    import instrumentation
+    from model_fitting import FitProblem, get_optimal_parameters
+
     gt_data = None
     if gt_data_path is not None:
         with open(gt_data_path) as data_file:
             gt_data = json.load(data_file)
             gt_data = gt_data['epidemic_evolution']
 
-    if simulation_duration is None:
+    if simulation_duration is None and not no_plot:
         assert gt_data is not None
         simulation_duration = len(gt_data) - 1
 
-    res_dict = get_optimal_parameters(data_path=train_data_path, verbose=True)
-    run_model(sm0=res_dict['suspected_medical_initial'],
-              se0=res_dict['suspected_essential_initial'],
-              so0=res_dict['suspected_others_initial'],
-              e0=res_dict['exposed_initial'],
-              i0=res_dict['infected_initial'],
-              q0=res_dict['quarantined_initial'],
-              r0=res_dict['recovered_initial'],
-              d0=res_dict['deceased_initial'],
-              quarantine_start=res_dict['quarantine_start'],
-              quarantine_1_duration=res_dict['quarantine_1_duration'],
-              quarantine_2_duration=res_dict['quarantine_2_duration'],
-              simulation_duration=simulation_duration,
-              gamma=res_dict['gamma'],
-              gamma_m_1=res_dict['gamma_m_1'],
-              gamma_e_1=res_dict['gamma_e_1'],
-              gamma_o_1=res_dict['gamma_o_1'],
-              gamma_m_2=res_dict['gamma_m_2'],
-              gamma_e_2=res_dict['gamma_e_2'],
-              gamma_o_2=res_dict['gamma_o_2'],
-              alpha=res_dict['alpha'],
-              delta=res_dict['delta'],
-              sigma=res_dict['sigma'],
-              r_i=res_dict['r_i'],
-              r_q=res_dict['r_q'],
-              d_i=res_dict['d_i'],
-              d_q=res_dict['d_q'],
-              gt_data=gt_data)
+    cache = FitCache(cache_dir)
+    if clear_cache:
+        cache.clear()
+    with instrumentation.maybe_profiling(profile, profile_trace):
+        res_dict = get_optimal_parameters(data_path=train_data_path, verbose=True,
+                                          cache=None if no_cache else cache)
+
+    if no_plot:
+        return res_dict
+
+    bands = None
+    if ensemble_size > 0:
+        from ensemble import bootstrap_samples, ensemble_bands, gaussian_samples
+        problem = FitProblem.from_path(train_data_path)
+        x = problem.vector(res_dict)
+        if ensemble_method == 'bootstrap':
+            samples = bootstrap_samples(problem, x, ensemble_size, seed=ensemble_seed, workers=workers)
+        else:
+            samples = gaussian_samples(problem, x, ensemble_size, seed=ensemble_seed)
+        bands = ensemble_bands(problem, samples, simulation_duration)
+        if bands['dropped']:
+            print(f'{bands["dropped"]} of {ensemble_size} ensemble members could not be integrated and were dropped.')
+    # The prediction goes through PartitionedModel, so it takes any groups and phases the data describes.
+    from partitioned_model import PartitionedModel
+    model = PartitionedModel.from_parameters(res_dict)
+    trajectory = model.to_trajectory(model.solve(model.initial_state_from_parameters(res_dict),
+                                                 simulation_duration=simulation_duration))
+    from visualization import show_results
+    show_results(trajectory, gt_data=None if gt_data is None else gt_data[:simulation_duration + 1],
+                 output_path=output_path, bands=bands)
 
 
 cli.add_command(fit_and_predict)
-cli.add_command(click_get_optimal_parameters)
-cli.add_command(simulate_quarantine_end)
 
 
 if __name__ == '__main__':
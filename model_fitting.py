@@ -1,195 +1,730 @@
 import json
-from typing import Dict, List, Union
+import time
+import warnings
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Dict, List, Optional, Tuple, Union
 
 import click
 import numpy as np
-from scipy.optimize import minimize
+from scipy.optimize import OptimizeResult, differential_evolution, minimize
 
-from ode_solving import solve_ode
+from fit_cache import FitCache
+import instrumentation
+from ode_solving import PRESETS
+from parameter_sets import sample_box
+from partitioned_model import RATE_NAMES, PartitionedModel, initial_key
+from trajectory import COMPARTMENT_INDEX, Trajectory
 
 
 @click.command('fit-parameters')
 @click.option('--data-path', prompt='Path to json data.')
-def click_get_optimal_parameters(data_path: str):
-    return get_optimal_parameters(data_path=data_path, verbose=True)
+@click.option('--piecewise', is_flag=True, help='Integrate each quarantine phase in a single solver call.')
+@click.option('--time-weighting', type=click.Choice(['constant', 'linear', 'quadratic']), default='constant',
+              help='Weight of each day in the loss.')
+@click.option('--gradient', is_flag=True, help='Use exact gradients from the forward sensitivity equations.')
+@click.option('--starts', default=1, help='Number of starting points. The first one is the guess in the data json.')
+@click.option('--workers', default=1, help='Number of processes running the fits from different starting points.')
+@click.option('--sampling', type=click.Choice(['sobol', 'lhs']), default='sobol',
+              help='How starting points are sampled around the guess.')
+@click.option('--seed', default=0, help='Seed of the sampling of starting points.')
+@click.option('--cache-dir', default='.fit_cache', help='Directory where fitted parameters are cached.')
+@click.option('--no-cache', is_flag=True, help='Refit even if the same fit is cached.')
+@click.option('--clear-cache', is_flag=True, help='Remove every cached fit before fitting.')
+@click.option('--profile', is_flag=True, help='Report solver, loss and optimizer counters and timings.')
+@click.option('--profile-trace', help='JSON lines file where the loss and timings of every iteration are written.')
+@click.option('--preset', type=click.Choice(list(PRESETS)), help='Integrator settings: fast (fixed step RK4), '
+                                                                 'balanced (dopri5, the default) or accurate (Radau).')
+@click.option('--jit', is_flag=True,
+              help='Use the compiled right hand side. Without numba the ordinary one is used.')
+def click_get_optimal_parameters(data_path: str, piecewise: bool = False, time_weighting: str = 'constant',
+                                 gradient: bool = False, starts: int = 1, workers: int = 1, sampling: str = 'sobol',
+                                 seed: int = 0, cache_dir: str = '.fit_cache', no_cache: bool = False,
+                                 clear_cache: bool = False, profile: bool = False, profile_trace: Optional[str] = None,
+                                 preset: Optional[str] = None, jit: bool = False):
+    cache = FitCache(cache_dir)
+    if clear_cache:
+        cache.clear()
+    with instrumentation.maybe_profiling(profile, profile_trace):
+        if starts > 1:
+            return get_multi_start_parameters(data_path=data_path, n_starts=starts, workers=workers,
+                                              sampling=sampling, seed=seed, verbose=True, piecewise=piecewise,
+                                              time_weighting=time_weighting, gradient=gradient,
+                                              cache=None if no_cache else cache, preset=preset, jit=jit)
+        return get_optimal_parameters(data_path=data_path, verbose=True, piecewise=piecewise,
+                                      time_weighting=time_weighting, gradient=gradient,
+                                      cache=None if no_cache else cache, preset=preset, jit=jit)
 
 
+@click.command('fit-staged')
+@click.option('--data-path', prompt='Path to json data.')
+@click.option('--coarse-rtol', default=1e-3, help='Relative tolerance of the integrator in the coarse stage.')
+@click.option('--coarse-atol', default=1e-6, help='Absolute tolerance of the integrator in the coarse stage.')
+@click.option('--coarse-days', type=int, help='Only fit the first days of data in the coarse stage.')
+@click.option('--coarse-maxiter', default=20, help='Generations of differential evolution in the coarse stage.')
+@click.option('--coarse-popsize', default=8, help='Population size multiplier of differential evolution.')
+@click.option('--seed', type=int, help='Seed of differential evolution.')
+@click.option('--workers', default=1, help='Number of processes evaluating the coarse population.')
+@click.option('--method', default='', help='scipy.optimize.minimize method of the refinement, trust-constr by default.')
+@click.option('--gradient', is_flag=True, help='Refine with exact gradients from the forward sensitivity equations.')
+@click.option('--tol', type=float, help='Tolerance of the refinement.')
+@click.option('--refine-rtol', default=1e-6, help='Relative tolerance of the integrator in the refinement.')
+@click.option('--refine-atol', default=1e-12, help='Absolute tolerance of the integrator in the refinement.')
+@click.option('--piecewise', is_flag=True, help='Also integrate each quarantine phase in a single solver call in the '
+                                             'refinement. The coarse stage always does.')
+@click.option('--time-weighting', type=click.Choice(['constant', 'linear', 'quadratic']), default='constant',
+              help='Weight of each day in the loss.')
+def click_get_staged_parameters(data_path: str, coarse_rtol: float = 1e-3, coarse_atol: float = 1e-6,
+                                coarse_days: Optional[int] = None, coarse_maxiter: int = 20, coarse_popsize: int = 8,
+                                seed: Optional[int] = None, workers: int = 1, method: str = '',
+                                gradient: bool = False, tol: Optional[float] = None, refine_rtol: float = 1e-6,
+                                refine_atol: float = 1e-12, piecewise: bool = False,
+                                time_weighting: str = 'constant'):
+    return get_staged_parameters(data_path=data_path, coarse_rtol=coarse_rtol, coarse_atol=coarse_atol,
+                                 coarse_days=coarse_days, coarse_maxiter=coarse_maxiter,
+                                 coarse_popsize=coarse_popsize, seed=seed, workers=workers, method=method,
+                                 gradient=gradient, tol=tol, refine_rtol=refine_rtol, refine_atol=refine_atol,
+                                 verbose=True, piecewise=piecewise, time_weighting=time_weighting)
+
+
+# Raised from the objective once a fit runs past its deadline.
+class FitTimeout(Exception):
+    pass
+
+
+# Everything needed to fit the model to one dataset: initial guess, bounds, loss and the mapping between the fitted
+# vector and the PartitionedModel described by the data (see PartitionedModel.structure_from_data). The vector holds
+# e0, i0, gamma, the K * P gamma reductions phase by phase (every group of the first phase, then of the second, ...),
+# alpha, delta, sigma, r_i, r_q, d_i and d_q; for the original medical, essential and others groups with two phases
+# the reductions are m_1, e_1, o_1, m_2, e_2, o_2. Populations are rescaled to a fictional total. Instances are
+# picklable so fits can run in worker processes.
+class FitProblem:
+    def __init__(self, gt_data: Dict, total: int = 10000, piecewise: bool = False,
+                 time_weighting: str = 'constant', memo_size: int = 256, rtol: float = 1e-6, atol: float = 1e-12,
+                 integrator: str = 'dopri5', jit: bool = False):
+        self.total = total
+        self.piecewise = piecewise
+        self.rtol = rtol
+        self.atol = atol
+        self.integrator = integrator
+        self.jit = jit
+        self.time_weighting = time_weighting
+        # LRU memo of objective evaluations, since optimizers often probe the same vector more than once.
+        self.memo_size = memo_size
+        self._memo = OrderedDict()
+        # time.monotonic() value after which objective evaluations raise FitTimeout.
+        self.deadline = None
+        # Day of the first state; the data starts on that day too.
+        self.t0 = 0
+        n = self.n = gt_data['total_individuals']
+        epidemic_evolution = self.epidemic_evolution = gt_data['epidemic_evolution']
+        simulation_duration = self.simulation_duration = len(epidemic_evolution)
+        assert simulation_duration > 0
+        self.q0 = epidemic_evolution[0].get('quarantined', 0) * total / n
+        self.r0 = epidemic_evolution[0].get('recovered', 0) * total / n
+        self.d0 = epidemic_evolution[0].get('deceased', 0) * total / n
+
+        self.quarantine_start = gt_data.get('quarantine_start', 2 * simulation_duration + 1)
+        self.quarantine_1_duration = gt_data.get('quarantine_1_duration', 2 * simulation_duration + 1)
+        self.quarantine_2_duration = gt_data.get('quarantine_2_duration', 2 * simulation_duration + 1)
+        self.structure = PartitionedModel.structure_from_data(
+            dict(gt_data, quarantine_start=self.quarantine_start, quarantine_1_duration=self.quarantine_1_duration,
+                 quarantine_2_duration=self.quarantine_2_duration))
+        self.legacy = 'groups' not in gt_data and 'phase_durations' not in gt_data
+        self.group_fractions = np.array(self.structure['group_fractions'], dtype=np.float64)
+        n_groups, n_phases = len(self.structure['group_names']), len(self.structure['phase_durations'])
+
+        frac_medical = self.frac_medical = gt_data.get('fraction_medical', 0)
+        frac_essential = self.frac_essential = gt_data.get('fraction_essential', 0)
+        self.frac_others = 1 - frac_medical - frac_essential
+        e0_guess = gt_data.get('initial_exposed_guess', 1) * total / n
+        i0_guess = gt_data.get('initial_infected_guess', 1) * total / n
+
+        epsilon = 0
+        default_gamma = 1.96
+        default_gamma_reduction_1 = 1
+        default_gamma_reduction_2 = 1
+        gamma_guess = gt_data.get('gamma_guess', default_gamma)
+        if self.legacy:
+            m_gamma_1_guess = gt_data.get('m_gamma_1_guess', gamma_guess / default_gamma_reduction_1)
+            m_gamma_reduction_1_guess = max(gamma_guess / m_gamma_1_guess, 1 + epsilon)
+            e_gamma_1_guess = gt_data.get('e_gamma_1_guess', gamma_guess / default_gamma_reduction_1)
+            e_gamma_reduction_1_guess = max(gamma_guess / e_gamma_1_guess, 1 + epsilon)
+            o_gamma_1_guess = gt_data.get('o_gamma_1_guess', gamma_guess / default_gamma_reduction_1)
+            o_gamma_reduction_1_guess = max(gamma_guess / o_gamma_1_guess, 1 + epsilon)
+            m_gamma_2_guess = gt_data.get('m_gamma_2_guess', m_gamma_1_guess / default_gamma_reduction_2)
+            m_gamma_reduction_2_guess = max(m_gamma_1_guess / m_gamma_2_guess, 1 + epsilon)
+            e_gamma_2_guess = gt_data.get('e_gamma_2_guess', e_gamma_1_guess / default_gamma_reduction_2)
+            e_gamma_reduction_2_guess = max(e_gamma_1_guess / e_gamma_2_guess, 1 + epsilon)
+            o_gamma_2_guess = gt_data.get('o_gamma_2_guess', o_gamma_1_guess / default_gamma_reduction_2)
+            o_gamma_reduction_2_guess = max(o_gamma_1_guess / o_gamma_2_guess, 1 + epsilon)
+            gamma_reductions_guess = [m_gamma_reduction_1_guess, e_gamma_reduction_1_guess, o_gamma_reduction_1_guess,
+                                      m_gamma_reduction_2_guess, e_gamma_reduction_2_guess, o_gamma_reduction_2_guess]
+        else:
+            # "gamma_reductions_guess" is a (K, P) list, like the "gamma_reductions" of a parameters json.
+            gamma_reductions_guess = np.ones((n_groups, n_phases))
+            if 'gamma_reductions_guess' in gt_data:
+                gamma_reductions_guess = np.array(gt_data['gamma_reductions_guess'], dtype=np.float64)
+            gamma_reductions_guess = np.maximum(gamma_reductions_guess, 1 + epsilon).T.ravel().tolist()
+        alpha_guess = gt_data.get('alpha_guess', 0.2)
+        delta_guess = max(gt_data.get('delta_guess', 0), epsilon)
+        sigma_guess = gt_data.get('sigma_guess', 0.196)
+        r_i_guess = gt_data.get('r_i_guess', 0.222)
+        r_q_guess = gt_data.get('r_q_guess', 0.222)
+        d_i_guess = gt_data.get('d_i_guess', 0.053)
+        d_q_guess = gt_data.get('d_q_guess', 0.053)
+
+        self.loss = LossFunction(gt_list=epidemic_evolution, fictional_total=total, total=n,
+                                 time_weighting=time_weighting)
+
+        # Derivative of the initial state (s_1, ..., s_K, e0, i0, q0, r0, d0) with respect to the fitted e0 and i0.
+        self.initial_state_jacobian = np.zeros((n_groups + 5, 2))
+        self.initial_state_jacobian[:n_groups] = -self.group_fractions[:, None]
+        self.initial_state_jacobian[n_groups, 0] = 1
+        self.initial_state_jacobian[n_groups + 1, 1] = 1
+
+        self.initial = ([e0_guess, i0_guess,
+                         gamma_guess]
+                        + gamma_reductions_guess
+                        + [alpha_guess, delta_guess, sigma_guess,
+                           r_i_guess, r_q_guess,
+                           d_i_guess, d_q_guess])
+        self.bounds = ([(0, total), (0, total),
+                        (0, 10)]
+                       + [(1, 100)] * (n_groups * n_phases)
+                       + [(0, 1), (0, 1), (0, 1),
+                          (0, 1), (0, 1),
+                          (0, 1), (0, 1)])
+
+    @classmethod
+    def from_path(cls, data_path: str, **kwargs) -> 'FitProblem':
+        # Get gt data.
+        with open(data_path) as data_file:
+            gt_data = json.load(data_file)
+        return cls(gt_data, **kwargs)
+
+    # The whole vector described above from the fitted one. Both are the same here; problems fitting only part of the
+    # vector complete it, and parameters_dict and result_dict go through it once.
+    def full_vector(self, pars: List[float]) -> np.ndarray:
+        return np.asarray(pars, dtype=np.float64)
+
+    # (K, P) gamma reductions of a whole vector.
+    def _gamma_reductions(self, pars: np.ndarray) -> np.ndarray:
+        n_groups, n_phases = len(self.structure['group_names']), len(self.structure['phase_durations'])
+        return np.reshape(pars[3:3 + n_groups * n_phases], (n_phases, n_groups)).T
+
+    # Model of a fitted vector.
+    def model(self, pars: List[float]) -> PartitionedModel:
+        n_groups, n_phases = len(self.structure['group_names']), len(self.structure['phase_durations'])
+        al, de, s, ri, rq, di, dq = pars[3 + n_groups * n_phases:]
+        return PartitionedModel(**self.structure, gamma=pars[2], gamma_reductions=self._gamma_reductions(pars),
+                                alpha=al, delta=de, sigma=s, r_i=ri, r_q=rq, d_i=di, d_q=dq)
+
+    # State of day t0, in fictional individuals, of a fitted vector.
+    def initial_state(self, pars: List[float]) -> np.ndarray:
+        e0, i0 = pars[:2]
+        s0 = self.total - i0 - e0 - self.q0 - self.r0 - self.d0
+        return np.concatenate([self.group_fractions * s0, [e0, i0, self.q0, self.r0, self.d0]])
+
+    # Trajectory of a fitted vector over the days of the data, in fictional individuals.
+    def solve(self, pars: List[float]) -> Trajectory:
+        model = self.model(pars)
+        return model.to_trajectory(model.solve(self.initial_state(pars), self.simulation_duration, t0=self.t0,
+                                               piecewise=self.piecewise, rtol=self.rtol, atol=self.atol,
+                                               integrator=self.integrator, jit=self.jit))
+
+    # solve_ode arguments of a fitted vector, for the medical, essential and others groups with two phases.
+    def solve_kwargs(self, pars: List[float]) -> Dict[str, float]:
+        assert self.legacy, 'solve_ode only takes the medical, essential and others groups with two phases.'
+        e0, i0, g, mg_red_1, eg_red_1, og_red_1, mg_red_2, eg_red_2, og_red_2, al, de, s, ri, rq, di, dq = pars
+        s0 = self.total - i0 - e0 - self.q0 - self.r0 - self.d0
+        return dict(sm0=self.frac_medical * s0, se0=self.frac_essential * s0, so0=self.frac_others * s0,
+                    e0=e0, i0=i0, q0=self.q0, r0=self.r0, d0=self.d0,
+                    quarantine_start=self.quarantine_start,
+                    quarantine_1_duration=self.quarantine_1_duration,
+                    quarantine_2_duration=self.quarantine_2_duration,
+                    simulation_duration=self.simulation_duration,
+                    gamma=g,
+                    m_gamma_reduction_1=mg_red_1, e_gamma_reduction_1=eg_red_1, o_gamma_reduction_1=og_red_1,
+                    m_gamma_reduction_2=mg_red_2, e_gamma_reduction_2=eg_red_2, o_gamma_reduction_2=og_red_2,
+                    alpha=al, delta=de, sigma=s,
+                    r_i=ri, r_q=rq,
+                    d_i=di, d_q=dq,
+                    piecewise=self.piecewise, rtol=self.rtol, atol=self.atol, integrator=self.integrator)
+
+    def _memo_get(self, key):
+        if key in self._memo:
+            self._memo.move_to_end(key)
+            return self._memo[key]
+        return None
+
+    def _memo_set(self, key, value):
+        if self.memo_size > 0:
+            self._memo[key] = value
+            if len(self._memo) > self.memo_size:
+                self._memo.popitem(last=False)
+
+    def _check_deadline(self):
+        if self.deadline is not None and time.monotonic() > self.deadline:
+            raise FitTimeout('The fit ran past its deadline.')
+
+    def objective_function(self, pars: List[float]) -> float:
+        self._check_deadline()
+        key = ('value', np.asarray(pars, dtype=np.float64).tobytes())
+        value = self._memo_get(key)
+        if value is None:
+            value = self.loss(self.solve(pars))
+            self._memo_set(key, value)
+        return value
+
+    # solve together with the (days, compartments, parameters) sensitivities of the trajectory with respect to the
+    # fitted vector. The model gives them ordered as the rates followed by e0 and i0, while the fitted vector starts
+    # with e0 and i0.
+    def solve_sensitivity(self, pars: List[float]) -> Tuple[Trajectory, np.ndarray]:
+        model = self.model(pars)
+        states, sensitivities = model.solve_sensitivity(
+            self.initial_state(pars), self.simulation_duration, initial_state_jacobian=self.initial_state_jacobian,
+            piecewise=self.piecewise, t0=self.t0, rtol=self.rtol, atol=self.atol, integrator=self.integrator)
+        sensitivities = model.compartment_values(sensitivities)
+        return model.to_trajectory(states), np.concatenate([sensitivities[:, :, model.n_rates:],
+                                                            sensitivities[:, :, :model.n_rates]], axis=2)
+
+    # Loss and its exact gradient from the forward sensitivity equations.
+    def objective_and_gradient(self, pars: List[float]):
+        self._check_deadline()
+        key = ('gradient', np.asarray(pars, dtype=np.float64).tobytes())
+        value_and_gradient = self._memo_get(key)
+        if value_and_gradient is None:
+            value_and_gradient = self.loss.value_and_gradient(*self.solve_sensitivity(pars))
+            self._memo_set(key, value_and_gradient)
+        return value_and_gradient
+
+    def minimize(self, initial: Optional[List[float]] = None, method: str = '', gradient: bool = False,
+                 tol: Optional[float] = None, disp: bool = True) -> OptimizeResult:
+        if initial is None:
+            initial = self.initial
+        # method = 'nelder-mead'  # not bad.  decrease fast.
+        # method = 'powell'
+        # method = 'cg'
+        # method = 'bfgs'
+        # method = 'l-bfgs-b'  # not bad. very linear.  # try reduction of 1.
+        # method = 'tnc'  # try incentivating end.
+        # method = 'cobyla'
+        # method = 'slsqp'
+        method = method or 'trust-constr'  # like.
+        # method = None
+        callback = self._iteration_callback(gradient)
+        if gradient:
+            return minimize(self.objective_and_gradient, np.array(initial), jac=True, bounds=self.bounds,
+                            method=method, tol=tol, callback=callback, options={'disp': disp})
+        return minimize(self.objective_function, np.array(initial), bounds=self.bounds, method=method,
+                        tol=tol, callback=callback, options={'disp': disp})
+
+    # Optimizer callback recording every iteration and its loss in the active profiler, if any. The loss at the
+    # iterate comes from the memo, so it is not evaluated again.
+    def _iteration_callback(self, gradient: bool = False):
+        profiler = instrumentation.current()
+        if profiler is None:
+            return None
+
+        def callback(xk, *args):
+            xk = getattr(xk, 'x', xk)
+            if gradient:
+                loss, _ = self.objective_and_gradient(xk)
+            else:
+                loss = self.objective_function(xk)
+            profiler.record_iteration(loss)
+        return callback
+
+    # Fitted model parameters in the units of the real population. The original model gives the contact rate of every
+    # group and phase under gamma_m_1 ... gamma_o_2, others their "gamma_reductions" as a (K, P) list.
+    def parameters_dict(self, res: np.ndarray) -> Dict[str, float]:
+        return self._parameters_dict(self.full_vector(res))
+
+    # parameters_dict of a whole vector.
+    def _parameters_dict(self, res: np.ndarray) -> Dict[str, float]:
+        n = self.n
+        total = self.total
+        if not self.legacy:
+            return dict({'exposed_initial': res[0] * n / total, 'infected_initial': res[1] * n / total,
+                         'gamma': res[2], 'gamma_reductions': self._gamma_reductions(res).tolist()},
+                        **dict(zip(RATE_NAMES, res[-len(RATE_NAMES):])))
+        e0_f, i0_f = res[:2]
+        gamma_f = res[2]
+        m_gamma_reduction_1_f, e_gamma_reduction_1_f, o_gamma_reduction_1_f = res[3:6]
+        m_gamma_reduction_2_f, e_gamma_reduction_2_f, o_gamma_reduction_2_f = res[6:9]
+        alpha_f, delta_f, sigma_f = res[9:12]
+        r_i_f, r_q_f = res[12:14]
+        d_i_f, d_q_f = res[14:16]
+
+        return {
+            'exposed_initial': e0_f * n / total,
+            'infected_initial': i0_f * n / total,
+            'gamma': gamma_f,
+            'gamma_m_1': gamma_f / m_gamma_reduction_1_f,
+            'gamma_e_1': gamma_f / e_gamma_reduction_1_f,
+            'gamma_o_1': gamma_f / o_gamma_reduction_1_f,
+            'gamma_m_2': gamma_f / m_gamma_reduction_1_f / m_gamma_reduction_2_f,
+            'gamma_e_2': gamma_f / e_gamma_reduction_1_f / e_gamma_reduction_2_f,
+            'gamma_o_2': gamma_f / o_gamma_reduction_1_f / o_gamma_reduction_2_f,
+            'alpha': alpha_f,
+            'delta': delta_f,
+            'sigma': sigma_f,
+            'r_i': r_i_f,
+            'r_q': r_q_f,
+            'd_i': d_i_f,
+            'd_q': d_q_f,
+        }
+
+    # Inverse of parameters_dict: the whole vector (see full_vector) of a parameters or result dict.
+    def vector(self, parameters: Dict[str, float]) -> np.ndarray:
+        scale = self.total / self.n
+        gamma = parameters['gamma']
+        if not self.legacy:
+            return np.array([parameters['exposed_initial'] * scale, parameters['infected_initial'] * scale, gamma]
+                            + np.array(parameters['gamma_reductions'], dtype=np.float64).T.ravel().tolist()
+                            + [parameters[name] for name in RATE_NAMES])
+        return np.array([parameters['exposed_initial'] * scale, parameters['infected_initial'] * scale,
+                         gamma,
+                         gamma / parameters['gamma_m_1'], gamma / parameters['gamma_e_1'],
+                         gamma / parameters['gamma_o_1'],
+                         parameters['gamma_m_1'] / parameters['gamma_m_2'],
+                         parameters['gamma_e_1'] / parameters['gamma_e_2'],
+                         parameters['gamma_o_1'] / parameters['gamma_o_2'],
+                         parameters['alpha'], parameters['delta'], parameters['sigma'],
+                         parameters['r_i'], parameters['r_q'],
+                         parameters['d_i'], parameters['d_q']])
+
+    # parameters_dict completed with the initial state and quarantine schedule, ready to be passed to run_model or, for
+    # any groups and phases, to PartitionedModel.from_parameters.
+    def result_dict(self, res: np.ndarray) -> Dict[str, Union[float, int]]:
+        n = self.n
+        total = self.total
+        res = self.full_vector(res)
+        res_dict = self._parameters_dict(res)
+        e0_f, i0_f = res[:2]
+        s0_f = total - i0_f - e0_f - self.q0 - self.r0 - self.d0
+        if not self.legacy:
+            for name, fraction in zip(self.structure['group_names'], self.group_fractions):
+                res_dict[initial_key(name)] = fraction * s0_f * n / total
+            res_dict['quarantined_initial'] = self.q0 * n / total
+            res_dict['recovered_initial'] = self.r0 * n / total
+            res_dict['deceased_initial'] = self.d0 * n / total
+            res_dict['groups'] = [{'name': name, 'fraction': float(fraction), 'quarantine_contact': bool(contact)}
+                                  for name, fraction, contact in zip(self.structure['group_names'],
+                                                                     self.group_fractions,
+                                                                     self.structure['quarantine_contact'])]
+            res_dict['quarantine_start'] = self.structure['quarantine_start']
+            res_dict['phase_durations'] = self.structure['phase_durations']
+            return res_dict
+        res_dict['suspected_medical_initial'] = self.frac_medical * s0_f * n / total
+        res_dict['suspected_essential_initial'] = self.frac_essential * s0_f * n / total
+        res_dict['suspected_others_initial'] = self.frac_others * s0_f * n / total
+        res_dict['quarantined_initial'] = self.q0 * n / total
+        res_dict['recovered_initial'] = self.r0 * n / total
+        res_dict['deceased_initial'] = self.d0 * n / total
+        res_dict['quarantine_start'] = self.quarantine_start
+        res_dict['quarantine_1_duration'] = self.quarantine_1_duration
+        res_dict['quarantine_2_duration'] = self.quarantine_2_duration
+
+        return res_dict
+
+    # Box around the initial guess for global searches, as (lower, upper, log_scale) arrays within the bounds. The data
+    # only pins e0 and i0 down to orders of magnitude, so they span a factor initial_spread either way, and the rates
+    # a factor rate_spread, both on a log scale. Parameters guessed as zero span their whole bounds.
+    def search_box(self, rate_spread: float = 3,
+                   initial_spread: float = 100) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        guess = np.array(self.initial, dtype=np.float64)
+        lower, upper = np.array(self.bounds, dtype=np.float64).T
+        spread = np.full(guess.size, float(rate_spread))
+        spread[:2] = initial_spread
+        log_scale = guess > 0
+        box_lower = np.where(log_scale, np.maximum(guess / spread, lower), lower)
+        box_upper = np.where(log_scale, np.minimum(guess * spread, upper), upper)
+        # A log scale needs a positive lower end, even where the bound is zero.
+        box_lower = np.where(log_scale & (box_lower <= 0), guess / spread, box_lower)
+        return box_lower, box_upper, log_scale
+
+    # Starting points for a multi-start fit: the guess from the data followed by n_starts - 1 quasi random points of
+    # search_box. Starts spread over the whole bounds end in far worse local minima than the guess.
+    def sample_initial(self, n_starts: int, sampling: str = 'sobol', seed: Optional[int] = None) -> np.ndarray:
+        initial = np.array([self.initial])
+        if n_starts <= 1:
+            return initial
+        lower, upper, log_scale = self.search_box()
+        return np.concatenate([initial, sample_box(lower, upper, n_starts - 1, sampling=sampling, seed=seed,
+                                                   log_scale=log_scale)])
+
+
+# Fit the model to the data in data_path. With a cache, a fit with the same data and settings is read back instead of
+# being recomputed. With a timeout, in seconds, the fit raises FitTimeout once it runs longer. preset names integrator
+# settings of ode_solving.PRESETS and jit selects the compiled right hand side.
 def get_optimal_parameters(data_path: str, method: str = '', verbose: bool = True,
-                           total: int = 10000) -> Dict[str, Union[float, int]]:
-    # Get gt data.
+                           total: int = 10000, piecewise: bool = False,
+                           time_weighting: str = 'constant', gradient: bool = False, tol: Optional[float] = None,
+                           cache: Optional[FitCache] = None,
+                           timeout: Optional[float] = None, preset: Optional[str] = None,
+                           jit: bool = False) -> Dict[str, Union[float, int]]:
+    problem = FitProblem.from_path(data_path, total=total, piecewise=piecewise, time_weighting=time_weighting,
+                                   jit=jit, **PRESETS.get(preset, {}))
+    if timeout is not None:
+        problem.deadline = time.monotonic() + timeout
+
+    res = None
+    if cache is not None:
+        cache_key = _fit_cache_key(cache, data_path, problem, initial=problem.initial,
+                                   method=method or 'trust-constr', tol=tol, gradient=gradient)
+        cached = cache.load(cache_key)
+        if cached is not None:
+            res = np.array(cached['x'])
+            if verbose:
+                print(f'\nLoaded fit from cache ({cache_key[:12]}).')
+    if res is None:
+        res = problem.minimize(method=method, gradient=gradient, tol=tol, disp=verbose).x
+        if cache is not None:
+            cache.store(cache_key, {'data_path': data_path, 'x': res, 'parameters': problem.result_dict(res)})
+
+    if verbose:
+        print('\nThe predicted optimal initial values are:')
+        for key, val in problem.parameters_dict(res).items():
+            print(f'\t{key}:\t{val}')
+
+    return problem.result_dict(res)
+
+
+# Cache key of a fit of problem to the data in data_path. Every setting of the problem that changes the fit, the whole
+# solver configuration included, goes in the key together with the fit_settings of the optimizer, so the fit commands
+# cannot key the same fit differently.
+def _fit_cache_key(cache: FitCache, data_path: str, problem: FitProblem, **fit_settings) -> str:
+    return cache.key(data_path, bounds=problem.bounds, total=problem.total, piecewise=problem.piecewise,
+                     time_weighting=problem.time_weighting, rtol=problem.rtol, atol=problem.atol,
+                     integrator=problem.integrator, jit=problem.jit, **fit_settings)
+
+
+def _fit_from_start(problem: FitProblem, start: int, initial: np.ndarray, method: str, gradient: bool):
+    res = problem.minimize(initial, method=method, gradient=gradient, disp=False)
+    return start, res
+
+
+# Fit from n_starts starting points (the data guess plus Sobol or Latin hypercube samples, see sample_initial) spread
+# over workers processes. Returns the best result dict and a table of every start ranked by final loss. With a cache,
+# the best vector and the table of a multi-start fit with the same data and settings are read back.
+def get_multi_start_parameters(data_path: str, n_starts: int = 8, workers: int = 1, sampling: str = 'sobol',
+                               seed: Optional[int] = 0, method: str = '', verbose: bool = True,
+                               total: int = 10000, piecewise: bool = False, time_weighting: str = 'constant',
+                               gradient: bool = False, cache: Optional[FitCache] = None,
+                               preset: Optional[str] = None,
+                               jit: bool = False) -> Tuple[Dict[str, Union[float, int]], List[Dict]]:
+    problem = FitProblem.from_path(data_path, total=total, piecewise=piecewise, time_weighting=time_weighting,
+                                   jit=jit, **PRESETS.get(preset, {}))
+    initials = problem.sample_initial(n_starts, sampling=sampling, seed=seed)
+
+    if cache is not None:
+        cache_key = _fit_cache_key(cache, data_path, problem, initials=initials, method=method or 'trust-constr',
+                                   gradient=gradient)
+        cached = cache.load(cache_key)
+        if cached is not None:
+            if verbose:
+                print(f'\nLoaded multi-start fit from cache ({cache_key[:12]}).')
+            return _report_multi_start(problem, np.array(cached['x']), cached['table'], verbose)
+
+    results = []
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(_fit_from_start, problem, start, initial, method, gradient)
+                       for start, initial in enumerate(initials)]
+            for future in as_completed(futures):
+                results.append(future.result())
+    else:
+        for start, initial in enumerate(initials):
+            results.append(_fit_from_start(problem, start, initial, method, gradient))
+
+    results.sort(key=lambda start_res: start_res[1].fun)
+    table = [
+        {
+            'rank': rank,
+            'start': start,
+            'loss': float(res.fun),
+            'success': bool(res.success),
+            'iterations': int(res.get('nit', 0)),
+            'evaluations': int(res.get('nfev', 0)),
+            'initial': initials[start].tolist(),
+            'parameters': problem.parameters_dict(res.x),
+        }
+        for rank, (start, res) in enumerate(results)
+    ]
+
+    best = results[0][1].x
+    if cache is not None:
+        cache.store(cache_key, {'data_path': data_path, 'x': best, 'parameters': problem.result_dict(best),
+                                'table': table})
+    return _report_multi_start(problem, best, table, verbose)
+
+
+def _report_multi_start(problem: FitProblem, best: np.ndarray, table: List[Dict],
+                        verbose: bool) -> Tuple[Dict[str, Union[float, int]], List[Dict]]:
+    if verbose:
+        print('\nrank\tstart\tloss\titerations\tsuccess')
+        for row in table:
+            print(f'{row["rank"]}\t{row["start"]}\t{row["loss"]:.4f}\t{row["iterations"]}\t{row["success"]}')
+        print('\nThe predicted optimal initial values are:')
+        for key, val in problem.parameters_dict(best).items():
+            print(f'\t{key}:\t{val}')
+    return problem.result_dict(best), table
+
+
+# Objective of a FitProblem over a search space whose dimensions flagged in log_scale hold the logarithm of the fitted
+# parameter. It is a class rather than a closure so differential evolution can send it to worker processes.
+class LogScaledObjective:
+    def __init__(self, problem: FitProblem, log_scale: np.ndarray):
+        self.problem = problem
+        self.log_scale = np.asarray(log_scale, dtype=bool)
+
+    def to_search(self, x: np.ndarray) -> np.ndarray:
+        z = np.array(x, dtype=np.float64)
+        z[self.log_scale] = np.log(z[self.log_scale])
+        return z
+
+    def to_vector(self, z: np.ndarray) -> np.ndarray:
+        x = np.array(z, dtype=np.float64)
+        x[self.log_scale] = np.exp(x[self.log_scale])
+        return x
+
+    def __call__(self, z: np.ndarray) -> float:
+        return self.problem.objective_function(self.to_vector(z))
+
+
+# Two stage fit. A global differential evolution search runs on a cheap version of the problem, then a local optimizer
+# refines its best vector on the full problem at refine_rtol and refine_atol. The cheap problem has loose integrator
+# tolerances, optionally only the first coarse_days of data, and is integrated phase by phase, so the solver steps
+# over the daily output grid instead of stopping on every day. The search covers FitProblem.search_box with the
+# positive parameters, e0 and i0 above all, on a log scale. Returns the result dict and the time, loss on the full
+# problem and number of evaluations of each stage.
+def get_staged_parameters(data_path: str, coarse_rtol: float = 1e-3, coarse_atol: float = 1e-6,
+                          coarse_days: Optional[int] = None, coarse_maxiter: int = 20, coarse_popsize: int = 8,
+                          seed: Optional[int] = None, workers: int = 1, method: str = '', gradient: bool = False,
+                          tol: Optional[float] = None, refine_rtol: float = 1e-6, refine_atol: float = 1e-12,
+                          verbose: bool = True, total: int = 10000, piecewise: bool = False,
+                          time_weighting: str = 'constant') -> Tuple[Dict[str, Union[float, int]], List[Dict]]:
     with open(data_path) as data_file:
         gt_data = json.load(data_file)
+    problem = FitProblem(gt_data, total=total, piecewise=piecewise, time_weighting=time_weighting,
+                         rtol=refine_rtol, atol=refine_atol)
+    coarse_data = dict(gt_data)
+    if coarse_days is not None:
+        coarse_data['epidemic_evolution'] = gt_data['epidemic_evolution'][:coarse_days]
+    coarse = FitProblem(coarse_data, total=total, piecewise=True, time_weighting=time_weighting,
+                        rtol=coarse_rtol, atol=coarse_atol)
+    lower, upper, log_scale = coarse.search_box()
+    objective = LogScaledObjective(coarse, log_scale)
 
-    n = gt_data['total_individuals']
-    epidemic_evolution = gt_data['epidemic_evolution']
-    simulation_duration = len(epidemic_evolution)
-    assert simulation_duration > 0
-    q0 = epidemic_evolution[0].get('quarantined', 0) * total / n
-    r0 = epidemic_evolution[0].get('recovered', 0) * total / n
-    d0 = epidemic_evolution[0].get('deceased', 0) * total / n
-
-    quarantine_start = gt_data.get('quarantine_start', 2 * simulation_duration + 1)
-    quarantine_1_duration = gt_data.get('quarantine_1_duration', 2 * simulation_duration + 1)
-    quarantine_2_duration = gt_data.get('quarantine_2_duration', 2 * simulation_duration + 1)
-
-    frac_medical = gt_data.get('fraction_medical', 0)
-    frac_essential = gt_data.get('fraction_essential', 0)
-    frac_others = 1 - frac_medical - frac_essential
-    e0_guess = gt_data.get('initial_exposed_guess', 1) * total / n
-    i0_guess = gt_data.get('initial_infected_guess', 1) * total / n
-
-    epsilon = 0
-    default_gamma = 1.96
-    default_gamma_reduction_1 = 1
-    default_gamma_reduction_2 = 1
-    gamma_guess = gt_data.get('gamma_guess', default_gamma)
-    m_gamma_1_guess = gt_data.get('m_gamma_1_guess', gamma_guess / default_gamma_reduction_1)
-    m_gamma_reduction_1_guess = max(gamma_guess / m_gamma_1_guess, 1 + epsilon)
-    e_gamma_1_guess = gt_data.get('e_gamma_1_guess', gamma_guess / default_gamma_reduction_1)
-    e_gamma_reduction_1_guess = max(gamma_guess / e_gamma_1_guess, 1 + epsilon)
-    o_gamma_1_guess = gt_data.get('o_gamma_1_guess', gamma_guess / default_gamma_reduction_1)
-    o_gamma_reduction_1_guess = max(gamma_guess / o_gamma_1_guess, 1 + epsilon)
-    m_gamma_2_guess = gt_data.get('m_gamma_2_guess', m_gamma_1_guess / default_gamma_reduction_2)
-    m_gamma_reduction_2_guess = max(m_gamma_1_guess / m_gamma_2_guess, 1 + epsilon)
-    e_gamma_2_guess = gt_data.get('e_gamma_2_guess', e_gamma_1_guess / default_gamma_reduction_2)
-    e_gamma_reduction_2_guess = max(e_gamma_1_guess / e_gamma_2_guess, 1 + epsilon)
-    o_gamma_2_guess = gt_data.get('o_gamma_2_guess', o_gamma_1_guess / default_gamma_reduction_2)
-    o_gamma_reduction_2_guess = max(o_gamma_1_guess / o_gamma_2_guess, 1 + epsilon)
-    alpha_guess = gt_data.get('alpha_guess', 0.2)
-    delta_guess = max(gt_data.get('delta_guess', 0), epsilon)
-    sigma_guess = gt_data.get('sigma_guess', 0.196)
-    r_i_guess = gt_data.get('r_i_guess', 0.222)
-    r_q_guess = gt_data.get('r_q_guess', 0.222)
-    d_i_guess = gt_data.get('d_i_guess', 0.053)
-    d_q_guess = gt_data.get('d_q_guess', 0.053)
-
-    def objective_function(pars: List[float]):
-        e0, i0, g, mg_red_1, eg_red_1, og_red_1, mg_red_2, eg_red_2, og_red_2, al, de, s, ri, rq, di, dq = pars
-        s0 = total - i0 - e0 - q0 - r0 - d0
-        sm0 = frac_medical * s0
-        se0 = frac_essential * s0
-        so0 = frac_others * s0
-        predict_list = solve_ode(sm0=sm0, se0=se0, so0=so0, e0=e0, i0=i0, q0=q0, r0=r0, d0=d0,
-                                 quarantine_start=quarantine_start,
-                                 quarantine_1_duration=quarantine_1_duration,
-                                 quarantine_2_duration=quarantine_2_duration,
-                                 simulation_duration=simulation_duration,
-                                 gamma=g,
-                                 m_gamma_reduction_1=mg_red_1, e_gamma_reduction_1=eg_red_1,
-                                 o_gamma_reduction_1=og_red_1,
-                                 m_gamma_reduction_2=mg_red_2, e_gamma_reduction_2=eg_red_2,
-                                 o_gamma_reduction_2=og_red_2,
-                                 alpha=al, delta=de, sigma=s,
-                                 r_i=ri, r_q=rq,
-                                 d_i=di, d_q=dq)
-        return loss_function(predict_list=predict_list, gt_list=epidemic_evolution, fictional_total=total, total=n)
-
-    initial = [e0_guess, i0_guess,
-               gamma_guess,
-               m_gamma_reduction_1_guess, e_gamma_reduction_1_guess, o_gamma_reduction_1_guess,
-               m_gamma_reduction_2_guess, e_gamma_reduction_2_guess, o_gamma_reduction_2_guess,
-               alpha_guess, delta_guess, sigma_guess,
-               r_i_guess, r_q_guess,
-               d_i_guess, d_q_guess]
-    bounds = [(0, total), (0, total),
-              (0, 10),
-              (1, 100), (1, 100), (1, 100),
-              (1, 100), (1, 100), (1, 100),
-              (0, 1), (0, 1), (0, 1),
-              (0, 1), (0, 1),
-              (0, 1), (0, 1)]
-
-    # method = 'nelder-mead'  # not bad.  decrease fast.
-    # method = 'powell'
-    # method = 'cg'
-    # method = 'bfgs'
-    # method = 'l-bfgs-b'  # not bad. very linear.  # try reduction of 1.
-    # method = 'tnc'  # try incentivating end.
-    # method = 'cobyla'
-    # method = 'slsqp'
-    method = 'trust-constr'  # like.
-    # method = None
-    res = minimize(objective_function, np.array(initial), bounds=bounds, method=method,
-                   tol=None, options={'disp': True})
-
-    res = res.x
-    e0_f, i0_f = res[:2]
-    gamma_f = res[2]
-    m_gamma_reduction_1_f, e_gamma_reduction_1_f, o_gamma_reduction_1_f = res[3:6]
-    m_gamma_reduction_2_f, e_gamma_reduction_2_f, o_gamma_reduction_2_f = res[6:9]
-    alpha_f, delta_f, sigma_f = res[9:12]
-    r_i_f, r_q_f = res[12:14]
-    d_i_f, d_q_f = res[14:16]
-
-    res_dict = {
-        'exposed_initial': e0_f * n / total,
-        'infected_initial': i0_f * n / total,
-        'gamma': gamma_f,
-        'gamma_m_1': gamma_f / m_gamma_reduction_1_f,
-        'gamma_e_1': gamma_f / e_gamma_reduction_1_f,
-        'gamma_o_1': gamma_f / o_gamma_reduction_1_f,
-        'gamma_m_2': gamma_f / m_gamma_reduction_1_f / m_gamma_reduction_2_f,
-        'gamma_e_2': gamma_f / e_gamma_reduction_1_f / e_gamma_reduction_2_f,
-        'gamma_o_2': gamma_f / o_gamma_reduction_1_f / o_gamma_reduction_2_f,
-        'alpha': alpha_f,
-        'delta': delta_f,
-        'sigma': sigma_f,
-        'r_i': r_i_f,
-        'r_q': r_q_f,
-        'd_i': d_i_f,
-        'd_q': d_q_f,
-    }
+    stages = []
+    start = time.perf_counter()
+    coarse_res = differential_evolution(objective, list(zip(objective.to_search(lower), objective.to_search(upper))),
+                                        x0=objective.to_search(coarse.initial), maxiter=coarse_maxiter,
+                                        popsize=coarse_popsize, seed=seed, polish=False, workers=workers,
+                                        updating='deferred' if workers > 1 else 'immediate')
+    coarse_x = objective.to_vector(coarse_res.x)
+    stages.append({'stage': 'coarse', 'seconds': time.perf_counter() - start,
+                   'loss': float(problem.objective_function(coarse_x)), 'evaluations': int(coarse_res.nfev)})
+    if np.allclose(coarse_x, coarse.initial):
+        warnings.warn('The coarse stage found nothing better than the initial guess. More generations or a larger '
+                      'population may help.', RuntimeWarning, stacklevel=2)
+
+    start = time.perf_counter()
+    res = problem.minimize(coarse_x, method=method, gradient=gradient, tol=tol, disp=False)
+    stages.append({'stage': 'refine', 'seconds': time.perf_counter() - start, 'loss': float(res.fun),
+                   'evaluations': int(res.get('nfev', 0))})
 
     if verbose:
+        print('\nstage\tseconds\tloss\tevaluations')
+        for stage in stages:
+            print(f'{stage["stage"]}\t{stage["seconds"]:.1f}\t{stage["loss"]:.4f}\t{stage["evaluations"]}')
         print('\nThe predicted optimal initial values are:')
-        for key, val in res_dict.items():
+        for key, val in problem.parameters_dict(res.x).items():
             print(f'\t{key}:\t{val}')
 
-    s0_f = total - i0_f - e0_f - q0 - r0 - d0
-    res_dict['suspected_medical_initial'] = frac_medical * s0_f * n / total
-    res_dict['suspected_essential_initial'] = frac_essential * s0_f * n / total
-    res_dict['suspected_others_initial'] = frac_others * s0_f * n / total
-    res_dict['quarantined_initial'] = q0 * n / total
-    res_dict['recovered_initial'] = r0 * n / total
-    res_dict['deceased_initial'] = d0 * n / total
-    res_dict['quarantine_start'] = quarantine_start
-    res_dict['quarantine_1_duration'] = quarantine_1_duration
-    res_dict['quarantine_2_duration'] = quarantine_2_duration
+    return problem.result_dict(res.x), stages
+
+
+# Weighted L1 loss between predicted and ground truth quarantined and deceased individuals. The ground truth is indexed
+# and rescaled to fictional_total once, so every call is a handful of array operations on the predicted trajectory.
+# Days whose ground truth lacks a key do not count for that key.
+class LossFunction:
+    time_weightings = ('constant', 'linear', 'quadratic')
+
+    def __init__(self, gt_list: List[Dict[str, float]], fictional_total: int, total: int,
+                 weight: float = 1, deceased_relative_weight: float = 10, offset: int = 0,
+                 time_weighting: str = 'constant'):
+        assert time_weighting in self.time_weightings
+        gt = Trajectory.from_dicts(gt_list[offset:])
+        self.offset = offset
+        self.time_weighting = time_weighting
+        self.gt_len = len(gt)
+        self.gt_quarantined, self.quarantined_mask = self._prepare(gt['quarantined'] * fictional_total / total)
+        self.gt_deceased, self.deceased_mask = self._prepare(gt['deceased'] * fictional_total / total)
+        self.quarantined_weight = weight
+        self.deceased_weight = weight * deceased_relative_weight
+        self._weights = self._compute_weights(self.gt_len)
+
+    @staticmethod
+    def _prepare(column: np.ndarray):
+        mask = ~np.isnan(column)
+        return np.where(mask, column, 0), mask.astype(np.float64)
+
+    def _step_weights(self, n: int) -> np.ndarray:
+        if self.time_weighting == 'linear':
+            return np.arange(1, n + 1) / n
+        if self.time_weighting == 'quadratic':
+            return (np.arange(1, n + 1) / n) ** 2
+        return np.ones(n)
+
+    # Per-day weights of each key for the first n days, already divided by the number of days the key is present.
+    def _compute_weights(self, n: int):
+        step_weights = self._step_weights(n)
+        quarantined_mask = self.quarantined_mask[:n]
+        deceased_mask = self.deceased_mask[:n]
+        quarantined_weights = quarantined_mask * step_weights * self.quarantined_weight / max(quarantined_mask.sum(), 1)
+        deceased_weights = deceased_mask * step_weights * self.deceased_weight / max(deceased_mask.sum(), 1)
+        return quarantined_weights, deceased_weights
+
+    @instrumentation.timed('loss')
+    def __call__(self, predict_list: Trajectory) -> float:
+        n = min(len(predict_list) - self.offset, self.gt_len)
+        if n <= 0:
+            return 0.
+        quarantined_weights, deceased_weights = self._weights if n == self.gt_len else self._compute_weights(n)
+        predicted = predict_list.values[self.offset:self.offset + n]
+        quarantined_loss = np.abs(self.gt_quarantined[:n] - predicted[:, COMPARTMENT_INDEX['quarantined']])
+        deceased_loss = np.abs(self.gt_deceased[:n] - predicted[:, COMPARTMENT_INDEX['deceased']])
+        return float(quarantined_loss @ quarantined_weights + deceased_loss @ deceased_weights)
 
-    return res_dict
+    # Loss together with its gradient, given the (days, compartments, parameters) sensitivities of predict_list.
+    @instrumentation.timed('loss')
+    def value_and_gradient(self, predict_list: Trajectory, sensitivities: np.ndarray):
+        n = min(len(predict_list) - self.offset, self.gt_len)
+        if n <= 0:
+            return 0., np.zeros(sensitivities.shape[2])
+        quarantined_weights, deceased_weights = self._weights if n == self.gt_len else self._compute_weights(n)
+        predicted = predict_list.values[self.offset:self.offset + n]
+        sensitivities = sensitivities[self.offset:self.offset + n]
+        quarantined_error = predicted[:, COMPARTMENT_INDEX['quarantined']] - self.gt_quarantined[:n]
+        deceased_error = predicted[:, COMPARTMENT_INDEX['deceased']] - self.gt_deceased[:n]
+        value = np.abs(quarantined_error) @ quarantined_weights + np.abs(deceased_error) @ deceased_weights
+        quarantined_sensitivities = sensitivities[:, COMPARTMENT_INDEX['quarantined']]
+        deceased_sensitivities = sensitivities[:, COMPARTMENT_INDEX['deceased']]
+        gradient = ((np.sign(quarantined_error) * quarantined_weights) @ quarantined_sensitivities
+                    + (np.sign(deceased_error) * deceased_weights) @ deceased_sensitivities)
+        return float(value), gradient
 
 
-def loss_function(predict_list: List[Dict[str, float]], gt_list: List[Dict[str, float]],
+def loss_function(predict_list: Trajectory, gt_list: List[Dict[str, float]],
                   fictional_total: int, total: int,
-                  weight: float = 1, deceased_relative_weight: float = 10, offset: int = 0) -> float:
-    predict_list = predict_list[offset:]
-    gt_list = gt_list[offset:]
-
-    quarantined_loss = 0
-    deceased_loss = 0
-    quarantined_weight = weight
-    n_quarantined = 0
-    n_deceased = 0
-    deceased_weight = weight * deceased_relative_weight
-    n = min(len(predict_list), len(gt_list))
-    for i, (predicted_data, gt_data) in enumerate(zip(predict_list, gt_list)):
-        # step_weight = ((i + 1) / n) ** 2
-        # step_weight = (i + 1) / n
-        step_weight = 1
-        for key, gt_val in gt_data.items():
-            gt_val = gt_val * fictional_total / total
-            if 'quarantined' in key:
-                quarantined_loss += abs(gt_val - predicted_data[key]) * quarantined_weight * step_weight
-                n_quarantined += 1
-            elif 'deceased' in key:
-                deceased_loss += abs(gt_val - predicted_data[key]) * deceased_weight * step_weight
-                n_deceased += 1
-    if n_quarantined > 0:
-        quarantined_loss /= n_quarantined
-    if n_deceased > 0:
-        deceased_loss /= n_deceased
-    # print(f'\nq_loss:\t{quarantined_loss:.3f}\nd_loss:\t{deceased_loss:.3f}')
-    return quarantined_loss + deceased_loss
+                  weight: float = 1, deceased_relative_weight: float = 10, offset: int = 0,
+                  time_weighting: str = 'constant') -> float:
+    return LossFunction(gt_list=gt_list, fictional_total=fictional_total, total=total, weight=weight,
+                        deceased_relative_weight=deceased_relative_weight, offset=offset,
+                        time_weighting=time_weighting)(predict_list)
 
 
 if __name__ == '__main__':
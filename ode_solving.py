@@ -1,21 +1,72 @@
 import json
-from typing import Dict, List, Optional
+import warnings
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
 
-from scipy.integrate import ode
+import numpy as np
+from scipy.integrate import ode, solve_ivp
 import click
 
-from visualization import show_results
+import instrumentation
+from trajectory import BranchedTrajectory, Trajectory
+
+
+# Indices in the (sm, se, so, e, i, q, r, d) state of every compartment in COMPARTMENTS.
+STATE_INDICES = {
+    'susceptible_medical': (0,),
+    'susceptible_essential_services': (1,),
+    'susceptible_others': (2,),
+    'susceptible': (0, 1, 2),
+    'exposed': (3,),
+    'infected': (4,),
+    'quarantined': (5,),
+    'recovered': (6,),
+    'deceased': (7,),
+}
+
+
+# Stops solve_ode on the first whole day, from start_day on, when the sum of the given compartments (names from
+# COMPARTMENTS) falls below or rises above threshold individuals.
+class TerminationEvent:
+    def __init__(self, name: str, compartments: Sequence[str], threshold: float, direction: str = 'below',
+                 start_day: float = 0):
+        assert direction in ('below', 'above')
+        if isinstance(compartments, str):
+            compartments = (compartments,)
+        self.name = name
+        self.compartments = tuple(compartments)
+        self.threshold = threshold
+        self.direction = direction
+        self.start_day = start_day
+        self.state_indices = sorted(index for compartment in self.compartments
+                                    for index in STATE_INDICES[compartment])
+
+    # Signed distance to the threshold, positive while the event has not happened, for normalized states y.
+    def distance(self, y, n: float) -> float:
+        value = sum(y[index] for index in self.state_indices) * n
+        if self.direction == 'below':
+            return value - self.threshold
+        return self.threshold - value
+
+    def triggered(self, day: float, y, n: float) -> bool:
+        return day >= self.start_day and self.distance(y, n) < 0
+
+    # Terminal solve_ivp event for the same condition.
+    def ivp_event(self, n: float) -> Callable:
+        def event(t, y, *args):
+            return self.distance(y, n)
+        event.terminal = True
+        event.direction = -1
+        return event
+
+
+def extinction_event(threshold: float = 1, start_day: float = 0) -> TerminationEvent:
+    return TerminationEvent('extinction', ('exposed', 'infected'), threshold, 'below', start_day)
 
 
 # Define the ordinary differential equation we must solve in order to compute epidemic evolution.
 def diff_equations(t, y, par):
     g, mg_1, eg_1, og_1, mg_2, eg_2, og_2, al, de, s, ri, rq, di, dq, start, dur_1, dur_2 = par
-    sm, se, so, e, i, q, r, d = y
-    n = sm + se + so + e + i + q + r + d
 
-    alpha = al
-    delta = d
-    sigma = s
     if start <= t < start + dur_1:
         gamma_m = g / mg_1
         gamma_e = g / eg_1
@@ -29,6 +80,19 @@ def diff_equations(t, y, par):
         gamma_e = g
         gamma_o = g
 
+    return phase_equations(t, y, (gamma_m, gamma_e, gamma_o, al, de, s, ri, rq, di, dq))
+
+
+# Right hand side of the ODE inside a single quarantine phase, where the contact rates are constant.
+def phase_equations(t, y, par):
+    gamma_m, gamma_e, gamma_o, al, de, s, ri, rq, di, dq = par
+    sm, se, so, e, i, q, r, d = y
+    n = sm + se + so + e + i + q + r + d
+
+    alpha = al
+    delta = d
+    sigma = s
+
     sm_dt = -sm * (gamma_m * i + delta * q) / n
     se_dt = -se * (gamma_e * i) / n
     so_dt = -so * (gamma_o * i) / n
@@ -41,6 +105,221 @@ def diff_equations(t, y, par):
     return [sm_dt, se_dt, so_dt, e_dt, i_dt, q_dt, r_dt, d_dt]
 
 
+# Jacobian of phase_equations with respect to the state, for the implicit integrators.
+def phase_jacobian(t, y, par):
+    gamma_m, gamma_e, gamma_o, al, de, s, ri, rq, di, dq = par
+    sm, se, so, e, i, q, r, d = y
+    n = sm + se + so + e + i + q + r + d
+
+    alpha = al
+    delta = d
+    sigma = s
+
+    contact_m = gamma_m * i + delta * q
+    contact_e = gamma_e * i
+    contact_o = gamma_o * i
+    jacobian = np.zeros((8, 8))
+    # Every state enters n, so every column of the susceptible rows gets the derivative of 1 / n.
+    jacobian[0] = sm * contact_m / n ** 2
+    jacobian[0, 0] -= contact_m / n
+    jacobian[0, 4] -= sm * gamma_m / n
+    jacobian[0, 5] -= sm * delta / n
+    jacobian[0, 7] -= sm * q / n
+    jacobian[1] = se * contact_e / n ** 2
+    jacobian[1, 1] -= contact_e / n
+    jacobian[1, 4] -= se * gamma_e / n
+    jacobian[2] = so * contact_o / n ** 2
+    jacobian[2, 2] -= contact_o / n
+    jacobian[2, 4] -= so * gamma_o / n
+    jacobian[3] = -jacobian[:3].sum(axis=0)
+    jacobian[3, 3] -= sigma
+    jacobian[4, 3] = sigma
+    jacobian[4, 4] = -(alpha + ri + di)
+    jacobian[5, 4] = alpha
+    jacobian[5, 5] = -(rq + dq)
+    jacobian[6, 4] = ri
+    jacobian[6, 5] = rq
+    jacobian[7, 4] = di
+    jacobian[7, 5] = dq
+    return jacobian
+
+
+# Jacobian of diff_equations with respect to the state.
+def diff_jacobian(t, y, par):
+    g, mg_1, eg_1, og_1, mg_2, eg_2, og_2, al, de, s, ri, rq, di, dq, start, dur_1, dur_2 = par
+    phase = quarantine_phase(t, start, dur_1, dur_2)
+    if phase == 1:
+        gammas = (g / mg_1, g / eg_1, g / og_1)
+    elif phase == 2:
+        gammas = (g / mg_1 / mg_2, g / eg_1 / eg_2, g / og_1 / og_2)
+    else:
+        gammas = (g, g, g)
+    return phase_jacobian(t, y, gammas + (al, de, s, ri, rq, di, dq))
+
+
+# Integrators of solve_ode: the dopri5 and lsoda codes of scipy.integrate.ode, the implicit BDF and Radau methods of
+# solve_ivp with the analytic Jacobian (for stiff parameter sets), and a fixed-step classic Runge-Kutta for quick scans.
+INTEGRATORS = ('dopri5', 'lsoda', 'bdf', 'radau', 'rk4')
+# solve_ivp method of each adaptive integrator, used when integrating phase by phase.
+IVP_METHODS = {'dopri5': 'RK45', 'lsoda': 'LSODA', 'bdf': 'BDF', 'radau': 'Radau'}
+RK4_STEPS_PER_DAY = 4
+# Named integrator settings, used as solve_ode(..., **PRESETS[name]).
+PRESETS = {
+    'fast': dict(integrator='rk4'),
+    'balanced': dict(integrator='dopri5', rtol=1e-6, atol=1e-12),
+    'accurate': dict(integrator='radau', rtol=1e-10, atol=1e-14),
+}
+FAILURE_MODES = ('raise', 'warn', 'ignore')
+
+
+class IntegrationError(RuntimeError):
+    pass
+
+
+# Called when the integrator stops before simulation_duration, day being the last day whose state was reached. The
+# trajectory then ends on that day, unless on_failure is 'raise'.
+def integration_failed(day: float, simulation_duration: float, on_failure: str = 'warn'):
+    instrumentation.count('integrator_failures')
+    message = f'Integration failed after day {day:g} of {simulation_duration:g}'
+    if on_failure == 'raise':
+        raise IntegrationError(f'{message}.')
+    if on_failure == 'warn':
+        warnings.warn(f'{message}, the trajectory is shorter.', RuntimeWarning)
+
+
+# Integrate from t to t_end with the classic fourth order Runge-Kutta method and steps_per_day steps per day.
+def rk4_integrate(rhs, t: float, y, t_end: float, args: tuple = (),
+                  steps_per_day: int = RK4_STEPS_PER_DAY) -> np.ndarray:
+    steps = max(1, int(np.ceil((t_end - t) * steps_per_day - 1e-9)))
+    h = (t_end - t) / steps
+    y = np.asarray(y, dtype=np.float64)
+    for step in range(steps):
+        k1 = np.asarray(rhs(t, y, *args))
+        k2 = np.asarray(rhs(t + h / 2, y + h / 2 * k1, *args))
+        k3 = np.asarray(rhs(t + h / 2, y + h / 2 * k2, *args))
+        k4 = np.asarray(rhs(t + h, y + h * k3, *args))
+        y = y + h / 6 * (k1 + 2 * k2 + 2 * k3 + k4)
+        t = t + h
+    return y
+
+
+# Split [0, simulation_duration] at the quarantine boundaries. Returns (phase_start, phase_end, phase, phase_parameters)
+# tuples where phase is 1 or 2 inside the quarantine phases and 0 otherwise, and phase_parameters are the
+# phase_equations parameters for that interval.
+def quarantine_phases(par, simulation_duration: float):
+    g, mg_1, eg_1, og_1, mg_2, eg_2, og_2, al, de, s, ri, rq, di, dq, start, dur_1, dur_2 = par
+    rates = (al, de, s, ri, rq, di, dq)
+    phases = [
+        (0, start, 0, (g, g, g) + rates),
+        (start, start + dur_1, 1, (g / mg_1, g / eg_1, g / og_1) + rates),
+        (start + dur_1, start + dur_1 + dur_2, 2, (g / mg_1 / mg_2, g / eg_1 / eg_2, g / og_1 / og_2) + rates),
+        (start + dur_1 + dur_2, simulation_duration, 0, (g, g, g) + rates),
+    ]
+    return [(max(phase_start, 0), min(phase_end, simulation_duration), phase, phase_par)
+            for phase_start, phase_end, phase, phase_par in phases
+            if max(phase_start, 0) < min(phase_end, simulation_duration)]
+
+
+def quarantine_phase(t: float, start: float, dur_1: float, dur_2: float) -> int:
+    if start <= t < start + dur_1:
+        return 1
+    if start + dur_1 <= t < start + dur_1 + dur_2:
+        return 2
+    return 0
+
+
+# Forward sensitivity equations of diff_equations. z holds the 8 normalized states followed by the flattened (8, 14 + k)
+# sensitivity matrix, whose columns are the derivatives with respect to the 14 rates of diff_equations (gamma to d_q)
+# and to k extra directions of the initial state. phase overrides the quarantine phase deduced from t, so the equations
+# can also be integrated one phase at a time.
+def sensitivity_equations(t, z, par, k: int, phase: Optional[int] = None):
+    g, mg_1, eg_1, og_1, mg_2, eg_2, og_2, al, de, s, ri, rq, di, dq, start, dur_1, dur_2 = par
+    sm, se, so, e, i, q, r, d = z[:8].tolist()
+    sensitivity = z[8:].reshape(8, 14 + k)
+    n = sm + se + so + e + i + q + r + d
+    if phase is None:
+        phase = quarantine_phase(t, start, dur_1, dur_2)
+
+    # Contact rates and their derivatives with respect to gamma and to the first and second reduction of their group.
+    if phase == 1:
+        gamma_m, gamma_e, gamma_o = g / mg_1, g / eg_1, g / og_1
+        gamma_derivatives = [(1 / mg_1, -gamma_m / mg_1, 0), (1 / eg_1, -gamma_e / eg_1, 0),
+                             (1 / og_1, -gamma_o / og_1, 0)]
+    elif phase == 2:
+        gamma_m, gamma_e, gamma_o = g / mg_1 / mg_2, g / eg_1 / eg_2, g / og_1 / og_2
+        gamma_derivatives = [(1 / mg_1 / mg_2, -gamma_m / mg_1, -gamma_m / mg_2),
+                             (1 / eg_1 / eg_2, -gamma_e / eg_1, -gamma_e / eg_2),
+                             (1 / og_1 / og_2, -gamma_o / og_1, -gamma_o / og_2)]
+    else:
+        gamma_m, gamma_e, gamma_o = g, g, g
+        gamma_derivatives = [(1, 0, 0), (1, 0, 0), (1, 0, 0)]
+
+    y_dt = phase_equations(t, (sm, se, so, e, i, q, r, d), (gamma_m, gamma_e, gamma_o, al, de, s, ri, rq, di, dq))
+
+    # Jacobian with respect to the state. As in phase_equations, the medical group is exposed to the quarantined through
+    # the deceased compartment d.
+    force_m, force_e, force_o = gamma_m * i + d * q, gamma_e * i, gamma_o * i
+    n_m, n_e, n_o = sm * force_m / n ** 2, se * force_e / n ** 2, so * force_o / n ** 2
+    sm_row = [n_m - force_m / n, n_m, n_m, n_m, n_m - sm * gamma_m / n, n_m - sm * d / n, n_m, n_m - sm * q / n]
+    se_row = [n_e, n_e - force_e / n, n_e, n_e, n_e - se * gamma_e / n, n_e, n_e, n_e]
+    so_row = [n_o, n_o, n_o - force_o / n, n_o, n_o - so * gamma_o / n, n_o, n_o, n_o]
+    e_row = [-(a + b + c) for a, b, c in zip(sm_row, se_row, so_row)]
+    e_row[3] -= s
+    state_jacobian = np.array([
+        sm_row, se_row, so_row, e_row,
+        [0, 0, 0, s, -(al + ri + di), 0, 0, 0],
+        [0, 0, 0, 0, al, -(rq + dq), 0, 0],
+        [0, 0, 0, 0, ri, rq, 0, 0],
+        [0, 0, 0, 0, di, dq, 0, 0],
+    ])
+
+    # Jacobian with respect to the rates, in the diff_equations parameter order. delta does not reach the equations.
+    (m_g, m_1, m_2), (e_g, e_1, e_2), (o_g, o_1, o_2) = gamma_derivatives
+    m_i, e_i, o_i = -sm * i / n, -se * i / n, -so * i / n
+    extra = [0] * k
+    rate_jacobian = np.array([
+        [m_i * m_g, m_i * m_1, 0, 0, m_i * m_2, 0, 0, 0, 0, 0, 0, 0, 0, 0] + extra,
+        [e_i * e_g, 0, e_i * e_1, 0, 0, e_i * e_2, 0, 0, 0, 0, 0, 0, 0, 0] + extra,
+        [o_i * o_g, 0, 0, o_i * o_1, 0, 0, o_i * o_2, 0, 0, 0, 0, 0, 0, 0] + extra,
+        [-(m_i * m_g + e_i * e_g + o_i * o_g), -m_i * m_1, -e_i * e_1, -o_i * o_1, -m_i * m_2, -e_i * e_2, -o_i * o_2,
+         0, 0, -e, 0, 0, 0, 0] + extra,
+        [0, 0, 0, 0, 0, 0, 0, -i, 0, e, -i, 0, -i, 0] + extra,
+        [0, 0, 0, 0, 0, 0, 0, i, 0, 0, 0, -q, 0, -q] + extra,
+        [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, i, q, 0, 0] + extra,
+        [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, i, q] + extra,
+    ])
+
+    return np.concatenate([y_dt, (state_jacobian @ sensitivity + rate_jacobian).ravel()])
+
+
+# Same equations as diff_equations evaluated for N scenarios at once. The state is the flattened (8, N) array and par is
+# an (N, 17) array whose columns follow the order of the diff_equations parameters.
+def diff_equations_batch(t, y, par):
+    g, mg_1, eg_1, og_1, mg_2, eg_2, og_2, al, de, s, ri, rq, di, dq, start, dur_1, dur_2 = par.T
+    sm, se, so, e, i, q, r, d = y.reshape(8, -1)
+    n = sm + se + so + e + i + q + r + d
+
+    alpha = al
+    delta = d
+    sigma = s
+    phase_1 = (start <= t) & (t < start + dur_1)
+    phase_2 = (start + dur_1 <= t) & (t < start + dur_1 + dur_2)
+    gamma_m = np.where(phase_1, g / mg_1, np.where(phase_2, g / mg_1 / mg_2, g))
+    gamma_e = np.where(phase_1, g / eg_1, np.where(phase_2, g / eg_1 / eg_2, g))
+    gamma_o = np.where(phase_1, g / og_1, np.where(phase_2, g / og_1 / og_2, g))
+
+    sm_dt = -sm * (gamma_m * i + delta * q) / n
+    se_dt = -se * (gamma_e * i) / n
+    so_dt = -so * (gamma_o * i) / n
+    e_dt = -(sm_dt + se_dt + so_dt) - sigma * e
+    i_dt = sigma * e - (alpha + ri + di) * i
+    q_dt = alpha * i - (rq + dq) * q
+    r_dt = ri * i + rq * q
+    d_dt = di * i + dq * q
+
+    return np.concatenate([sm_dt, se_dt, so_dt, e_dt, i_dt, q_dt, r_dt, d_dt])
+
+
 def run_model(sm0: int, se0: int, so0: int, e0: int = 1, i0: int = 0, q0: int = 0,
               r0: int = 0, d0: int = 0,
               quarantine_start: int = 25,
@@ -52,7 +331,9 @@ def run_model(sm0: int, se0: int, so0: int, e0: int = 1, i0: int = 0, q0: int =
               alpha: float = 0.5, delta: float = 0, sigma: float = 0.9,
               r_i: float = 0.9, r_q: float = 0.7,
               d_i: float = 0, d_q: float = 0.034,
-              gt_data: Optional[List[Dict[str, float]]] = None) -> List[Dict[str, float]]:
+              gt_data: Optional[List[Dict[str, float]]] = None,
+              output_path: Optional[str] = None,
+              bands: Optional[Dict] = None) -> Trajectory:
     gt_data = gt_data[:simulation_duration + 1]
     result_list = solve_ode(sm0=sm0, se0=se0, so0=so0, e0=e0, i0=i0, q0=q0, r0=r0, d0=d0,
                             quarantine_start=quarantine_start,
@@ -69,11 +350,19 @@ def run_model(sm0: int, se0: int, so0: int, e0: int = 1, i0: int = 0, q0: int =
                             r_i=r_i, r_q=r_q,
                             d_i=d_i, d_q=d_q)
 
-    show_results(result_list, gt_data=gt_data)
+    # matplotlib is only imported by runs that plot.
+    from visualization import show_results
+    show_results(result_list, gt_data=gt_data, output_path=output_path, bands=bands)
 
     return result_list
 
 
+# Original model through PartitionedModel, whose three groups and two phases it takes as separate arguments.
+# With t0, (sm0, ..., d0) is the state of day t0 and the trajectory covers days t0 to simulation_duration. integrator
+# is one of INTEGRATORS, with tolerances rtol and atol; PRESETS holds usual combinations. jit uses the compiled right
+# hand side of compiled_equations, or the ordinary one when numba is missing. on_failure tells what happens when the
+# integrator fails: 'raise' an IntegrationError, or 'warn' or 'ignore' and return the days reached.
+@instrumentation.timed('solve_ode')
 def solve_ode(sm0: int, se0: int, so0: int, e0: int, i0: int = 0, q0: int = 0, r0: int = 0, d0: int = 0,
               quarantine_start: int = 25,
               quarantine_1_duration: int = 14,
@@ -84,54 +373,304 @@ def solve_ode(sm0: int, se0: int, so0: int, e0: int, i0: int = 0, q0: int = 0, r
               m_gamma_reduction_2: float = 1, e_gamma_reduction_2: float = 1, o_gamma_reduction_2: float = 1,
               alpha: float = 0.5, delta: float = 0, sigma: float = 0.9,
               r_i: float = 0.9, r_q: float = 0.7,
-              d_i: float = 0, d_q: float = 0.034) -> List[Dict[str, float]]:
+              d_i: float = 0, d_q: float = 0.034,
+              piecewise: bool = False,
+              events: Sequence[TerminationEvent] = (), pad: bool = False, t0: int = 0,
+              rtol: float = 1e-6, atol: float = 1e-12, integrator: str = 'dopri5', jit: bool = False,
+              on_failure: str = 'warn') -> Trajectory:
+    assert integrator in INTEGRATORS and on_failure in FAILURE_MODES
     n = sm0 + se0 + so0 + e0 + i0 + q0 + r0 + d0
+    y0 = [sm0 / n, se0 / n, so0 / n, e0 / n, i0 / n, q0 / n, r0 / n, d0 / n]
+    par = [gamma,
+           m_gamma_reduction_1, e_gamma_reduction_1, o_gamma_reduction_1,
+           m_gamma_reduction_2, e_gamma_reduction_2, o_gamma_reduction_2,
+           alpha, delta, sigma,
+           r_i, r_q,
+           d_i, d_q,
+           quarantine_start, quarantine_1_duration, quarantine_2_duration]
+
+    triggered = []
+
+    def stop(day: float, y) -> bool:
+        for event in events:
+            if event.triggered(day, y, n):
+                triggered.append((int(day), event.name))
+                return True
+        return False
+
+    # partitioned_model builds on the integrators of this module, so it can only be imported once they exist.
+    from partitioned_model import PartitionedModel
+    states = PartitionedModel.from_par(par).integrate(
+        y0, simulation_duration, t0=t0, piecewise=piecewise, stop=stop if events else None,
+        events=[(event.start_day, event.ivp_event(n)) for event in events] if piecewise else (),
+        rtol=rtol, atol=atol, integrator=integrator, jit=jit, on_failure=on_failure)
+
+    if not triggered:
+        return Trajectory.from_states(states, n)
+
+    # Stopped by an event: the output ends on the event day or, with pad, repeats that day's state up to
+    # simulation_duration.
+    event_day, event_name = triggered[0]
+    if pad:
+        states = states + [states[-1]] * (simulation_duration - t0 + 1 - len(states))
+    return Trajectory.from_states(states, n, event_day=event_day, event=event_name)
+
+
+# Daily states from day t0 (the initial value) to simulation_duration. With stop, integration ends after the first day
+# for which stop(day, y) is true. integrator is one of INTEGRATORS and jac, with the signature of rhs, the Jacobian used
+# by lsoda, bdf and radau (lsoda approximates it when jac is None). on_failure is passed to integration_failed. rk4
+# takes fixed steps through any switch of rhs inside a day, so right hand sides with phases use integrate_phases.
+def integrate_daily(rhs, y0, f_params: tuple, simulation_duration: int, t0: int = 0,
+                    stop: Optional[Callable[[float, np.ndarray], bool]] = None,
+                    rtol: float = 1e-6, atol: float = 1e-12, integrator: str = 'dopri5', jac: Optional[Callable] = None,
+                    on_failure: str = 'warn') -> List[List[float]]:
+    rhs = instrumentation.wrap_rhs(rhs)
+    states = [list(y0)]
+    if stop is not None and stop(t0, np.asarray(y0)):
+        return states
+    step = 1
+    days = np.arange(t0 + step, simulation_duration + 1e-9, step)
+
+    if integrator == 'rk4':
+        y = np.asarray(y0, dtype=np.float64)
+        for day in days:
+            y = rk4_integrate(rhs, day - step, y, day, f_params)
+            if not np.isfinite(y).all():
+                integration_failed(day - step, simulation_duration, on_failure)
+                break
+            states.append(y.tolist())
+            if stop is not None and stop(day, y):
+                break
+        return states
+
+    if integrator in ('bdf', 'radau'):
+        # The implicit methods integrate the whole span in one call, so stop is applied to the daily output afterwards.
+        if days.size == 0:
+            return states
+        solution = solve_ivp(rhs, (t0, days[-1]), y0, method=IVP_METHODS[integrator], t_eval=days, args=f_params,
+                             rtol=rtol, atol=atol, jac=jac)
+        for day, state in zip(days, solution.y.T):
+            states.append(state.tolist())
+            if stop is not None and stop(day, state):
+                return states
+        if not solution.success:
+            integration_failed(solution.t[-1] if solution.t.size else t0, simulation_duration, on_failure)
+        return states
 
     # Initialize an object to solve the differential equation.
-    ode_solver = ode(diff_equations).set_integrator('dopri5', nsteps=10000)
+    use_jac = integrator == 'lsoda' and jac is not None
+    ode_solver = ode(rhs, jac if use_jac else None).set_integrator(integrator, nsteps=10000, rtol=rtol, atol=atol)
 
     # Set initial value.
-    ode_solver.set_initial_value([sm0 / n, se0 / n, so0 / n, e0 / n, i0 / n, q0 / n, r0 / n, d0 / n], 0)
+    ode_solver.set_initial_value(y0, t0)
 
     # Set parameters.
-    ode_solver.set_f_params([gamma,
-                             m_gamma_reduction_1, e_gamma_reduction_1, o_gamma_reduction_1,
-                             m_gamma_reduction_2, e_gamma_reduction_2, o_gamma_reduction_2,
-                             alpha, delta, sigma,
-                             r_i, r_q,
-                             d_i, d_q,
-                             quarantine_start, quarantine_1_duration, quarantine_2_duration])
-    result_list: List[Dict[str, float]] = [
-        {
-            'susceptible_medical': sm0,
-            'susceptible_essential_services': se0,
-            'susceptible_others': so0,
-            'susceptible': sm0 + se0 + so0,
-            'exposed': e0,
-            'infected': i0,
-            'quarantined': q0,
-            'recovered': r0,
-            'deceased': d0,
-        }
-    ]
+    ode_solver.set_f_params(*f_params)
+    if use_jac:
+        ode_solver.set_jac_params(*f_params)
+    for day in days:
+        ode_solver.integrate(day)
+        if not ode_solver.successful():
+            integration_failed(day - step, simulation_duration, on_failure)
+            break
+        states.append(list(ode_solver.y))
+        if stop is not None and stop(day, ode_solver.y):
+            break
+
+    return states
+
+
+# Integrate from t to each of the output times with rk4_integrate. Returns the states reached, ending early if one is
+# not finite.
+def rk4_outputs(rhs, t: float, y: np.ndarray, t_outputs: np.ndarray, args: tuple) -> List[np.ndarray]:
+    outputs = []
+    for t_output in t_outputs:
+        y = rk4_integrate(rhs, t, y, t_output, args)
+        if not np.isfinite(y).all():
+            break
+        outputs.append(y)
+        t = t_output
+    return outputs
+
+
+# phases is a list of consecutive (phase_start, phase_end, rhs_args) and y0 the state at the start of the first one.
+# Returns y0 followed by the states of the whole days inside the phases and, with return_phase_ends, also the state at
+# the end of every phase that was integrated successfully. With stop, integration ends after the first day for which
+# stop(day, y) is true. events are (active_from, function) pairs of terminal solve_ivp events, used inside phases
+# starting at or after active_from to interrupt the integration as soon as stop may have become true. integrator, jac
+# and on_failure are as in integrate_daily; rk4 checks stop on whole days only and ignores events.
+def integrate_phases(rhs, y0, phases: list, rtol: float = 1e-6, atol: float = 1e-12,
+                     return_phase_ends: bool = False,
+                     stop: Optional[Callable[[float, np.ndarray], bool]] = None,
+                     events: Sequence[Tuple[float, Callable]] = (), integrator: str = 'dopri5',
+                     jac: Optional[Callable] = None, on_failure: str = 'warn'):
+    rhs = instrumentation.wrap_rhs(rhs)
+    ivp_options = dict(method=IVP_METHODS.get(integrator), rtol=rtol, atol=atol)
+    if integrator != 'dopri5' and jac is not None:
+        ivp_options['jac'] = jac
+    states = [list(y0)]
+    phase_ends = []
+    y = np.asarray(y0, dtype=np.float64)
+    simulation_duration = phases[-1][1] if phases else 0
+    finished = stop is not None and stop(phases[0][0] if phases else 0, y)
+    for phase_start, phase_end, args in phases:
+        if finished:
+            break
+        phase_events = [function for active_from, function in events if active_from <= phase_start]
+        t = phase_start
+        while t < phase_end and not finished:
+            days = np.arange(np.floor(t) + 1, np.floor(phase_end) + 1)
+            t_eval = days if days.size > 0 and days[-1] == phase_end else np.append(days, phase_end)
+            if integrator == 'rk4':
+                outputs = rk4_outputs(rhs, t, y, t_eval, args)
+                t_reached, y_reached = t_eval[:len(outputs)], np.array(outputs).reshape(-1, y.size).T
+                success, status = len(outputs) == t_eval.size, 0
+            else:
+                solution = solve_ivp(rhs, (t, phase_end), y, t_eval=t_eval, args=args, events=phase_events or None,
+                                     **ivp_options)
+                t_reached, y_reached, success, status = solution.t, solution.y, solution.success, solution.status
+            reached = min(t_reached.size, days.size)
+            for day, state in zip(days[:reached], y_reached[:, :reached].T):
+                states.append(state.tolist())
+                if stop is not None and stop(day, state):
+                    finished = True
+                    break
+            if not success and not finished:
+                integration_failed(t_reached[-1] if t_reached.size else t, simulation_duration, on_failure)
+            if finished or not success:
+                finished = True
+                break
+            if status == 1:
+                # A terminal event fired. The event function is zero at that point, so step to the next output time
+                # without events before looking for events again.
+                t_event, y_event = next((t_events[0], y_events[0])
+                                        for t_events, y_events in zip(solution.t_events, solution.y_events)
+                                        if t_events.size > 0)
+                last_day = days[reached - 1] if reached else t
+                t = t_eval[reached]
+                bridge = solve_ivp(rhs, (t_event, t), y_event, args=args, **ivp_options)
+                if not bridge.success:
+                    integration_failed(last_day, simulation_duration, on_failure)
+                    finished = True
+                    break
+                y = bridge.y[:, -1]
+                if reached < days.size:
+                    states.append(y.tolist())
+                    finished = stop is not None and stop(t, y)
+            else:
+                y = y_reached[:, -1]
+                t = phase_end
+        if not finished:
+            phase_ends.append(y)
+
+    if return_phase_ends:
+        return states, phase_ends
+    return states
+
+
+# solve_ode together with the derivatives of every compartment with respect to the 14 rates of diff_equations (gamma,
+# the six gamma reductions, alpha, delta, sigma, r_i, r_q, d_i and d_q) and to k extra parameters of the initial state.
+# initial_state_jacobian is the (8, k) derivative of (sm0, se0, so0, e0, i0, q0, r0, d0) with respect to those extra
+# parameters. Returns the trajectory and a (days, compartments, 14 + k) array of sensitivities. With t0, as in
+# solve_ode, the initial state is the one of day t0 and the sensitivities start from initial_state_jacobian there.
+def solve_ode_sensitivity(sm0: float, se0: float, so0: float, e0: float, i0: float = 0, q0: float = 0,
+                          r0: float = 0, d0: float = 0,
+                          quarantine_start: int = 25,
+                          quarantine_1_duration: int = 14,
+                          quarantine_2_duration: int = 1000,
+                          simulation_duration: int = 100,
+                          gamma: float = 1,
+                          m_gamma_reduction_1: float = 1, e_gamma_reduction_1: float = 1,
+                          o_gamma_reduction_1: float = 1,
+                          m_gamma_reduction_2: float = 1, e_gamma_reduction_2: float = 1,
+                          o_gamma_reduction_2: float = 1,
+                          alpha: float = 0.5, delta: float = 0, sigma: float = 0.9,
+                          r_i: float = 0.9, r_q: float = 0.7,
+                          d_i: float = 0, d_q: float = 0.034,
+                          initial_state_jacobian: Optional[np.ndarray] = None,
+                          piecewise: bool = False, t0: int = 0,
+                          rtol: float = 1e-6, atol: float = 1e-12, integrator: str = 'dopri5',
+                          on_failure: str = 'warn') -> Tuple[Trajectory, np.ndarray]:
+    assert integrator in INTEGRATORS and on_failure in FAILURE_MODES
+    if initial_state_jacobian is None:
+        initial_state_jacobian = np.zeros((8, 0))
+    par = [gamma,
+           m_gamma_reduction_1, e_gamma_reduction_1, o_gamma_reduction_1,
+           m_gamma_reduction_2, e_gamma_reduction_2, o_gamma_reduction_2,
+           alpha, delta, sigma,
+           r_i, r_q,
+           d_i, d_q,
+           quarantine_start, quarantine_1_duration, quarantine_2_duration]
+
+    from partitioned_model import PartitionedModel
+    model = PartitionedModel.from_par(par)
+    states, sensitivity = model.solve_sensitivity(np.array([sm0, se0, so0, e0, i0, q0, r0, d0], dtype=np.float64),
+                                                  simulation_duration, initial_state_jacobian=initial_state_jacobian,
+                                                  piecewise=piecewise, t0=t0, rtol=rtol, atol=atol,
+                                                  integrator=integrator, on_failure=on_failure)
+    return model.to_trajectory(states), model.compartment_values(sensitivity)
+
+
+# Integrate N scenarios together. initial_states is an (N, 8) array with the absolute (sm, se, so, e, i, q, r, d) values
+# and parameters an (N, 17) array laid out as the diff_equations parameters. Returns an (N, days, compartments) array
+# whose last axis follows COMPARTMENTS, so Trajectory(result[k]) is the k-th scenario. All trajectories share the
+# adaptive steps of a single dopri5 run. If it fails, the days axis ends on the last day reached (see
+# integration_failed).
+@instrumentation.timed('solve_ode_batch')
+def solve_ode_batch(initial_states: np.ndarray, parameters: np.ndarray,
+                    simulation_duration: int = 100, on_failure: str = 'warn') -> np.ndarray:
+    initial_states = np.atleast_2d(np.asarray(initial_states, dtype=np.float64))
+    parameters = np.atleast_2d(np.asarray(parameters, dtype=np.float64))
+    assert initial_states.shape[1] == 8 and parameters.shape[1] == 17
+    assert initial_states.shape[0] == parameters.shape[0]
+    n = initial_states.sum(axis=1)
+
+    ode_solver = ode(instrumentation.wrap_rhs(diff_equations_batch)).set_integrator('dopri5', nsteps=10000)
+    ode_solver.set_initial_value((initial_states / n[:, None]).T.ravel(), 0)
+    ode_solver.set_f_params(parameters)
+
+    states = [initial_states / n[:, None]]
     step = 1
     t = step
-    while ode_solver.successful() and t <= simulation_duration:
+    while t <= simulation_duration:
         ode_solver.integrate(t)
+        if not ode_solver.successful():
+            integration_failed(t - step, simulation_duration, on_failure)
+            break
         t += step
-        sm, se, so, e, i, q, r, d = ode_solver.y
-        result_list.append(
-            {
-                'susceptible_medical': sm * n,
-                'susceptible_essential_services': se * n,
-                'susceptible_others': so * n,
-                'susceptible': (sm + se + so) * n,
-                'exposed': e * n,
-                'infected': i * n,
-                'quarantined': q * n,
-                'recovered': r * n,
-                'deceased': d * n,
-            }
-        )
+        states.append(ode_solver.y.reshape(8, -1).T)
 
-    return result_list
+    states = np.stack(states, axis=1) * n[:, None, None]
+    susceptible = states[:, :, :3].sum(axis=2, keepdims=True)
+    return np.concatenate([states[:, :, :3], susceptible, states[:, :, 3:]], axis=2)
+
+
+# Solve the solve_ode scenarios that only differ in quarantine_2_duration, sharing the trajectory up to the earliest
+# quarantine end (see PartitionedModel.solve_last_phase_ends). Returns one BranchedTrajectory per duration, in the given
+# order.
+def solve_ode_quarantine_ends(sm0: float, se0: float, so0: float, e0: float, i0: float = 0, q0: float = 0,
+                              r0: float = 0, d0: float = 0,
+                              quarantine_start: int = 25,
+                              quarantine_1_duration: int = 14,
+                              quarantine_2_durations: Sequence[int] = (1000,),
+                              simulation_duration: int = 100,
+                              gamma: float = 1,
+                              m_gamma_reduction_1: float = 1, e_gamma_reduction_1: float = 1,
+                              o_gamma_reduction_1: float = 1,
+                              m_gamma_reduction_2: float = 1, e_gamma_reduction_2: float = 1,
+                              o_gamma_reduction_2: float = 1,
+                              alpha: float = 0.5, delta: float = 0, sigma: float = 0.9,
+                              r_i: float = 0.9, r_q: float = 0.7,
+                              d_i: float = 0, d_q: float = 0.034,
+                              piecewise: bool = False) -> List[BranchedTrajectory]:
+    par = [gamma,
+           m_gamma_reduction_1, e_gamma_reduction_1, o_gamma_reduction_1,
+           m_gamma_reduction_2, e_gamma_reduction_2, o_gamma_reduction_2,
+           alpha, delta, sigma,
+           r_i, r_q,
+           d_i, d_q,
+           quarantine_start, quarantine_1_duration, max(quarantine_2_durations)]
+    from partitioned_model import PartitionedModel
+    return PartitionedModel.from_par(par).solve_last_phase_ends(np.array([sm0, se0, so0, e0, i0, q0, r0, d0]),
+                                                                 quarantine_2_durations, simulation_duration,
+                                                                 piecewise=piecewise)
@@ -0,0 +1,69 @@
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+# Keys of a trained parameters json that define a scenario.
+PARAMETER_KEYS = ['suspected_medical_initial', 'suspected_essential_initial', 'suspected_others_initial',
+                  'exposed_initial', 'infected_initial', 'quarantined_initial', 'recovered_initial',
+                  'deceased_initial',
+                  'quarantine_start', 'quarantine_1_duration', 'quarantine_2_duration',
+                  'gamma', 'gamma_m_1', 'gamma_e_1', 'gamma_o_1', 'gamma_m_2', 'gamma_e_2', 'gamma_o_2',
+                  'alpha', 'delta', 'sigma', 'r_i', 'r_q', 'd_i', 'd_q']
+# solve_ode arguments of the initial state, in the order of the state vector of diff_equations.
+STATE_ARGUMENTS = ('sm0', 'se0', 'so0', 'e0', 'i0', 'q0', 'r0', 'd0')
+# solve_ode arguments in the order of the par vector of diff_equations.
+PAR_ARGUMENTS = ('gamma', 'm_gamma_reduction_1', 'e_gamma_reduction_1', 'o_gamma_reduction_1',
+                 'm_gamma_reduction_2', 'e_gamma_reduction_2', 'o_gamma_reduction_2', 'alpha', 'delta', 'sigma',
+                 'r_i', 'r_q', 'd_i', 'd_q', 'quarantine_start', 'quarantine_1_duration', 'quarantine_2_duration')
+
+
+# solve_ode arguments of a trained parameters json. The second quarantine phase never ends unless
+# quarantine_2_duration is given.
+def solve_kwargs(parameters: Dict, simulation_duration: int, piecewise: bool = False) -> Dict:
+    return dict(sm0=parameters['suspected_medical_initial'],
+                se0=parameters['suspected_essential_initial'],
+                so0=parameters['suspected_others_initial'],
+                e0=parameters['exposed_initial'],
+                i0=parameters['infected_initial'],
+                q0=parameters['quarantined_initial'],
+                r0=parameters['recovered_initial'],
+                d0=parameters['deceased_initial'],
+                quarantine_start=parameters['quarantine_start'],
+                quarantine_1_duration=parameters['quarantine_1_duration'],
+                quarantine_2_duration=parameters.get('quarantine_2_duration', 1000),
+                simulation_duration=simulation_duration,
+                gamma=parameters['gamma'],
+                m_gamma_reduction_1=parameters['gamma'] / parameters['gamma_m_1'],
+                e_gamma_reduction_1=parameters['gamma'] / parameters['gamma_e_1'],
+                o_gamma_reduction_1=parameters['gamma'] / parameters['gamma_o_1'],
+                m_gamma_reduction_2=parameters['gamma_m_1'] / parameters['gamma_m_2'],
+                e_gamma_reduction_2=parameters['gamma_e_1'] / parameters['gamma_e_2'],
+                o_gamma_reduction_2=parameters['gamma_o_1'] / parameters['gamma_o_2'],
+                alpha=parameters['alpha'], delta=parameters['delta'], sigma=parameters['sigma'],
+                r_i=parameters['r_i'], r_q=parameters['r_q'],
+                d_i=parameters['d_i'], d_q=parameters['d_q'],
+                piecewise=piecewise)
+
+
+# Initial state and par vector of diff_equations from solve_ode arguments.
+def state_and_par(kwargs: Dict) -> Tuple[List[float], List[float]]:
+    return [kwargs[name] for name in STATE_ARGUMENTS], [kwargs[name] for name in PAR_ARGUMENTS]
+
+
+# n quasi random points of the box between lower and upper, as an (n, len(lower)) array. Dimensions flagged in log_scale
+# are sampled uniformly in the logarithm, which needs positive bounds there.
+def sample_box(lower: Sequence[float], upper: Sequence[float], n: int, sampling: str = 'sobol',
+               seed: Optional[int] = None, log_scale: Optional[Sequence[bool]] = None) -> np.ndarray:
+    # scipy.stats takes long to import and only sampled sweeps and multi-start fits need it.
+    from scipy.stats import qmc
+    lower, upper = np.array(lower, dtype=np.float64), np.array(upper, dtype=np.float64)
+    if sampling == 'sobol':
+        # Sobol points keep their balance properties only in powers of two.
+        unit = qmc.Sobol(d=len(lower), seed=seed).random_base2(int(np.ceil(np.log2(max(n, 1)))))[:n]
+    else:
+        unit = qmc.LatinHypercube(d=len(lower), seed=seed).random(n)
+    log_scale = np.zeros(len(lower), dtype=bool) if log_scale is None else np.asarray(log_scale, dtype=bool)
+    lower[log_scale], upper[log_scale] = np.log(lower[log_scale]), np.log(upper[log_scale])
+    points = lower + unit * (upper - lower)
+    points[:, log_scale] = np.exp(points[:, log_scale])
+    return points
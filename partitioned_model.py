@@ -0,0 +1,484 @@
+import copy
+import json
+from bisect import bisect_right
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import click
+import numpy as np
+
+import instrumentation
+from ode_solving import (diff_equations, diff_jacobian, integrate_daily, integrate_phases, phase_equations,
+                         phase_jacobian, sensitivity_equations)
+from trajectory import COMPARTMENT_INDEX, BranchedTrajectory, Trajectory
+
+
+LEGACY_GROUPS = ('medical', 'essential_services', 'others')
+LEGACY_QUARANTINE_CONTACT = (True, False, False)
+# Rates shared by every group, in the order of their columns in the sensitivities.
+RATE_NAMES = ('alpha', 'delta', 'sigma', 'r_i', 'r_q', 'd_i', 'd_q')
+LEGACY_INITIAL_KEYS = dict(zip(LEGACY_GROUPS, ('suspected_medical_initial', 'suspected_essential_initial',
+                                               'suspected_others_initial')))
+
+
+# Key of the initial susceptible individuals of a group in a parameters json: the suspected_*_initial key of the
+# original model for its groups, whatever the other groups, and "<name>_initial" for any other group.
+def initial_key(group_name: str) -> str:
+    return LEGACY_INITIAL_KEYS.get(group_name, f'{group_name}_initial')
+
+
+# SEIQRD model whose susceptible population is split into K groups and whose contact rates change over P consecutive
+# quarantine phases. Phase p starts phase_durations[0] + ... + phase_durations[p - 1] days after quarantine_start and
+# lasts phase_durations[p] days; before and after the quarantine every group has the base contact rate gamma.
+# gamma_reductions is a (K, P) array: in phase p the contact rate of group k is gamma divided by
+# gamma_reductions[k, 0], ..., gamma_reductions[k, p] in turn. Groups with quarantine_contact are also infected by the
+# quarantined. The state is (s_1, ..., s_K, e, i, q, r, d).
+# The original medical, essential and others groups with two phases are a special case, integrated with the scalar
+# right hand sides of ode_solving, which are faster on so few groups and give the same output.
+class PartitionedModel:
+    def __init__(self, group_names: Sequence[str], group_fractions: Sequence[float],
+                 quarantine_contact: Sequence[bool], quarantine_start: float, phase_durations: Sequence[float],
+                 gamma: float, gamma_reductions: np.ndarray,
+                 alpha: float, delta: float, sigma: float, r_i: float, r_q: float, d_i: float, d_q: float):
+        self.group_names = list(group_names)
+        self.group_fractions = np.asarray(group_fractions, dtype=np.float64)
+        self.quarantine_contact = np.asarray(quarantine_contact, dtype=np.float64)
+        self.quarantine_start = quarantine_start
+        self.phase_durations = list(phase_durations)
+        # Added one phase at a time, as diff_equations does.
+        self.phase_boundaries = [quarantine_start]
+        for duration in self.phase_durations:
+            self.phase_boundaries.append(self.phase_boundaries[-1] + duration)
+        self.gamma = gamma
+        self.gamma_reductions = np.asarray(gamma_reductions, dtype=np.float64).reshape(len(self.group_names), -1)
+        assert self.gamma_reductions.shape[1] == len(self.phase_durations)
+        self.alpha, self.delta, self.sigma = alpha, delta, sigma
+        self.r_i, self.r_q, self.d_i, self.d_q = r_i, r_q, d_i, d_q
+        self.rates = np.array([alpha, delta, sigma, r_i, r_q, d_i, d_q], dtype=np.float64)
+
+        # Contact rates of every group, column 0 outside the quarantine and column p in phase p, and their derivatives
+        # with respect to gamma. Divisions are applied one phase at a time as in diff_equations.
+        gammas = [np.full(len(self.group_names), float(gamma))]
+        gamma_derivatives = [np.ones(len(self.group_names))]
+        for p in range(self.gamma_reductions.shape[1]):
+            gammas.append(gammas[-1] / self.gamma_reductions[:, p])
+            gamma_derivatives.append(gamma_derivatives[-1] / self.gamma_reductions[:, p])
+        self.gammas = np.stack(gammas, axis=1)
+        self.gamma_derivatives = np.stack(gamma_derivatives, axis=1)
+
+        self.legacy = (tuple(self.group_names) == LEGACY_GROUPS and self.n_phases == 2
+                       and tuple(self.quarantine_contact.astype(bool)) == LEGACY_QUARANTINE_CONTACT)
+
+    @property
+    def n_groups(self) -> int:
+        return len(self.group_names)
+
+    @property
+    def n_phases(self) -> int:
+        return len(self.phase_durations)
+
+    # Number of rates the trajectory depends on: gamma, the K * P gamma reductions and RATE_NAMES.
+    @property
+    def n_rates(self) -> int:
+        return 1 + self.n_groups * self.n_phases + len(RATE_NAMES)
+
+    # Groups and phases as described in a data json. "groups" is a list of {"name", "fraction", "quarantine_contact"}
+    # and "phase_durations" the duration of every phase after "quarantine_start". Without them, the medical, essential
+    # and others groups and the two quarantine phases of the original model are used. As in parameter_sets.solve_kwargs,
+    # the second phase never ends unless quarantine_2_duration is given.
+    @staticmethod
+    def structure_from_data(data: Dict) -> Dict:
+        if 'groups' in data:
+            groups = data['groups']
+            group_names = [group['name'] for group in groups]
+            group_fractions = [group['fraction'] for group in groups]
+            quarantine_contact = [group.get('quarantine_contact', False) for group in groups]
+        else:
+            frac_medical = data.get('fraction_medical', 0)
+            frac_essential = data.get('fraction_essential', 0)
+            group_names = list(LEGACY_GROUPS)
+            group_fractions = [frac_medical, frac_essential, 1 - frac_medical - frac_essential]
+            quarantine_contact = list(LEGACY_QUARANTINE_CONTACT)
+        if 'phase_durations' in data:
+            phase_durations = list(data['phase_durations'])
+        else:
+            phase_durations = [data['quarantine_1_duration'], data.get('quarantine_2_duration', 1000)]
+        return dict(group_names=group_names, group_fractions=group_fractions, quarantine_contact=quarantine_contact,
+                    quarantine_start=data['quarantine_start'], phase_durations=phase_durations)
+
+    # Model from a parameters json. Either "gamma_reductions" is given as a (K, P) list together with the structure
+    # keys of structure_from_data, or the gamma_m_1 ... gamma_o_2 keys of the original model are converted. The rates
+    # of a window refit (see incremental.refit_parameters) only hold from its window_start, so they are refused.
+    @classmethod
+    def from_parameters(cls, parameters: Dict) -> 'PartitionedModel':
+        if 'window_start' in parameters:
+            raise ValueError(f'The parameters of a window refit only hold from day {parameters["window_start"]}, '
+                             f'they cannot be simulated from day 0.')
+        structure = cls.structure_from_data(parameters)
+        if 'gamma_reductions' in parameters:
+            gamma_reductions = parameters['gamma_reductions']
+        else:
+            gamma_reductions = [[parameters['gamma'] / parameters[f'gamma_{group}_1'],
+                                 parameters[f'gamma_{group}_1'] / parameters[f'gamma_{group}_2']]
+                                for group in ('m', 'e', 'o')]
+        return cls(**structure, gamma=parameters['gamma'], gamma_reductions=gamma_reductions,
+                   alpha=parameters['alpha'], delta=parameters['delta'], sigma=parameters['sigma'],
+                   r_i=parameters['r_i'], r_q=parameters['r_q'], d_i=parameters['d_i'], d_q=parameters['d_q'])
+
+    # Original model from the par vector of diff_equations. The group fractions only matter to
+    # initial_state_from_parameters, so they are left at the defaults of structure_from_data.
+    @classmethod
+    def from_par(cls, par: Sequence[float]) -> 'PartitionedModel':
+        g, mg_1, eg_1, og_1, mg_2, eg_2, og_2, al, de, s, ri, rq, di, dq, start, dur_1, dur_2 = par
+        structure = cls.structure_from_data(dict(quarantine_start=start, quarantine_1_duration=dur_1,
+                                                 quarantine_2_duration=dur_2))
+        return cls(**structure, gamma=g, gamma_reductions=[[mg_1, mg_2], [eg_1, eg_2], [og_1, og_2]],
+                   alpha=al, delta=de, sigma=s, r_i=ri, r_q=rq, d_i=di, d_q=dq)
+
+    # Par vector of diff_equations, for the original model only.
+    @property
+    def par(self) -> List[float]:
+        assert self.legacy, 'Only the medical, essential and others groups with two phases have a diff_equations par.'
+        (mg_1, mg_2), (eg_1, eg_2), (og_1, og_2) = self.gamma_reductions.tolist()
+        return ([self.gamma, mg_1, eg_1, og_1, mg_2, eg_2, og_2] + self.rates.tolist()
+                + [self.quarantine_start] + self.phase_durations)
+
+    # Same model integrated through the vectorized right hand sides even if it is the original one, to check them
+    # against the scalar ones.
+    def vectorized(self) -> 'PartitionedModel':
+        model = copy.copy(self)
+        model.legacy = False
+        return model
+
+    # Same model with the last phase lasting duration days.
+    def with_last_phase_duration(self, duration: float) -> 'PartitionedModel':
+        model = copy.copy(self)
+        model.phase_durations = self.phase_durations[:-1] + [duration]
+        model.phase_boundaries = self.phase_boundaries[:-1] + [self.phase_boundaries[-2] + duration]
+        return model
+
+    # Initial (s_1, ..., s_K, e, i, q, r, d) in individuals from a parameters json. Groups with an initial_key entry
+    # use it; otherwise "susceptible_initial" is split according to the group fractions.
+    def initial_state_from_parameters(self, parameters: Dict) -> np.ndarray:
+        susceptible = []
+        for name, fraction in zip(self.group_names, self.group_fractions):
+            key = initial_key(name)
+            if key in parameters:
+                susceptible.append(parameters[key])
+            else:
+                susceptible.append(parameters['susceptible_initial'] * fraction)
+        others = [parameters.get(f'{compartment}_initial', 0)
+                  for compartment in ('exposed', 'infected', 'quarantined', 'recovered', 'deceased')]
+        return np.array(susceptible + others, dtype=np.float64)
+
+    def phase_column(self, t: float) -> int:
+        phase = bisect_right(self.phase_boundaries, t)
+        return phase if phase <= self.n_phases else 0
+
+    # Extra arguments of rhs, phase_rhs and their Jacobians are those of the compiled right hand sides, which carry
+    # the model in arrays, and are ignored.
+    def rhs(self, t, y, *args):
+        return self.phase_rhs(t, y, self.phase_column(t))
+
+    # Right hand side with the contact rates of column phase of self.gammas.
+    def phase_rhs(self, t, y, phase: int, *args):
+        k = self.n_groups
+        s = y[:k]
+        e, i, q, r, d = y[k:]
+        # Summed in the order of diff_equations, so the original model is reproduced exactly.
+        n = s.sum() + e + i + q + r + d
+
+        # As in diff_equations, contact with the quarantined is weighted by the deceased compartment d.
+        s_dt = -s * (self.gammas[:, phase] * i + self.quarantine_contact * d * q) / n
+        e_dt = -s_dt.sum() - self.sigma * e
+        i_dt = self.sigma * e - (self.alpha + self.r_i + self.d_i) * i
+        q_dt = self.alpha * i - (self.r_q + self.d_q) * q
+        r_dt = self.r_i * i + self.r_q * q
+        d_dt = self.d_i * i + self.d_q * q
+
+        return np.concatenate([s_dt, [e_dt, i_dt, q_dt, r_dt, d_dt]])
+
+    def jacobian(self, t, y, *args) -> np.ndarray:
+        return self.phase_jacobian(t, y, self.phase_column(t))
+
+    # Jacobian of phase_rhs with respect to the state, for the implicit integrators.
+    def phase_jacobian(self, t, y, phase: int, *args) -> np.ndarray:
+        k = self.n_groups
+        s = np.asarray(y[:k])
+        e, i, q, r, d = y[k:]
+        n = s.sum() + e + i + q + r + d
+        gammas = self.gammas[:, phase]
+        force = gammas * i + self.quarantine_contact * d * q
+
+        jacobian = np.zeros((k + 5, k + 5))
+        # Every state enters n, so every column of the susceptible rows gets the derivative of 1 / n.
+        jacobian[:k] = (s * force / n ** 2)[:, None]
+        jacobian[np.arange(k), np.arange(k)] -= force / n
+        jacobian[:k, k + 1] -= s * gammas / n
+        jacobian[:k, k + 2] -= s * self.quarantine_contact * d / n
+        jacobian[:k, k + 4] -= s * self.quarantine_contact * q / n
+        jacobian[k] = -jacobian[:k].sum(axis=0)
+        jacobian[k, k] -= self.sigma
+        jacobian[k + 1, k] = self.sigma
+        jacobian[k + 1, k + 1] = -(self.alpha + self.r_i + self.d_i)
+        jacobian[k + 2, k + 1] = self.alpha
+        jacobian[k + 2, k + 2] = -(self.r_q + self.d_q)
+        jacobian[k + 3, k + 1] = self.r_i
+        jacobian[k + 3, k + 2] = self.r_q
+        jacobian[k + 4, k + 1] = self.d_i
+        jacobian[k + 4, k + 2] = self.d_q
+        return jacobian
+
+    # Forward sensitivity equations. z holds the K + 5 normalized states followed by the flattened (K + 5, n_rates + k)
+    # sensitivity matrix, whose columns are the derivatives with respect to gamma, the gamma reductions phase by phase
+    # (every group of the first phase, then of the second, ...), RATE_NAMES and k extra directions of the initial
+    # state. phase overrides the phase deduced from t, so the equations can also be integrated one phase at a time.
+    def sensitivity_rhs(self, t, z, k: int, phase: Optional[int] = None):
+        groups = self.n_groups
+        y = z[:groups + 5]
+        sensitivity = z[groups + 5:].reshape(groups + 5, self.n_rates + k)
+        if phase is None:
+            phase = self.phase_column(t)
+        s = y[:groups]
+        e, i, q, r, d = y[groups:]
+        n = s.sum() + e + i + q + r + d
+        gammas = self.gammas[:, phase]
+
+        # Derivatives of the contact rates: gamma enters every phase and the reduction of phase j the phases from j on.
+        rate_jacobian = np.zeros((groups + 5, self.n_rates + k))
+        s_i = -s * i / n
+        rate_jacobian[:groups, 0] = s_i * self.gamma_derivatives[:, phase]
+        for j in range(min(phase, self.n_phases)):
+            columns = 1 + j * groups + np.arange(groups)
+            rate_jacobian[np.arange(groups), columns] = s_i * -gammas / self.gamma_reductions[:, j]
+        rate_jacobian[groups] = -rate_jacobian[:groups].sum(axis=0)
+        alpha, delta, sigma, r_i, r_q, d_i, d_q = 1 + groups * self.n_phases + np.arange(len(RATE_NAMES))
+        rate_jacobian[groups, sigma] = -e
+        rate_jacobian[groups + 1, [alpha, sigma, r_i, d_i]] = -i, e, -i, -i
+        rate_jacobian[groups + 2, [alpha, r_q, d_q]] = i, -q, -q
+        rate_jacobian[groups + 3, [r_i, r_q]] = i, q
+        rate_jacobian[groups + 4, [d_i, d_q]] = i, q
+
+        y_dt = self.phase_rhs(t, y, phase)
+        return np.concatenate([y_dt, (self.phase_jacobian(t, y, phase) @ sensitivity + rate_jacobian).ravel()])
+
+    # (phase_start, phase_end, column) intervals covering [0, simulation_duration].
+    def phases(self, simulation_duration: float) -> List:
+        boundaries = [0] + self.phase_boundaries + [simulation_duration]
+        columns = [0] + list(range(1, self.n_phases + 1)) + [0]
+        return [(max(phase_start, 0), min(phase_end, simulation_duration), column)
+                for phase_start, phase_end, column in zip(boundaries[:-1], boundaries[1:], columns)
+                if max(phase_start, 0) < min(phase_end, simulation_duration)]
+
+    # phases split at split_times, keeping those that start at or after t0.
+    def pieces(self, simulation_duration: float, split_times: Sequence[float] = (), t0: float = 0) -> List:
+        split_list = []
+        for phase_start, phase_end, column in self.phases(simulation_duration):
+            inner_times = sorted({t for t in split_times if phase_start < t < phase_end})
+            for piece_start, piece_end in zip([phase_start] + inner_times, inner_times + [phase_end]):
+                if piece_start >= t0:
+                    split_list.append((piece_start, piece_end, column))
+        return split_list
+
+    # Right hand side switching phases inside, its arguments and its Jacobian, for integrate_daily.
+    def _stepwise_system(self, jit: bool = False) -> Tuple[Callable, tuple, Callable]:
+        if self.legacy:
+            if jit:
+                import compiled_equations
+                return compiled_equations.diff_equations, (np.array(self.par, dtype=np.float64),), diff_jacobian
+            return diff_equations, (self.par,), diff_jacobian
+        if jit:
+            import compiled_equations
+            return (compiled_equations.partitioned_equations,
+                    (self.gammas, np.array(self.phase_boundaries, dtype=np.float64), self.quarantine_contact,
+                     self.rates), self.jacobian)
+        return self.rhs, (), self.jacobian
+
+    # Right hand side of a single phase, its Jacobian and a function giving its arguments in phase column, for
+    # integrate_phases.
+    def _phase_system(self, jit: bool = False) -> Tuple[Callable, Callable, Callable]:
+        if jit:
+            import compiled_equations
+        if self.legacy:
+            rates = self.rates.tolist()
+
+            def phase_par(column: int):
+                par = tuple(self.gammas[:, column].tolist()) + tuple(rates)
+                return (np.array(par),) if jit else (par,)
+            return compiled_equations.phase_equations if jit else phase_equations, phase_jacobian, phase_par
+        if jit:
+            return (compiled_equations.partitioned_phase_equations, self.phase_jacobian,
+                    lambda column: (column, self.gammas, self.quarantine_contact, self.rates))
+        return self.phase_rhs, self.phase_jacobian, lambda column: (column,)
+
+    # Normalized states of days t0 to simulation_duration from the normalized state y0 of day t0, integrated day by
+    # day through rhs or, with piecewise, one phase at a time. stop, events, the integrator options and on_failure are
+    # those of integrate_daily and integrate_phases; rk4 has no step control to absorb a phase switch, which its last
+    # stage before a boundary would already see, so it always integrates phase by phase. jit uses the compiled right
+    # hand sides of compiled_equations, or the ordinary ones when numba is missing.
+    def integrate(self, y0, simulation_duration: int, t0: int = 0, piecewise: bool = False,
+                  stop: Optional[Callable[[float, np.ndarray], bool]] = None,
+                  events: Sequence[Tuple[float, Callable]] = (), rtol: float = 1e-6, atol: float = 1e-12,
+                  integrator: str = 'dopri5', jit: bool = False, on_failure: str = 'warn') -> List[List[float]]:
+        if jit:
+            # Importing numba is slow, so it only happens for compiled runs.
+            from compiled_equations import jit_enabled
+            jit = jit_enabled()
+        if piecewise or integrator == 'rk4':
+            rhs, jacobian, phase_args = self._phase_system(jit)
+            phases = [(phase_start, phase_end, phase_args(column)) for phase_start, phase_end, column in
+                      self.pieces(simulation_duration, [t0] + [active_from for active_from, _ in events], t0)]
+            return integrate_phases(rhs, y0, phases, rtol=rtol, atol=atol, stop=stop, events=events,
+                                    integrator=integrator, jac=jacobian, on_failure=on_failure)
+        rhs, args, jacobian = self._stepwise_system(jit)
+        return integrate_daily(rhs, y0, args, simulation_duration, t0=t0, stop=stop, rtol=rtol, atol=atol,
+                               integrator=integrator, jac=jacobian, on_failure=on_failure)
+
+    # Normalized state and population of an initial state in individuals, summed in the order of diff_equations.
+    def _normalize(self, initial_state: np.ndarray) -> Tuple[np.ndarray, float]:
+        initial_state = np.asarray(initial_state, dtype=np.float64)
+        n = initial_state[:self.n_groups].sum()
+        for value in initial_state[self.n_groups:]:
+            n += value
+        return initial_state / n, n
+
+    # Daily (s_1, ..., s_K, e, i, q, r, d) in individuals for days t0 to simulation_duration, initial_state being the
+    # state of day t0. options are passed to integrate.
+    @instrumentation.timed('solve_ode')
+    def solve(self, initial_state: np.ndarray, simulation_duration: int = 100, piecewise: bool = False,
+              t0: int = 0, **options) -> np.ndarray:
+        y0, n = self._normalize(initial_state)
+        states = self.integrate(y0, simulation_duration, t0=t0, piecewise=piecewise, **options)
+        return np.asarray(states).reshape(-1, self.n_groups + 5) * n
+
+    # solve together with the (days, K + 5, n_rates + k) derivatives of the states with respect to the rates (see
+    # sensitivity_rhs) and to k extra parameters of the initial state, initial_state_jacobian being the (K + 5, k)
+    # derivative of initial_state with respect to them. With t0 the sensitivities start from initial_state_jacobian
+    # on day t0. rk4 integrates phase by phase, as in integrate.
+    @instrumentation.timed('solve_ode_sensitivity')
+    def solve_sensitivity(self, initial_state: np.ndarray, simulation_duration: int = 100,
+                          initial_state_jacobian: Optional[np.ndarray] = None, piecewise: bool = False, t0: int = 0,
+                          rtol: float = 1e-6, atol: float = 1e-12, integrator: str = 'dopri5',
+                          on_failure: str = 'warn') -> Tuple[np.ndarray, np.ndarray]:
+        size = self.n_groups + 5
+        if initial_state_jacobian is None:
+            initial_state_jacobian = np.zeros((size, 0))
+        k = initial_state_jacobian.shape[1]
+        x0 = np.asarray(initial_state, dtype=np.float64)
+        n = x0.sum()
+        n_jacobian = initial_state_jacobian.sum(axis=0)
+
+        sensitivity_0 = np.zeros((size, self.n_rates + k))
+        sensitivity_0[:, self.n_rates:] = initial_state_jacobian / n - np.outer(x0, n_jacobian) / n ** 2
+        z0 = np.concatenate([x0 / n, sensitivity_0.ravel()])
+
+        if self.legacy:
+            rhs, args = sensitivity_equations, (self.par, k)
+        else:
+            rhs, args = self.sensitivity_rhs, (k,)
+        if piecewise or integrator == 'rk4':
+            phases = [(phase_start, phase_end, args + (column,))
+                      for phase_start, phase_end, column in self.pieces(simulation_duration, [t0], t0)]
+            states = np.array(integrate_phases(rhs, z0, phases, rtol=rtol, atol=atol, integrator=integrator,
+                                               on_failure=on_failure))
+        else:
+            states = np.array(integrate_daily(rhs, z0, args, simulation_duration, t0=t0, rtol=rtol, atol=atol,
+                                              integrator=integrator, on_failure=on_failure))
+
+        y = states[:, :size]
+        sensitivity = states[:, size:].reshape(-1, size, self.n_rates + k) * n
+        sensitivity[:, :, self.n_rates:] += y[:, :, None] * n_jacobian
+        return y * n, sensitivity
+
+    # Solve the variants of the model that only differ in the duration of the last phase. They all share the
+    # trajectory up to the earliest end, so a single trunk is integrated with the longest duration, the solver state
+    # is taken at every end and each variant continues from its own branch point. Returns one BranchedTrajectory per
+    # duration, in the given order, whose prefix is a view of the shared trunk.
+    @instrumentation.timed('solve_ode_quarantine_ends')
+    def solve_last_phase_ends(self, initial_state: np.ndarray, durations: Sequence[float],
+                              simulation_duration: int = 100, piecewise: bool = False) -> List[BranchedTrajectory]:
+        y0, n = self._normalize(initial_state)
+        models = [self.with_last_phase_duration(duration) for duration in durations]
+        ends = [min(model.phase_boundaries[-1], simulation_duration) for model in models]
+        trunk_end = max(ends)
+        trunk_model = self.with_last_phase_duration(max(durations))
+
+        if piecewise:
+            rhs, _, phase_args = trunk_model._phase_system()
+            trunk_phases = trunk_model.pieces(trunk_end, sorted(set(ends)))
+            trunk_states, phase_ends = integrate_phases(
+                rhs, y0, [(phase_start, phase_end, phase_args(column))
+                          for phase_start, phase_end, column in trunk_phases], return_phase_ends=True)
+            branch_states = {phase_end: y for (_, phase_end, _), y in zip(trunk_phases, phase_ends)}
+        else:
+            rhs, args, _ = trunk_model._stepwise_system()
+            trunk_states = integrate_daily(rhs, y0, args, trunk_end)
+        trunk = self.to_trajectory(np.asarray(trunk_states).reshape(-1, self.n_groups + 5) * n)
+
+        results = []
+        for model, end in zip(models, ends):
+            prefix_days = min(int(np.floor(end)) + 1, len(trunk))
+            if piecewise:
+                if end not in branch_states:
+                    # The trunk integration failed before this branch point.
+                    suffix_states = []
+                else:
+                    rhs, _, phase_args = model._phase_system()
+                    phases = [(phase_start, phase_end, phase_args(column))
+                              for phase_start, phase_end, column in model.pieces(simulation_duration, t0=end)]
+                    suffix_states = integrate_phases(rhs, branch_states[end], phases)[1:]
+            else:
+                branch_day = prefix_days - 1
+                rhs, args, _ = model._stepwise_system()
+                suffix_states = integrate_daily(rhs, trunk_states[branch_day], args, simulation_duration,
+                                                t0=branch_day)[1:]
+            suffix = np.asarray(suffix_states, dtype=np.float64).reshape(-1, self.n_groups + 5) * n
+            results.append(BranchedTrajectory(trunk[:prefix_days], self.to_trajectory(suffix)))
+
+        return results
+
+    # (days, K + 5, ...) model states, or their sensitivities, laid out as the (days, compartments, ...) values of a
+    # Trajectory. The per-group susceptible columns are only filled for the medical, essential_services and others
+    # groups.
+    def compartment_values(self, states: np.ndarray) -> np.ndarray:
+        k = self.n_groups
+        values = np.full((states.shape[0], len(COMPARTMENT_INDEX)) + states.shape[2:], np.nan)
+        for group, name in enumerate(self.group_names):
+            if f'susceptible_{name}' in COMPARTMENT_INDEX:
+                values[:, COMPARTMENT_INDEX[f'susceptible_{name}']] = states[:, group]
+        values[:, COMPARTMENT_INDEX['susceptible']] = states[:, :k].sum(axis=1)
+        for offset, compartment in enumerate(('exposed', 'infected', 'quarantined', 'recovered', 'deceased')):
+            values[:, COMPARTMENT_INDEX[compartment]] = states[:, k + offset]
+        return values
+
+    def to_trajectory(self, states: np.ndarray) -> Trajectory:
+        return Trajectory(self.compartment_values(states))
+
+
+@click.command('partitioned-prediction')
+@click.option('--parameters-path', prompt='Parameters path', help='path where model parameters are stored.',
+              required=True)
+@click.option('--simulation-duration', default=100, help='Duration of simulation.')
+@click.option('--quarantine-2-duration', type=int, help='Duration of the second phase of the original model.')
+@click.option('--piecewise', is_flag=True, help='Integrate each quarantine phase in a single solver call.')
+@click.option('--output-path', help='Write the figure to this png, svg or pdf file instead of showing it.')
+def run_partitioned_model(parameters_path: str, simulation_duration: int = 100,
+                          quarantine_2_duration: Optional[int] = None, piecewise: bool = False,
+                          output_path: Optional[str] = None) -> Trajectory:
+    with open(parameters_path) as data_file:
+        parameters = json.load(data_file)
+    if quarantine_2_duration is not None:
+        parameters['quarantine_2_duration'] = quarantine_2_duration
+
+    model = PartitionedModel.from_parameters(parameters)
+    states = model.solve(model.initial_state_from_parameters(parameters), simulation_duration=simulation_duration,
+                         piecewise=piecewise)
+    trajectory = model.to_trajectory(states)
+    # matplotlib is only imported by runs that plot.
+    from visualization import show_results
+    show_results(trajectory, gt_data=parameters.get('gt_data', None), output_path=output_path)
+
+    return trajectory
+
+
+if __name__ == '__main__':
+    run_partitioned_model()
@@ -1,10 +1,11 @@
 import json
+import os
 from typing import Optional
 
 import click
 
-from ode_solving import solve_ode
-from visualization import show_multiple_results
+import instrumentation
+from partitioned_model import PartitionedModel
 
 
 @click.command('quarantine-end-prediction')
@@ -13,44 +14,47 @@ from visualization import show_multiple_results
 @click.option('--simulation-duration', prompt='Simulation duration', help='Duration of simulation.', default=100)
 @click.option('--offset', prompt='Offset from day 0', help='Offset from day 0 when showing.', default=0)
 @click.option('--top-lim', help='Offset from day 0 when showing.', type=int)
+@click.option('--piecewise', is_flag=True, help='Integrate each quarantine phase in a single solver call.')
+@click.option('--profile', is_flag=True, help='Report solver counters and timings.')
+@click.option('--output-path', help='Write the figure to this png, svg or pdf file instead of showing it.')
+@click.option('--figures-dir', help='Also write a figure of every quarantine end to this directory.')
+@click.option('--workers', default=1, help='Number of processes rendering the figures written to files.')
 def simulate_quarantine_end(parameters_path: str, simulation_duration: int = 100, offset: int = 0,
-                            top_lim: Optional[int] = None):
+                            top_lim: Optional[int] = None, piecewise: bool = False, profile: bool = False,
+                            output_path: Optional[str] = None, figures_dir: Optional[str] = None, workers: int = 1):
     with open(parameters_path) as data_file:
         parameters = json.load(data_file)
 
+    # The listed durations are those of the last phase, the second one of the original model.
+    quarantine_2_durations = [quarantine_2_duration for quarantine_2_duration, _ in
+                              parameters["quarantine_2_duration_list"]]
+    model = PartitionedModel.from_parameters(dict(parameters, quarantine_2_duration=max(quarantine_2_durations)))
+    with instrumentation.maybe_profiling(profile):
+        results_list = model.solve_last_phase_ends(model.initial_state_from_parameters(parameters),
+                                                   quarantine_2_durations, simulation_duration=simulation_duration,
+                                                   piecewise=piecewise)
     result_list = []
-    for quarantine_2_duration, date in parameters["quarantine_2_duration_list"]:
-        results = solve_ode(sm0=parameters["suspected_medical_initial"],
-                            se0=parameters["suspected_essential_initial"],
-                            so0=parameters["suspected_others_initial"],
-                            e0=parameters["exposed_initial"],
-                            i0=parameters["infected_initial"],
-                            q0=parameters["quarantined_initial"],
-                            r0=parameters["recovered_initial"],
-                            d0=parameters["deceased_initial"],
-                            quarantine_start=parameters["quarantine_start"],
-                            quarantine_1_duration=parameters["quarantine_1_duration"],
-                            quarantine_2_duration=quarantine_2_duration,
-                            simulation_duration=simulation_duration,
-                            gamma=parameters["gamma"],
-                            m_gamma_reduction_1=parameters["gamma"] / parameters["gamma_m_1"],
-                            e_gamma_reduction_1=parameters["gamma"] / parameters["gamma_e_1"],
-                            o_gamma_reduction_1=parameters["gamma"] / parameters["gamma_o_1"],
-                            m_gamma_reduction_2=parameters["gamma_m_1"] / parameters["gamma_m_2"],
-                            e_gamma_reduction_2=parameters["gamma_e_1"] / parameters["gamma_e_2"],
-                            o_gamma_reduction_2=parameters["gamma_o_1"] / parameters["gamma_o_2"],
-                            alpha=parameters["alpha"],
-                            delta=parameters["delta"],
-                            sigma=parameters["sigma"],
-                            r_i=parameters["r_i"],
-                            r_q=parameters["r_q"],
-                            d_i=parameters["d_i"],
-                            d_q=parameters["d_q"])
-        end_day = parameters["quarantine_start"] + parameters["quarantine_1_duration"] + quarantine_2_duration
+    for results, (quarantine_2_duration, date) in zip(results_list, parameters["quarantine_2_duration_list"]):
+        end_day = model.phase_boundaries[-2] + quarantine_2_duration
         result_list.append((results, date, end_day))
 
-    show_multiple_results(result_list, offset=offset, top_lim=top_lim,
-                          gt_data=parameters.get('gt_data', None))
+    # matplotlib is only imported by runs that plot.
+    from visualization import render_figures, show_multiple_results
+    gt_data = parameters.get('gt_data', None)
+    combined = dict(result_list=result_list, offset=offset, top_lim=top_lim, gt_data=gt_data,
+                    output_path=output_path)
+    if figures_dir is None:
+        show_multiple_results(**combined)
+        return
+    os.makedirs(figures_dir, exist_ok=True)
+    jobs = [('results', dict(result_list=results, gt_data=gt_data, title=f'Quarantine end {date} (day {end_day})',
+                             output_path=os.path.join(figures_dir, f'quarantine_end_{end_day}.png')))
+            for results, date, end_day in result_list]
+    if output_path is not None:
+        jobs.insert(0, ('multiple_results', combined))
+    render_figures(jobs, workers=workers)
+    if output_path is None:
+        show_multiple_results(**combined)
 
 
 if __name__ == '__main__':
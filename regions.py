@@ -0,0 +1,224 @@
+import csv
+import glob
+import json
+import multiprocessing
+import os
+import time
+from multiprocessing import connection
+from typing import Dict, List, Optional, Tuple
+
+import click
+
+from fit_cache import FitCache
+from model_fitting import FitProblem, FitTimeout, get_optimal_parameters
+from partitioned_model import PartitionedModel
+from trajectory import Trajectory
+
+SUMMARY_COLUMNS = ['region', 'status', 'loss', 'seconds', 'parameters_path', 'error']
+# Durations of the second quarantine phase written to the parameters files for quarantine-end-prediction, unless the
+# dataset gives its own quarantine_2_duration_list. They are those of data/spain_trained_parameters.json.
+QUARANTINE_2_DURATIONS = (18, 48, 78, 108, 137)
+# Seconds past the timeout after which a worker that has not given up on its fit is killed.
+KILL_GRACE = 10.
+# Seconds between two checks of the running fits.
+POLL_INTERVAL = 1.
+
+
+@click.command('fit-regions')
+@click.option('--data-dir', help='Directory whose json files are fitted, one region per file.')
+@click.option('--manifest', help='Json manifest, either a list of dataset paths or a {region: path} object. '
+                                 'Relative paths are read from the manifest directory.')
+@click.option('--output-dir', default='regions_output', help='Directory where parameters and summary are written.')
+@click.option('--workers', default=1, help='Number of processes running fits.')
+@click.option('--timeout', type=float, help='Seconds after which a fit is abandoned.')
+@click.option('--piecewise', is_flag=True, help='Integrate each quarantine phase in a single solver call.')
+@click.option('--time-weighting', type=click.Choice(['constant', 'linear', 'quadratic']), default='constant',
+              help='Weight of each day in the loss.')
+@click.option('--gradient', is_flag=True, help='Use exact gradients from the forward sensitivity equations.')
+@click.option('--cache-dir', default='.fit_cache', help='Directory where fitted parameters are cached.')
+@click.option('--no-cache', is_flag=True, help='Refit even if the same fit is cached.')
+@click.option('--no-figures', is_flag=True, help='Do not write a figure of every fit.')
+def click_fit_regions(data_dir: Optional[str] = None, manifest: Optional[str] = None,
+                      output_dir: str = 'regions_output', workers: int = 1, timeout: Optional[float] = None,
+                      piecewise: bool = False, time_weighting: str = 'constant', gradient: bool = False,
+                      cache_dir: str = '.fit_cache', no_cache: bool = False, no_figures: bool = False):
+    if (data_dir is None) == (manifest is None):
+        raise click.UsageError('Give exactly one of --data-dir and --manifest.')
+    datasets = read_manifest(manifest) if manifest is not None else datasets_in_directory(data_dir)
+    summary = fit_regions(datasets, output_dir=output_dir, workers=workers, timeout=timeout,
+                          cache_dir=None if no_cache else cache_dir, figures=not no_figures, piecewise=piecewise,
+                          time_weighting=time_weighting, gradient=gradient)
+
+    print('\nregion\tstatus\tloss\tseconds')
+    for row in summary:
+        loss = '' if row['loss'] is None else f'{row["loss"]:.4f}'
+        print(f'{row["region"]}\t{row["status"]}\t{loss}\t{row["seconds"]:.1f}')
+    if any(row['status'] != 'ok' for row in summary):
+        raise SystemExit(1)
+
+
+# (region, path) of every json file in data_dir, the region being the file name without extension.
+def datasets_in_directory(data_dir: str) -> List[Tuple[str, str]]:
+    paths = sorted(glob.glob(os.path.join(data_dir, '*.json')))
+    return [(os.path.splitext(os.path.basename(path))[0], path) for path in paths]
+
+
+def read_manifest(manifest_path: str) -> List[Tuple[str, str]]:
+    with open(manifest_path) as manifest_file:
+        manifest = json.load(manifest_file)
+    if isinstance(manifest, dict):
+        entries = list(manifest.items())
+    else:
+        entries = [(os.path.splitext(os.path.basename(path))[0], path) for path in manifest]
+    base_dir = os.path.dirname(os.path.abspath(manifest_path))
+    return [(region, os.path.join(base_dir, path)) for region, path in entries]
+
+
+# Fit one region and write its parameters file. Every failure is caught and reported in the returned summary row, so
+# one bad dataset does not stop the others.
+def fit_region(region: str, data_path: str, output_dir: str, timeout: Optional[float] = None,
+               cache_dir: Optional[str] = None, **fit_kwargs) -> Dict:
+    start = time.perf_counter()
+    row = dict(region=region, status='ok', loss=None, parameters_path=None, error='')
+    try:
+        cache = FitCache(cache_dir) if cache_dir is not None else None
+        parameters = get_optimal_parameters(data_path=data_path, verbose=False, cache=cache, timeout=timeout,
+                                            **fit_kwargs)
+        with open(data_path) as data_file:
+            gt_data = json.load(data_file)
+        problem = FitProblem(gt_data, piecewise=fit_kwargs.get('piecewise', False),
+                             time_weighting=fit_kwargs.get('time_weighting', 'constant'))
+        row['loss'] = float(problem.objective_function(problem.vector(parameters)))
+        row['parameters_path'] = os.path.join(output_dir, f'{region}_trained_parameters.json')
+        with open(row['parameters_path'], 'w') as parameters_file:
+            json.dump(trained_parameters(parameters, gt_data), parameters_file, indent=2)
+    except FitTimeout:
+        row['status'] = 'timeout'
+    except Exception as error:
+        row['status'] = 'failed'
+        row['error'] = f'{type(error).__name__}: {error}'
+    row['seconds'] = time.perf_counter() - start
+    return row
+
+
+# Parameters file in the format of data/spain_trained_parameters.json: the last quarantine phase is left open and
+# quarantine_2_duration_list holds the (duration, label) ends that quarantine-end-prediction compares. Without a list
+# in the dataset, QUARANTINE_2_DURATIONS are labelled with the day the quarantine ends.
+def trained_parameters(parameters: Dict, gt_data: Dict) -> Dict:
+    quarantine_2_start = PartitionedModel.from_parameters(parameters).phase_boundaries[-2]
+    parameters = {key: value for key, value in parameters.items() if key != 'quarantine_2_duration'}
+    quarantine_2_duration_list = gt_data.get('quarantine_2_duration_list',
+                                             [[duration, f'day {quarantine_2_start + duration}']
+                                              for duration in QUARANTINE_2_DURATIONS])
+    parameters['quarantine_2_duration_list'] = quarantine_2_duration_list
+    parameters['quarantine_2_duration_list_aux'] = gt_data.get('quarantine_2_duration_list_aux',
+                                                               quarantine_2_duration_list[-1:])
+    parameters['gt_data_occluded'] = gt_data['epidemic_evolution']
+    return parameters
+
+
+def _failed_row(region: str, error: str, status: str = 'failed', seconds: float = 0.) -> Dict:
+    return dict(region=region, status=status, loss=None, seconds=seconds, parameters_path=None, error=error)
+
+
+# Fit every (region, data path) of datasets over workers processes, each fit abandoned after timeout seconds. Writes
+# <region>_trained_parameters.json files (see trained_parameters) and summary.csv to output_dir and, with figures, a
+# <region>_fit.png figure of every successful fit, rendered over workers processes too. Returns the summary rows in
+# the order of datasets.
+def fit_regions(datasets: List[Tuple[str, str]], output_dir: str = 'regions_output', workers: int = 1,
+                timeout: Optional[float] = None, cache_dir: Optional[str] = '.fit_cache', figures: bool = False,
+                **fit_kwargs) -> List[Dict]:
+    regions = [region for region, _ in datasets]
+    assert len(set(regions)) == len(regions), 'Region names must be unique.'
+    os.makedirs(output_dir, exist_ok=True)
+
+    if workers > 1:
+        rows = _fit_regions_in_processes(datasets, output_dir, workers, timeout, cache_dir, fit_kwargs)
+    else:
+        rows = {}
+        for region, data_path in datasets:
+            rows[region] = fit_region(region, data_path, output_dir, timeout=timeout, cache_dir=cache_dir,
+                                      **fit_kwargs)
+
+    summary = [rows[region] for region in regions]
+    with open(os.path.join(output_dir, 'summary.csv'), 'w', newline='') as summary_file:
+        writer = csv.DictWriter(summary_file, fieldnames=SUMMARY_COLUMNS)
+        writer.writeheader()
+        writer.writerows(summary)
+
+    if figures:
+        # matplotlib is only imported by runs that plot.
+        from visualization import render_figures
+        render_figures([fit_figure_job(row['region'], data_path, row['parameters_path'], output_dir, fit_kwargs)
+                        for row, (_, data_path) in zip(summary, datasets) if row['status'] == 'ok'], workers=workers)
+    return summary
+
+
+# render_figures job drawing the trajectory of the parameters in parameters_path over the data in data_path.
+def fit_figure_job(region: str, data_path: str, parameters_path: str, output_dir: str,
+                   fit_kwargs: Dict) -> Tuple[str, Dict]:
+    with open(data_path) as data_file:
+        gt_data = json.load(data_file)
+    with open(parameters_path) as parameters_file:
+        parameters = json.load(parameters_file)
+    problem = FitProblem(gt_data, piecewise=fit_kwargs.get('piecewise', False),
+                         time_weighting=fit_kwargs.get('time_weighting', 'constant'))
+    trajectory = problem.solve(problem.vector(parameters))
+    return 'results', dict(result_list=Trajectory(trajectory.values * problem.n / problem.total),
+                           gt_data=gt_data['epidemic_evolution'], title=f'{region} fit',
+                           output_path=os.path.join(output_dir, f'{region}_fit.png'))
+
+
+def _fit_region_in_process(sender: connection.Connection, region: str, data_path: str, output_dir: str,
+                           timeout: Optional[float], cache_dir: Optional[str], fit_kwargs: Dict):
+    sender.send(fit_region(region, data_path, output_dir, timeout=timeout, cache_dir=cache_dir, **fit_kwargs))
+    sender.close()
+
+
+# Fits of fit_regions, each in a process of its own, at most workers at a time. The timeout is first left to the fit
+# itself, which raises FitTimeout; a process still busy KILL_GRACE seconds later is killed. A process that dies
+# without sending its row only fails its own region.
+def _fit_regions_in_processes(datasets: List[Tuple[str, str]], output_dir: str, workers: int,
+                              timeout: Optional[float], cache_dir: Optional[str], fit_kwargs: Dict) -> Dict[str, Dict]:
+    rows = {}
+    pending = list(datasets)
+    running = {}
+    while pending or running:
+        while pending and len(running) < workers:
+            region, data_path = pending.pop(0)
+            receiver, sender = multiprocessing.Pipe(duplex=False)
+            process = multiprocessing.Process(target=_fit_region_in_process, daemon=True,
+                                              args=(sender, region, data_path, output_dir, timeout, cache_dir,
+                                                    fit_kwargs))
+            process.start()
+            sender.close()
+            running[region] = process, receiver, time.perf_counter()
+
+        connection.wait([receiver for _, receiver, _ in running.values()]
+                        + [process.sentinel for process, _, _ in running.values()], timeout=POLL_INTERVAL)
+        now = time.perf_counter()
+        for region, (process, receiver, started) in list(running.items()):
+            if receiver.poll():
+                try:
+                    rows[region] = receiver.recv()
+                except EOFError:
+                    # The process exited without sending its row.
+                    pass
+            if region not in rows:
+                if process.is_alive():
+                    if timeout is None or now - started <= timeout + KILL_GRACE:
+                        continue
+                    process.kill()
+                    rows[region] = _failed_row(region, f'Killed after {now - started:.0f} s.', status='timeout',
+                                               seconds=now - started)
+                else:
+                    rows[region] = _failed_row(region, f'The worker process died with exit code {process.exitcode}.',
+                                               seconds=now - started)
+            process.join()
+            receiver.close()
+            del running[region]
+    return rows
+
+
+if __name__ == '__main__':
+    click_fit_regions()
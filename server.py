@@ -0,0 +1,347 @@
+import asyncio
+import functools
+import glob
+import itertools
+import json
+import os
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from http import HTTPStatus
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import click
+
+from fit_cache import FitCache
+from model_fitting import FitTimeout, get_optimal_parameters
+from ode_solving import PRESETS, IntegrationError, solve_ode
+from parameter_sets import PARAMETER_KEYS, solve_kwargs
+from trajectory import COMPARTMENTS
+
+# Keys a parameter set must have. Without quarantine_2_duration the second quarantine phase never ends.
+REQUIRED_PARAMETERS = [name for name in PARAMETER_KEYS if name != 'quarantine_2_duration']
+FIT_OPTIONS = ('piecewise', 'time_weighting', 'gradient', 'preset', 'timeout')
+
+
+@click.command('serve')
+@click.option('--host', default='127.0.0.1', help='Address the HTTP server listens on.')
+@click.option('--port', default=8765, help='Port the HTTP server listens on.')
+@click.option('--unix-socket', help='Listen on this Unix socket instead of a TCP port.')
+@click.option('--parameters-dir', default='data', help='Directory whose trained parameters json files are loaded.')
+@click.option('--workers', default=1, help='Number of processes solving scenarios.')
+@click.option('--fit-workers', default=1, help='Number of processes running queued fits.')
+@click.option('--cache-size', default=1024, help='Number of responses kept in the LRU response cache.')
+@click.option('--cache-dir', default='.fit_cache', help='Directory where fitted parameters are cached.')
+def click_serve(host: str = '127.0.0.1', port: int = 8765, unix_socket: Optional[str] = None,
+                parameters_dir: str = 'data', workers: int = 1, fit_workers: int = 1, cache_size: int = 1024,
+                cache_dir: str = '.fit_cache'):
+    parameter_sets = load_parameter_sets(parameters_dir)
+    print(f'Loaded {len(parameter_sets)} parameter sets: {", ".join(sorted(parameter_sets))}')
+    service = PredictionService(parameter_sets, workers=workers, fit_workers=fit_workers, cache_size=cache_size,
+                                cache_dir=cache_dir)
+    try:
+        asyncio.run(serve(service, host=host, port=port, unix_socket=unix_socket))
+    except KeyboardInterrupt:
+        pass
+
+
+# Trained parameters json files of parameters_dir, keyed by file name without extension and without the
+# _trained_parameters suffix. Files that are not valid json or lack any of REQUIRED_PARAMETERS, such as training data,
+# are skipped.
+def load_parameter_sets(parameters_dir: str) -> Dict[str, Dict]:
+    parameter_sets = {}
+    for path in sorted(glob.glob(os.path.join(parameters_dir, '*.json'))):
+        try:
+            with open(path) as parameters_file:
+                parameters = json.load(parameters_file)
+        except ValueError:
+            continue
+        if isinstance(parameters, dict) and all(name in parameters for name in REQUIRED_PARAMETERS):
+            name = os.path.splitext(os.path.basename(path))[0]
+            if name.endswith('_trained_parameters'):
+                name = name[:-len('_trained_parameters')]
+            parameter_sets[name] = parameters
+    return parameter_sets
+
+
+# Solve one scenario in a worker process. Returns the requested compartments of every day.
+def solve_scenario(parameters: Dict, simulation_duration: int, piecewise: bool, preset: Optional[str],
+                   compartments: Sequence[str]) -> Dict:
+    trajectory = solve_ode(**solve_kwargs(parameters, simulation_duration, piecewise=piecewise),
+                           **PRESETS.get(preset, {}), on_failure='raise')
+    response = {'days': len(trajectory), 'series': {name: trajectory[name].tolist() for name in compartments}}
+    if trajectory.event is not None:
+        response.update(event=trajectory.event, event_day=trajectory.event_day)
+    return response
+
+
+def run_fit(data_path: str, cache_dir: Optional[str], **fit_options) -> Dict:
+    cache = FitCache(cache_dir) if cache_dir is not None else None
+    return get_optimal_parameters(data_path=data_path, verbose=False, cache=cache, **fit_options)
+
+
+# A request the service rejects, answered with status and the message as error.
+class RequestError(Exception):
+    def __init__(self, status: HTTPStatus, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+# LRU map from request keys to the futures of their responses. Identical requests arriving while the first one is
+# still being solved wait on the same future instead of solving again.
+class ResponseCache:
+    def __init__(self, size: int = 1024):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def get(self, key: str) -> Optional[asyncio.Future]:
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self._entries[key]
+        self.misses += 1
+        return None
+
+    def put(self, key: str, future: asyncio.Future):
+        if self.size > 0:
+            self._entries[key] = future
+            if len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def discard(self, key: str):
+        self._entries.pop(key, None)
+
+    def stats(self) -> Dict[str, int]:
+        return {'size': len(self._entries), 'capacity': self.size, 'hits': self.hits, 'misses': self.misses}
+
+
+# State of the server: the parameter sets held in memory, the response cache, a process pool solving scenarios and a
+# queue of fit jobs consumed by fit_workers tasks, each running get_optimal_parameters in a separate process pool so
+# long fits never hold up scenario queries.
+class PredictionService:
+    def __init__(self, parameter_sets: Dict[str, Dict], workers: int = 1, fit_workers: int = 1,
+                 cache_size: int = 1024, cache_dir: Optional[str] = '.fit_cache'):
+        self.parameter_sets = dict(parameter_sets)
+        self.workers = workers
+        self.fit_workers = fit_workers
+        self.cache = ResponseCache(cache_size)
+        self.cache_dir = cache_dir
+        self.jobs = OrderedDict()
+        self._job_ids = itertools.count(1)
+        self._solve_pool = None
+        self._fit_pool = None
+        self._fit_queue = None
+        self._fit_tasks = []
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        self._solve_pool = ProcessPoolExecutor(max_workers=self.workers)
+        self._fit_pool = ProcessPoolExecutor(max_workers=self.fit_workers)
+        self._fit_queue = asyncio.Queue()
+        self._fit_tasks = [asyncio.create_task(self._run_fits()) for _ in range(self.fit_workers)]
+        # Start the solver processes now, so the first queries do not pay for it.
+        await asyncio.gather(*(loop.run_in_executor(self._solve_pool, os.getpid) for _ in range(self.workers)))
+
+    async def close(self):
+        for task in self._fit_tasks:
+            task.cancel()
+        await asyncio.gather(*self._fit_tasks, return_exceptions=True)
+        for pool in (self._solve_pool, self._fit_pool):
+            if pool is not None:
+                pool.shutdown(wait=False, cancel_futures=True)
+
+    def _parameters(self, request: Dict) -> Tuple[Optional[str], Dict]:
+        parameters = request.get('parameters')
+        name = None
+        if isinstance(parameters, str):
+            name = parameters
+            if name not in self.parameter_sets:
+                raise RequestError(HTTPStatus.NOT_FOUND, f'Unknown parameter set {name}.')
+            parameters = self.parameter_sets[name]
+        elif not isinstance(parameters, dict):
+            raise RequestError(HTTPStatus.BAD_REQUEST, 'parameters must be a parameter set name or an object.')
+        overrides = request.get('overrides', {})
+        unknown = [key for key in overrides if key not in PARAMETER_KEYS]
+        if unknown:
+            raise RequestError(HTTPStatus.BAD_REQUEST, f'Cannot override {", ".join(unknown)}.')
+        parameters = {key: value for key, value in dict(parameters, **overrides).items() if key in PARAMETER_KEYS}
+        missing = [key for key in REQUIRED_PARAMETERS if key not in parameters]
+        if missing:
+            raise RequestError(HTTPStatus.BAD_REQUEST, f'Missing parameters {", ".join(missing)}.')
+        return name, parameters
+
+    # Answer a scenario query: {"parameters": name or object, "overrides": {...}, "simulation_duration": days,
+    # "piecewise": bool, "preset": name, "compartments": [...]}. Only the values that reach the solver are part of the
+    # cache key, so replacing a parameter set never serves stale responses.
+    async def solve(self, request: Dict) -> Dict:
+        name, parameters = self._parameters(request)
+        simulation_duration = request.get('simulation_duration', 100)
+        piecewise = bool(request.get('piecewise', False))
+        preset = request.get('preset')
+        compartments = request.get('compartments', list(COMPARTMENTS))
+        if not isinstance(simulation_duration, int) or simulation_duration < 0:
+            raise RequestError(HTTPStatus.BAD_REQUEST, 'simulation_duration must be a non negative integer.')
+        if preset is not None and preset not in PRESETS:
+            raise RequestError(HTTPStatus.BAD_REQUEST, f'preset must be one of {", ".join(PRESETS)}.')
+        unknown = [compartment for compartment in compartments if compartment not in COMPARTMENTS]
+        if unknown:
+            raise RequestError(HTTPStatus.BAD_REQUEST, f'Unknown compartments {", ".join(unknown)}.')
+
+        key = json.dumps([parameters, simulation_duration, piecewise, preset, compartments], sort_keys=True)
+        future = self.cache.get(key)
+        cached = future is not None
+        if future is None:
+            future = asyncio.get_running_loop().run_in_executor(
+                self._solve_pool, solve_scenario, parameters, simulation_duration, piecewise, preset, compartments)
+            self.cache.put(key, future)
+        try:
+            response = await asyncio.shield(future)
+        except IntegrationError as error:
+            self.cache.discard(key)
+            raise RequestError(HTTPStatus.UNPROCESSABLE_ENTITY, str(error))
+        except Exception:
+            self.cache.discard(key)
+            raise
+        return dict(response, parameters=name, cached=cached)
+
+    # Queue a fit: {"data_path": path, "name": parameter set name, and any of FIT_OPTIONS}. When name is given, the
+    # fitted parameters become that parameter set once the fit is done.
+    def submit_fit(self, request: Dict) -> Dict:
+        data_path = request.get('data_path')
+        if not isinstance(data_path, str) or not os.path.isfile(data_path):
+            raise RequestError(HTTPStatus.BAD_REQUEST, 'data_path must be an existing json file.')
+        if request.get('preset') is not None and request['preset'] not in PRESETS:
+            raise RequestError(HTTPStatus.BAD_REQUEST, f'preset must be one of {", ".join(PRESETS)}.')
+        job_id = str(next(self._job_ids))
+        self.jobs[job_id] = dict(id=job_id, status='queued', data_path=data_path, name=request.get('name'),
+                                 options={key: request[key] for key in FIT_OPTIONS if key in request},
+                                 seconds=None, error=None, parameters=None)
+        self._fit_queue.put_nowait(job_id)
+        return self.job_status(job_id)
+
+    def job_status(self, job_id: str) -> Dict:
+        if job_id not in self.jobs:
+            raise RequestError(HTTPStatus.NOT_FOUND, f'Unknown fit job {job_id}.')
+        return dict(self.jobs[job_id])
+
+    async def _run_fits(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            job = self.jobs[await self._fit_queue.get()]
+            job['status'] = 'running'
+            start = time.perf_counter()
+            try:
+                job['parameters'] = await loop.run_in_executor(
+                    self._fit_pool, functools.partial(run_fit, job['data_path'], self.cache_dir, **job['options']))
+                job['status'] = 'done'
+                if job['name'] is not None:
+                    self.parameter_sets[job['name']] = job['parameters']
+            except FitTimeout:
+                job['status'] = 'timeout'
+            except Exception as error:
+                job['status'] = 'failed'
+                job['error'] = f'{type(error).__name__}: {error}'
+            job['seconds'] = time.perf_counter() - start
+
+    def status(self) -> Dict:
+        statuses = [job['status'] for job in self.jobs.values()]
+        return {'status': 'ok', 'parameter_sets': len(self.parameter_sets), 'workers': self.workers,
+                'cache': self.cache.stats(),
+                'fits': {status: statuses.count(status) for status in ('queued', 'running', 'done', 'failed',
+                                                                       'timeout')}}
+
+    def put_parameters(self, name: str, parameters: Dict) -> Dict:
+        if not isinstance(parameters, dict) or any(key not in parameters for key in REQUIRED_PARAMETERS):
+            raise RequestError(HTTPStatus.BAD_REQUEST, f'A parameter set needs {", ".join(REQUIRED_PARAMETERS)}.')
+        self.parameter_sets[name] = parameters
+        return {'name': name}
+
+    # Route a request. Returns the status and the json payload of the response.
+    async def handle(self, method: str, path: str, body: bytes) -> Tuple[HTTPStatus, Dict]:
+        parts = [part for part in path.split('?', 1)[0].split('/') if part]
+        try:
+            request = json.loads(body) if body else {}
+            if not isinstance(request, dict):
+                raise RequestError(HTTPStatus.BAD_REQUEST, 'The request body must be a json object.')
+            if parts == ['health'] and method == 'GET':
+                return HTTPStatus.OK, self.status()
+            if parts == ['parameters'] and method == 'GET':
+                return HTTPStatus.OK, {'parameter_sets': sorted(self.parameter_sets)}
+            if len(parts) == 2 and parts[0] == 'parameters' and method == 'GET':
+                if parts[1] not in self.parameter_sets:
+                    raise RequestError(HTTPStatus.NOT_FOUND, f'Unknown parameter set {parts[1]}.')
+                return HTTPStatus.OK, self.parameter_sets[parts[1]]
+            if len(parts) == 2 and parts[0] == 'parameters' and method == 'PUT':
+                return HTTPStatus.OK, self.put_parameters(parts[1], request)
+            if parts == ['solve'] and method == 'POST':
+                return HTTPStatus.OK, await self.solve(request)
+            if parts == ['fits'] and method == 'POST':
+                return HTTPStatus.ACCEPTED, self.submit_fit(request)
+            if parts == ['fits'] and method == 'GET':
+                return HTTPStatus.OK, {'fits': [self.job_status(job_id) for job_id in self.jobs]}
+            if len(parts) == 2 and parts[0] == 'fits' and method == 'GET':
+                return HTTPStatus.OK, self.job_status(parts[1])
+            raise RequestError(HTTPStatus.NOT_FOUND, f'No route for {method} {path}.')
+        except RequestError as error:
+            return error.status, {'error': str(error)}
+        except ValueError as error:
+            return HTTPStatus.BAD_REQUEST, {'error': f'Invalid request: {error}'}
+        except Exception as error:
+            return HTTPStatus.INTERNAL_SERVER_ERROR, {'error': f'{type(error).__name__}: {error}'}
+
+
+# Minimal HTTP/1.1 on top of asyncio streams: json bodies with Content-Length, and connections kept alive unless the
+# client asks otherwise, so a dashboard can send many small queries over one connection.
+async def handle_connection(service: PredictionService, reader: asyncio.StreamReader,
+                            writer: asyncio.StreamWriter):
+    try:
+        while True:
+            request_line = await reader.readline()
+            if not request_line.strip():
+                break
+            method, path, version = request_line.decode('latin-1').split()
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+            status, payload = await service.handle(method, path, body)
+            data = json.dumps(payload).encode()
+            keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+            writer.write(f'HTTP/1.1 {status.value} {status.phrase}\r\nContent-Type: application/json\r\n'
+                         f'Content-Length: {len(data)}\r\nConnection: {"keep-alive" if keep_alive else "close"}\r\n'
+                         f'\r\n'.encode('latin-1') + data)
+            await writer.drain()
+            if not keep_alive:
+                break
+    except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(service: PredictionService, host: str = '127.0.0.1', port: int = 8765,
+                unix_socket: Optional[str] = None):
+    await service.start()
+    handler = functools.partial(handle_connection, service)
+    if unix_socket is not None:
+        server = await asyncio.start_unix_server(handler, path=unix_socket)
+    else:
+        server = await asyncio.start_server(handler, host=host, port=port)
+    addresses: List[str] = [str(sock.getsockname()) for sock in server.sockets]
+    print(f'Serving on {", ".join(addresses)}')
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await service.close()
+
+
+if __name__ == '__main__':
+    click_serve()
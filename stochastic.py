@@ -0,0 +1,186 @@
+import json
+import time
+from typing import Dict, Optional, Sequence, Tuple
+
+import click
+import numpy as np
+
+from ensemble import QUANTILES
+from ode_solving import quarantine_phases, solve_ode
+from parameter_sets import solve_kwargs, state_and_par
+from partitioned_model import PartitionedModel
+from trajectory import COMPARTMENTS, Trajectory
+
+
+@click.command('stochastic')
+@click.option('--parameters-path', prompt='Parameters path', required=True, help='Trained parameters json.')
+@click.option('--simulation-duration', default=100, help='Duration of simulation.')
+@click.option('--realizations', default=1000, help='Number of realizations simulated together.')
+@click.option('--steps-per-day', default=4, help='Tau-leaping steps per day. The bias of tau-leaping grows with the '
+                                                'step, so rates of order one per day need several steps a day. The '
+                                                'run time grows in proportion: 10k realizations of 365 days take '
+                                                'about 11 s at four steps a day.')
+@click.option('--seed', type=int, help='Seed of the random generator.')
+@click.option('--results-path', help='Json file where the quantiles and extinction probabilities are written.')
+@click.option('--output-path', help='Write the figure to this png, svg or pdf file instead of showing it.')
+@click.option('--no-plot', is_flag=True, help='Only print and write the results.')
+def click_simulate_stochastic(parameters_path: str, simulation_duration: int = 100, realizations: int = 1000,
+                              steps_per_day: int = 4, seed: Optional[int] = None, results_path: Optional[str] = None,
+                              output_path: Optional[str] = None, no_plot: bool = False):
+    with open(parameters_path) as data_file:
+        parameters = json.load(data_file)
+    start = time.perf_counter()
+    results = simulate_stochastic(parameters, simulation_duration=simulation_duration, realizations=realizations,
+                                  steps_per_day=steps_per_day, seed=seed)
+    print(f'\n{realizations} realizations of {simulation_duration} days in {time.perf_counter() - start:.1f} s.')
+    print(f'Extinction probability on the last day: {results["extinction_probability"][-1]:.3f}')
+    print('\nquantile\tpeak quarantined\tfinal deceased')
+    for k, quantile in enumerate(results['quantiles']):
+        print(f'{quantile}\t{results["peak_quarantined"][k]:.0f}\t{results["final_deceased"][k]:.0f}')
+
+    if results_path is not None:
+        with open(results_path, 'w') as results_file:
+            json.dump({key: value.tolist() if isinstance(value, np.ndarray) else value
+                       for key, value in results.items()}, results_file)
+    if not no_plot:
+        # The deterministic trajectory with the stochastic bands around it. matplotlib is only imported here.
+        from visualization import show_results
+        trajectory = solve_ode(**solve_kwargs(parameters, simulation_duration))
+        show_results(trajectory, gt_data=parameters.get('gt_data'), output_path=output_path, bands=results)
+
+
+# Binomial tau-leaping counterpart of diff_equations: every realization is a vector of integer counts, and on each step
+# of 1 / steps_per_day days the individuals leaving a compartment are a binomial draw with probability
+# 1 - exp(-rate * tau), split among its destinations by further binomial draws. Counts never become negative, which a
+# Poisson leap cannot ensure in the small compartments where the stochastic model matters. Contact rates follow the
+# quarantine phases of the deterministic model, and the medical group is exposed to the quarantined through the
+# deceased compartment as in diff_equations. state0 and par are as in diff_equations, in individuals, and the initial
+# counts are drawn by initial_counts. Returns the (realizations, 8) counts of every day through callback(day, counts),
+# so the realizations are never stored per day.
+# The nine binomial draws of every step take nearly all the time, about 0.1 us per realization each, since numpy
+# sets up every draw anew when the counts differ. So each day only the realizations with exposed, infected or
+# quarantined individuals left are leapt, the others never change again, and _draw skips the compartments that are
+# empty in every realization. 10k realizations of data/spain_trained_parameters.json over 365 days still take about
+# 5.5 s at one step a day and 11 s at four on one core.
+def tau_leap(state0: Sequence[float], par: Sequence[float], simulation_duration: int, realizations: int,
+             rng: np.random.Generator, callback, steps_per_day: int = 4):
+    # (8, realizations), so every compartment is contiguous.
+    counts = initial_counts(state0, realizations, rng).T.copy()
+    n = counts.sum(axis=0)
+    tau = 1 / steps_per_day
+    # Phase of every step and leap constants of every phase, so nothing is looked up per step.
+    phases = quarantine_phases(par, simulation_duration)
+    step_phase = np.searchsorted([phase_start for phase_start, _, _, _ in phases],
+                                 np.arange(simulation_duration * steps_per_day) * tau, side='right') - 1
+    phase_probabilities = [_phase_probabilities(phase_par, tau) for _, _, _, phase_par in phases]
+    callback(0, counts.T)
+    for day in range(simulation_duration):
+        active = np.flatnonzero(counts[3:6].any(axis=0))
+        if active.size == realizations:
+            for step in range(day * steps_per_day, (day + 1) * steps_per_day):
+                counts = _leap(counts, n, phase_probabilities[step_phase[step]], tau, rng)
+        elif active.size:
+            state = counts[:, active]
+            for step in range(day * steps_per_day, (day + 1) * steps_per_day):
+                state = _leap(state, n[active], phase_probabilities[step_phase[step]], tau, rng)
+            counts[:, active] = state
+        callback(day + 1, counts.T)
+
+
+# Constants of a leap in one quarantine phase, from its phase_equations parameters: the contact rates times tau, the
+# probabilities of leaving the exposed, infected and quarantined compartments in a step, and the fractions of the
+# infected leaving to quarantine and to recovery and of the quarantined leaving to recovery.
+def _phase_probabilities(phase_par: Sequence[float], tau: float) -> Tuple:
+    gamma_m, gamma_e, gamma_o, al, _, s, ri, rq, di, dq = phase_par
+    return (gamma_m * tau, gamma_e * tau, gamma_o * tau, -np.expm1(-s * tau), -np.expm1(-(al + ri + di) * tau),
+            al / (al + ri + di) if al + ri + di > 0 else 0, ri / (ri + di) if ri + di > 0 else 0,
+            -np.expm1(-(rq + dq) * tau), rq / (rq + dq) if rq + dq > 0 else 0)
+
+
+# One leap of the (8, m) counts of m realizations with populations n.
+def _leap(state: np.ndarray, n: np.ndarray, probabilities: Tuple, tau: float, rng: np.random.Generator) -> np.ndarray:
+    (contact_m, contact_e, contact_o, p_incubated, p_left_i, p_quarantined, p_recovered_i, p_left_q,
+     p_recovered_q) = probabilities
+    sm, se, so, e, i, q, r, d = state
+    force_i = i / n
+    infected_m = _draw(rng, sm, -np.expm1(-(contact_m * force_i + d / n * q / n * tau)))
+    infected_e = _draw(rng, se, -np.expm1(-contact_e * force_i))
+    infected_o = _draw(rng, so, -np.expm1(-contact_o * force_i))
+    incubated = _draw(rng, e, p_incubated)
+    left_i = _draw(rng, i, p_left_i)
+    quarantined = _draw(rng, left_i, p_quarantined)
+    recovered_i = _draw(rng, left_i - quarantined, p_recovered_i)
+    left_q = _draw(rng, q, p_left_q)
+    recovered_q = _draw(rng, left_q, p_recovered_q)
+
+    return np.stack([sm - infected_m, se - infected_e, so - infected_o,
+                     e + infected_m + infected_e + infected_o - incubated,
+                     i + incubated - left_i,
+                     q + quarantined - left_q,
+                     r + recovered_i + recovered_q,
+                     d + left_i - quarantined - recovered_i + left_q - recovered_q])
+
+
+# Binomial draws of counts leaving with probability p, skipped when every count is 0: numpy spends nearly as long on
+# an empty compartment as on a full one.
+def _draw(rng: np.random.Generator, counts: np.ndarray, p) -> np.ndarray:
+    if not counts.any():
+        return np.zeros_like(counts)
+    return rng.binomial(counts, p)
+
+
+# Integer initial counts of every realization. A fitted state has fractions of individuals, and rounding them would
+# bias the extinction probability: 0.4 initial infected would never start an epidemic and 0.6 always would. Each count
+# is the integer part plus a Bernoulli draw on the fractional part, so every compartment keeps its expected value.
+def initial_counts(state0: Sequence[float], realizations: int, rng: np.random.Generator) -> np.ndarray:
+    state0 = np.asarray(state0, dtype=np.float64)
+    whole = np.floor(state0)
+    return (whole + (rng.random((realizations, state0.size)) < state0 - whole)).astype(np.int64)
+
+
+# Simulate realizations of the model of a trained parameters json (see parameter_sets.solve_kwargs) with tau_leap.
+# Returns a dict with the quantiles, the number of realizations and, for every compartment, a (quantiles, days) array
+# of exact per-day quantiles over the realizations. extinction_probability holds, for every day, the fraction of
+# realizations without exposed, infected or quarantined individuals left, which is final since nobody can be infected
+# any more.
+# peak_quarantined and final_deceased are quantiles of the per-realization peak and last value. Parameters of other
+# groups or phases than those of the original model (see partitioned_model) raise a ValueError.
+def simulate_stochastic(parameters: Dict, simulation_duration: int = 100, realizations: int = 1000,
+                        steps_per_day: int = 4, seed: Optional[int] = None,
+                        quantiles: Sequence[float] = QUANTILES) -> Dict:
+    if not PartitionedModel.from_parameters(parameters).legacy:
+        raise ValueError('Only the medical, essential and others groups with the two quarantine phases of the original '
+                         'model can be simulated stochastically.')
+    state0, par = state_and_par(solve_kwargs(parameters, simulation_duration))
+
+    bands = np.empty((len(quantiles), simulation_duration + 1, len(COMPARTMENTS)))
+    extinction_probability = np.empty(simulation_duration + 1)
+    peak_quarantined = np.zeros(realizations)
+    final_deceased = np.zeros(realizations)
+    # Linear interpolation between order statistics, as np.quantile does, on a single sort per day.
+    positions = np.asarray(quantiles, dtype=np.float64) * (realizations - 1)
+    below = np.floor(positions).astype(int)
+    above = np.minimum(below + 1, realizations - 1)
+    fraction = (positions - below)[:, None]
+
+    def record(day: int, counts: np.ndarray):
+        values = np.sort(Trajectory.from_states(counts, 1).values, axis=0)
+        bands[:, day] = values[below] * (1 - fraction) + values[above] * fraction
+        extinction_probability[day] = np.mean(counts[:, 3:6].sum(axis=1) == 0)
+        np.maximum(peak_quarantined, counts[:, 5], out=peak_quarantined)
+        final_deceased[:] = counts[:, 7]
+
+    tau_leap(state0, par, simulation_duration, realizations, np.random.default_rng(seed), record,
+             steps_per_day=steps_per_day)
+
+    results = {'quantiles': list(quantiles), 'realizations': realizations}
+    for k, compartment in enumerate(COMPARTMENTS):
+        results[compartment] = bands[:, :, k]
+    results['extinction_probability'] = extinction_probability
+    results['peak_quarantined'] = np.quantile(peak_quarantined, quantiles)
+    results['final_deceased'] = np.quantile(final_deceased, quantiles)
+    return results
+
+
+if __name__ == '__main__':
+    click_simulate_stochastic()
@@ -0,0 +1,183 @@
+import csv
+import itertools
+import json
+import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+import click
+import numpy as np
+
+from ode_solving import PRESETS, solve_ode
+from parameter_sets import PARAMETER_KEYS, sample_box, solve_kwargs
+from trajectory import COMPARTMENT_INDEX, COMPARTMENTS
+
+METRICS = ['peak_quarantined', 'peak_day', 'final_deceased', 'extinction_day']
+
+
+@click.command('sweep')
+@click.option('--parameters-path', prompt='Parameters path', required=True,
+              help='Trained parameters json with the values that are not swept.')
+@click.option('--grid', 'grid_specs', multiple=True,
+              help='name=v1,v2,... or name=start:stop:num. The grids of every --grid are combined.')
+@click.option('--range', 'range_specs', multiple=True, help='name=low:high, sampled --samples times.')
+@click.option('--samples', default=0, help='Number of points sampled within the --range bounds.')
+@click.option('--sampling', type=click.Choice(['sobol', 'lhs']), default='sobol',
+              help='How points are sampled within the --range bounds.')
+@click.option('--seed', type=int, help='Seed of the sampling.')
+@click.option('--simulation-duration', default=100, help='Duration of simulation.')
+@click.option('--output-dir', default='sweep_output', help='Directory where results are written.')
+@click.option('--trajectories', is_flag=True, help='Also write the daily trajectories as npz files.')
+@click.option('--workers', default=1, help='Number of processes running scenarios.')
+@click.option('--chunk-size', default=64, help='Number of scenarios sent to a worker at once.')
+@click.option('--extinction-start', default=20, help='First day on which the epidemic may be considered extinct.')
+@click.option('--piecewise', is_flag=True, help='Integrate each quarantine phase in a single solver call.')
+@click.option('--preset', type=click.Choice(list(PRESETS)), help='Integrator settings, fast being meant for scans.')
+@click.option('--jit', is_flag=True,
+              help='Use the compiled right hand side. Without numba the ordinary one is used.')
+def run_sweep(parameters_path: str, grid_specs: Sequence[str] = (), range_specs: Sequence[str] = (),
+              samples: int = 0, sampling: str = 'sobol', seed: Optional[int] = None,
+              simulation_duration: int = 100, output_dir: str = 'sweep_output', trajectories: bool = False,
+              workers: int = 1, chunk_size: int = 64, extinction_start: int = 20, piecewise: bool = False,
+              preset: Optional[str] = None, jit: bool = False):
+    with open(parameters_path) as data_file:
+        parameters = json.load(data_file)
+    grid = dict(parse_grid(spec) for spec in grid_specs)
+    ranges = dict(parse_range(spec) for spec in range_specs)
+    n_scenarios = sweep(parameters, grid=grid, ranges=ranges, samples=samples, sampling=sampling, seed=seed,
+                        simulation_duration=simulation_duration, output_dir=output_dir, trajectories=trajectories,
+                        workers=workers, chunk_size=chunk_size, extinction_start=extinction_start,
+                        piecewise=piecewise, preset=preset, jit=jit)
+    print(f'{n_scenarios} scenarios written to {output_dir}')
+
+
+def _check_name(name: str) -> str:
+    if name not in PARAMETER_KEYS:
+        raise click.BadParameter(f'{name} cannot be swept. Choose among {", ".join(PARAMETER_KEYS)}.')
+    return name
+
+
+def parse_grid(spec: str) -> Tuple[str, List[float]]:
+    name, values = spec.split('=', 1)
+    if ':' in values:
+        start, stop, num = values.split(':')
+        return _check_name(name), list(np.linspace(float(start), float(stop), int(num)))
+    return _check_name(name), [float(value) for value in values.split(',')]
+
+
+def parse_range(spec: str) -> Tuple[str, Tuple[float, float]]:
+    name, bounds = spec.split('=', 1)
+    low, high = bounds.split(':')
+    return _check_name(name), (float(low), float(high))
+
+
+# Swept values of every scenario, in order: the Cartesian product of the grids, each combined with every sampled
+# point of the ranges. Scenarios are generated lazily, so large grids are never held in memory.
+def scenarios(grid: Dict[str, Sequence[float]], ranges: Dict[str, Tuple[float, float]], samples: int = 0,
+              sampling: str = 'sobol', seed: Optional[int] = None) -> Iterator[Tuple[float, ...]]:
+    points = [()]
+    if ranges:
+        lower, upper = np.array(list(ranges.values()), dtype=np.float64).T
+        points = [tuple(point) for point in sample_box(lower, upper, samples, sampling=sampling, seed=seed)]
+    for grid_point in itertools.product(*grid.values()):
+        for point in points:
+            yield tuple(grid_point) + point
+
+
+# Summary metrics of an (N, days, compartments) array. Days past a failed integration are NaN. The extinction day is the
+# first day from extinction_start with less than one exposed and infected individual, -1 if there is none.
+def scenario_metrics(values: np.ndarray, extinction_start: int = 20) -> np.ndarray:
+    quarantined = np.nan_to_num(values[:, :, COMPARTMENT_INDEX['quarantined']], nan=-np.inf)
+    peak_day = quarantined.argmax(axis=1)
+    peak_quarantined = quarantined[np.arange(len(values)), peak_day]
+    last_day = (~np.isnan(values[:, :, 0])).sum(axis=1) - 1
+    final_deceased = values[np.arange(len(values)), last_day, COMPARTMENT_INDEX['deceased']]
+    active = values[:, :, COMPARTMENT_INDEX['exposed']] + values[:, :, COMPARTMENT_INDEX['infected']]
+    extinct = active < 1
+    extinct[:, :extinction_start] = False
+    extinction_day = np.where(extinct.any(axis=1), extinct.argmax(axis=1), -1)
+    return np.stack([peak_quarantined, peak_day, final_deceased, extinction_day], axis=1)
+
+
+def _run_chunk(parameters: Dict, names: Sequence[str], indices: Sequence[int], points: Sequence[Tuple[float, ...]],
+               simulation_duration: int, extinction_start: int, piecewise: bool, keep_trajectories: bool,
+               solver_options: Dict):
+    values = np.full((len(points), simulation_duration + 1, len(COMPARTMENTS)), np.nan)
+    for k, point in enumerate(points):
+        scenario = dict(parameters, **dict(zip(names, point)))
+        trajectory = solve_ode(**solve_kwargs(scenario, simulation_duration, piecewise=piecewise), **solver_options)
+        values[k, :len(trajectory)] = trajectory.values
+    metrics = scenario_metrics(values, extinction_start=extinction_start)
+    return indices, points, metrics, values if keep_trajectories else None
+
+
+def _chunks(iterable: Iterator, size: int) -> Iterator[Tuple[List[int], List]]:
+    iterator = enumerate(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        indices, items = zip(*chunk)
+        yield list(indices), list(items)
+
+
+# Run every scenario of the sweep and stream the results to output_dir as chunks finish: scenarios.csv holds the
+# swept values and the metrics of each scenario, trajectories_<chunk>.npz the daily values of the chunk (optional) and
+# sweep.json the settings. At most two chunks per worker are in flight. Scenarios whose integration fails keep NaN on
+# the days that were not reached. preset and jit choose the integrator as in ode_solving. Returns the number of
+# scenarios.
+def sweep(parameters: Dict, grid: Dict[str, Sequence[float]], ranges: Dict[str, Tuple[float, float]],
+          samples: int = 0, sampling: str = 'sobol', seed: Optional[int] = None, simulation_duration: int = 100,
+          output_dir: str = 'sweep_output', trajectories: bool = False, workers: int = 1, chunk_size: int = 64,
+          extinction_start: int = 20, piecewise: bool = False, preset: Optional[str] = None,
+          jit: bool = False) -> int:
+    names = list(grid) + list(ranges)
+    assert len(set(names)) == len(names), 'A parameter is both in a grid and in a range.'
+    if ranges and samples <= 0:
+        raise click.UsageError('--range needs --samples to be positive.')
+    os.makedirs(output_dir, exist_ok=True)
+    with open(os.path.join(output_dir, 'sweep.json'), 'w') as manifest_file:
+        json.dump(dict(grid=grid, ranges=ranges, samples=samples, sampling=sampling, seed=seed,
+                       simulation_duration=simulation_duration, extinction_start=extinction_start,
+                       piecewise=piecewise, preset=preset, compartments=COMPARTMENTS, metrics=METRICS),
+                  manifest_file, indent=2)
+
+    chunks = _chunks(scenarios(grid, ranges, samples=samples, sampling=sampling, seed=seed), chunk_size)
+    solver_options = dict(PRESETS.get(preset, {}), jit=jit)
+    chunk_args = (simulation_duration, extinction_start, piecewise, trajectories, solver_options)
+    n_scenarios = 0
+    with open(os.path.join(output_dir, 'scenarios.csv'), 'w', newline='') as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(['scenario'] + names + METRICS)
+
+        def write(result):
+            nonlocal n_scenarios
+            indices, points, metrics, values = result
+            for index, point, row in zip(indices, points, metrics):
+                writer.writerow([index] + list(point) + [row[0], int(row[1]), row[2], int(row[3])])
+            csv_file.flush()
+            if values is not None:
+                np.savez(os.path.join(output_dir, f'trajectories_{indices[0] // chunk_size:06d}.npz'),
+                         scenario=np.array(indices), values=values)
+            n_scenarios += len(indices)
+
+        if workers <= 1:
+            for indices, points in chunks:
+                write(_run_chunk(parameters, names, indices, points, *chunk_args))
+            return n_scenarios
+
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            pending = set()
+            for indices, points in chunks:
+                pending.add(executor.submit(_run_chunk, parameters, names, indices, points, *chunk_args))
+                if len(pending) >= 2 * workers:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        write(future.result())
+            for future in wait(pending).done:
+                write(future.result())
+    return n_scenarios
+
+
+if __name__ == '__main__':
+    run_sweep()
@@ -0,0 +1,49 @@
+import json
+import os
+
+import numpy as np
+import pytest
+
+from ensemble import BAND_SERIES, P2Quantiles, ensemble_bands, gaussian_samples
+from model_fitting import FitProblem
+
+# Paths are relative to this file, so the tests run from any directory.
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+TRAIN_DATA_PATH = os.path.join(DATA_DIR, 'spain_multi_phase_partitioned_train.json')
+PARAMETERS_PATH = os.path.join(DATA_DIR, 'spain_trained_parameters.json')
+
+
+def test_p2_quantiles_match_exact_quantiles():
+    rng = np.random.default_rng(0)
+    observations = rng.lognormal(size=(5000, 3))
+    aggregator = P2Quantiles((0.05, 0.5, 0.95), (3,))
+    for observation in observations:
+        aggregator.update(observation)
+    np.testing.assert_allclose(aggregator.result(), np.quantile(observations, (0.05, 0.5, 0.95), axis=0), rtol=0.05)
+
+
+# The median of a Gaussian ensemble around the trained parameters stays within tolerance of their trajectory and the
+# outer band brackets it on every day.
+def test_gaussian_bands_follow_the_fit(tolerance=0.05):
+    problem = FitProblem.from_path(TRAIN_DATA_PATH)
+    with open(PARAMETERS_PATH) as parameters_file:
+        x = problem.vector(json.load(parameters_file))
+    simulation_duration = problem.simulation_duration - 1
+    fitted = problem.solve(x)[:simulation_duration + 1]
+    bands = ensemble_bands(problem, gaussian_samples(problem, x, 1000, seed=0), simulation_duration)
+
+    assert bands['dropped'] == 0
+    assert bands['members'] == 1000
+    for series in BAND_SERIES:
+        expected = fitted[series] * problem.n / problem.total
+        median = bands[series][bands['quantiles'].index(0.5)]
+        assert np.all(np.abs(median - expected) <= tolerance * expected + 1e-9), f'The {series} median drifts.'
+        assert np.all((bands[series][0] <= expected * (1 + 1e-9))
+                      & (expected <= bands[series][-1] * (1 + 1e-9))), f'The {series} bands miss the fit.'
+
+
+def test_dropping_every_member_raises():
+    problem = FitProblem.from_path(TRAIN_DATA_PATH)
+    samples = iter([np.full((3, len(problem.initial)), np.nan)])
+    with pytest.raises(ValueError, match='All 3 members'):
+        ensemble_bands(problem, samples, 30)
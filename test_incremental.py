@@ -0,0 +1,46 @@
+import json
+import os
+
+import numpy as np
+import pytest
+
+from incremental import WindowFitProblem, refit_parameters
+from model_fitting import FitProblem
+from partitioned_model import PartitionedModel
+
+# Paths are relative to this file, so the tests run from any directory.
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+DATA_PATH = os.path.join(DATA_DIR, 'spain_multi_phase_partitioned.json')
+
+
+def _gt_data():
+    with open(DATA_PATH) as data_file:
+        return json.load(data_file)
+
+
+def test_window_result_round_trips_through_vector():
+    gt_data = _gt_data()
+    problem = FitProblem(gt_data)
+    window = WindowFitProblem(gt_data, problem.initial, 10)
+    x = np.array(window.initial) * 1.1
+
+    np.testing.assert_allclose(problem.vector(window.result_dict(x)), window.full_vector(x))
+    np.testing.assert_allclose(problem.vector(window.parameters_dict(x)), window.full_vector(x))
+
+
+def test_window_refit_is_not_a_trained_parameters_file():
+    previous = FitProblem(_gt_data()).result_dict(FitProblem(_gt_data()).initial)
+    parameters, drift = refit_parameters(DATA_PATH, previous, window=5, tol=1e-2)
+
+    assert parameters['window_start'] == len(_gt_data()['epidemic_evolution']) - 5
+    assert 'suspected_medical_initial' not in parameters
+    assert {row['parameter'] for row in drift} >= {'gamma', 'alpha', 'd_q'}
+    with pytest.raises(ValueError):
+        PartitionedModel.from_parameters(parameters)
+
+
+def test_window_refits_do_not_chain():
+    previous = FitProblem(_gt_data()).result_dict(FitProblem(_gt_data()).initial)
+    parameters, _ = refit_parameters(DATA_PATH, previous, window=5, tol=1e-2)
+    with pytest.raises(ValueError, match='window refit'):
+        refit_parameters(DATA_PATH, parameters, window=5, tol=1e-2)
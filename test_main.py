@@ -0,0 +1,36 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+from main import LAZY_COMMANDS
+
+# Paths are relative to this file, so the tests run from any directory.
+MAIN_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py')
+
+# Runs main.py with the given arguments as python main.py would, then prints the top-level packages imported.
+LIST_IMPORTS = '''
+import os, runpy, sys
+sys.argv = sys.argv[1:]
+sys.path[0] = os.path.dirname(sys.argv[0])
+try:
+    runpy.run_path(sys.argv[0], run_name='__main__')
+except SystemExit:
+    pass
+print(' '.join(sorted({name.split('.')[0] for name in sys.modules})), file=sys.stderr)
+'''
+
+
+@pytest.mark.parametrize('args, forbidden', [(['--help'], {'scipy', 'matplotlib', 'numba'}),
+                                             (['sweep', '--help'], {'matplotlib', 'numba'})])
+def test_help_does_not_import_heavy_packages(args, forbidden):
+    result = subprocess.run([sys.executable, '-c', LIST_IMPORTS, MAIN_PATH] + args, check=True,
+                            capture_output=True, text=True)
+    imported = set(result.stderr.split())
+
+    assert 'click' in imported
+    assert not imported & forbidden, f'{" ".join(args)} imports {", ".join(sorted(imported & forbidden))}.'
+    if args == ['--help']:
+        for name in LAZY_COMMANDS:
+            assert name in result.stdout
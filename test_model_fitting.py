@@ -0,0 +1,62 @@
+import os
+
+import numpy as np
+import pytest
+
+from fit_cache import FitCache
+from model_fitting import FitProblem, LossFunction, _fit_cache_key
+from ode_solving import PRESETS
+
+# Paths are relative to this file, so the tests run from any directory.
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+DATA_PATH = os.path.join(DATA_DIR, 'spain_multi_phase_partitioned.json')
+
+
+def test_cache_key_follows_the_solver_configuration(tmp_path):
+    cache = FitCache(str(tmp_path))
+
+    def key(**problem_settings):
+        return _fit_cache_key(cache, DATA_PATH, FitProblem.from_path(DATA_PATH, **problem_settings),
+                              method='trust-constr', gradient=False)
+
+    assert key() == key(**PRESETS['balanced'])
+    assert key() != key(jit=True)
+    assert key() != key(**PRESETS['fast'])
+    assert key() != key(rtol=1e-3)
+
+
+# loss_function as it was before LossFunction, looping over the day dicts.
+def _dict_loss(predict_list, gt_list, fictional_total, total, weight=1, deceased_relative_weight=10, offset=0):
+    predict_list = predict_list[offset:]
+    gt_list = gt_list[offset:]
+    quarantined_loss = deceased_loss = 0
+    n_quarantined = n_deceased = 0
+    for predicted_data, gt_data in zip(predict_list, gt_list):
+        for key, gt_val in gt_data.items():
+            gt_val = gt_val * fictional_total / total
+            if 'quarantined' in key:
+                quarantined_loss += abs(gt_val - predicted_data[key]) * weight
+                n_quarantined += 1
+            elif 'deceased' in key:
+                deceased_loss += abs(gt_val - predicted_data[key]) * weight * deceased_relative_weight
+                n_deceased += 1
+    if n_quarantined > 0:
+        quarantined_loss /= n_quarantined
+    if n_deceased > 0:
+        deceased_loss /= n_deceased
+    return quarantined_loss + deceased_loss
+
+
+# Days without a deceased count and predictions shorter than the ground truth included.
+@pytest.mark.parametrize('offset', [0, 5, 30])
+@pytest.mark.parametrize('days', [None, 40])
+def test_loss_function_matches_the_dict_loss(offset, days):
+    problem = FitProblem.from_path(DATA_PATH)
+    gt_list = [dict(day) for day in problem.epidemic_evolution]
+    for day in gt_list[3::7]:
+        day.pop('deceased', None)
+    predicted = problem.solve(np.array(problem.initial))[:days]
+
+    loss = LossFunction(gt_list, fictional_total=problem.total, total=problem.n, offset=offset)
+    expected = _dict_loss(predicted.to_dicts(), gt_list, problem.total, problem.n, offset=offset)
+    assert loss(predicted) == pytest.approx(expected, rel=1e-12)
@@ -0,0 +1,102 @@
+import json
+import os
+
+import numpy as np
+import pytest
+
+import compiled_equations
+from ode_solving import (INTEGRATORS, IntegrationError, TerminationEvent, solve_ode, solve_ode_batch,
+                         solve_ode_quarantine_ends)
+from parameter_sets import solve_kwargs, state_and_par
+
+# Paths are relative to this file, so the tests run from any directory.
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+PARAMETERS_PATH = os.path.join(DATA_DIR, 'spain_trained_parameters.json')
+
+# Contact rates 10^5 times higher from the quarantine start on, which neither the daily dopri5 loop nor rk4 gets
+# through.
+DIVERGING = dict(sm0=1000, se0=1000, so0=1000, e0=10, i0=10, gamma=1, sigma=0.3, quarantine_start=24,
+                 simulation_duration=100, m_gamma_reduction_1=1e-5, e_gamma_reduction_1=1e-5,
+                 o_gamma_reduction_1=1e-5)
+
+
+# rk4 always integrates phase by phase, so both integration loops are covered.
+@pytest.mark.parametrize('integrator', ['dopri5', 'rk4'])
+def test_failure_reports_last_day_reached(integrator):
+    trajectory = solve_ode(**DIVERGING, integrator=integrator, on_failure='ignore')
+    with pytest.raises(IntegrationError, match=f'after day {len(trajectory) - 1} of 100'):
+        solve_ode(**DIVERGING, integrator=integrator, on_failure='raise')
+
+
+@pytest.mark.skipif(compiled_equations.JIT_AVAILABLE, reason='numba is installed')
+@pytest.mark.parametrize('piecewise', [False, True])
+def test_jit_without_numba_uses_the_ordinary_right_hand_side(piecewise):
+    compiled_equations.jit_enabled.cache_clear()
+    with pytest.warns(RuntimeWarning, match='numba'):
+        trajectory = solve_ode(**DIVERGING, piecewise=piecewise, jit=True, on_failure='ignore')
+    assert np.array_equal(trajectory.values, solve_ode(**DIVERGING, piecewise=piecewise, on_failure='ignore').values)
+
+
+# Branches sharing the trajectory up to the earliest quarantine end against one solve_ode per end. The integrator
+# restarts at different days, so they agree to the solver tolerance, not exactly.
+@pytest.mark.parametrize('piecewise', [False, True])
+def test_quarantine_end_branches_match_independent_solves(piecewise):
+    with open(PARAMETERS_PATH) as parameters_file:
+        parameters = json.load(parameters_file)
+    kwargs = solve_kwargs(parameters, 400, piecewise=piecewise)
+    del kwargs['quarantine_2_duration']
+    durations = [duration for duration, _ in parameters['quarantine_2_duration_list']]
+
+    branches = solve_ode_quarantine_ends(quarantine_2_durations=durations, **kwargs)
+    for duration, branch in zip(durations, branches):
+        expected = solve_ode(**kwargs, quarantine_2_duration=duration).values
+        np.testing.assert_allclose(branch.values, expected, rtol=1e-4, atol=1, err_msg=f'duration {duration}')
+
+
+# Termination events are checked on whole days by every integrator, and inside phases by solve_ivp in piecewise mode, so
+# all of them stop on the same day. The thresholds are crossed well inside a day, and the states of that day agree to
+# the tolerance of the least accurate integrator.
+@pytest.mark.parametrize('event', [TerminationEvent('many_quarantined', 'quarantined', 2000, 'above'),
+                                   TerminationEvent('few_infected', 'infected', 5000, 'below', start_day=60)],
+                         ids=lambda event: event.name)
+def test_events_stop_on_the_same_day_with_every_integrator(event):
+    with open(PARAMETERS_PATH) as parameters_file:
+        parameters = json.load(parameters_file)
+    expected = solve_ode(**solve_kwargs(parameters, 400), events=[event])
+    assert expected.event == event.name
+
+    for integrator in INTEGRATORS:
+        for piecewise in (False, True):
+            trajectory = solve_ode(**solve_kwargs(parameters, 400, piecewise=piecewise), events=[event],
+                                   integrator=integrator)
+            case = f'{integrator}, piecewise={piecewise}'
+            assert (trajectory.event, trajectory.event_day) == (event.name, expected.event_day), case
+            np.testing.assert_allclose(trajectory.values, expected.values, rtol=1e-3, atol=1, err_msg=case)
+
+
+# Scenarios of the trained parameters with the contact rate scaled, the second phase ending on day 78 of it.
+def _scenarios(simulation_duration, factors=(0.8, 1, 1.2)):
+    with open(PARAMETERS_PATH) as parameters_file:
+        parameters = json.load(parameters_file)
+    return [solve_kwargs(dict(parameters, gamma=parameters['gamma'] * factor, quarantine_2_duration=78),
+                         simulation_duration) for factor in factors]
+
+
+# The batch shares the steps of a single integration, whose error control covers every member, so each member agrees
+# with its own solve_ode to the solver tolerance.
+def test_batch_matches_solve_ode():
+    scenarios = _scenarios(300)
+    initial_states, parameters = zip(*(state_and_par(kwargs) for kwargs in scenarios))
+    batch = solve_ode_batch(np.array(initial_states), np.array(parameters), 300)
+
+    assert batch.shape == (len(scenarios), 301, 9)
+    for kwargs, member in zip(scenarios, batch):
+        np.testing.assert_allclose(member, solve_ode(**kwargs).values, rtol=1e-4, atol=1)
+
+
+# Piecewise integration crosses each phase in one solver call instead of stopping on every day, so it agrees with the
+# daily loop to the solver tolerance, the phase boundaries included.
+def test_piecewise_matches_stepwise():
+    for kwargs in _scenarios(300):
+        np.testing.assert_allclose(solve_ode(**dict(kwargs, piecewise=True)).values, solve_ode(**kwargs).values,
+                                   rtol=1e-4, atol=1)
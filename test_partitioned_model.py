@@ -0,0 +1,98 @@
+import json
+import os
+
+import numpy as np
+import pytest
+from click.testing import CliRunner
+
+from ensemble import ensemble_bands, gaussian_samples
+from model_fitting import FitProblem
+from partitioned_model import PartitionedModel, run_partitioned_model
+from trajectory import COMPARTMENT_INDEX
+
+# Paths are relative to this file, so the tests run from any directory.
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+DATA_PATH = os.path.join(DATA_DIR, 'spain_multi_phase_partitioned.json')
+PARAMETERS_PATH = os.path.join(DATA_DIR, 'spain_trained_parameters.json')
+
+
+# Spain data split into three groups, one of them named like a group of the original model, over three phases.
+def _partitioned_data():
+    with open(DATA_PATH) as data_file:
+        gt_data = json.load(data_file)
+    return dict(total_individuals=gt_data['total_individuals'], epidemic_evolution=gt_data['epidemic_evolution'],
+                quarantine_start=gt_data['quarantine_start'], phase_durations=[14, 10, 1000],
+                groups=[{'name': 'medical', 'fraction': 0.0124, 'quarantine_contact': True},
+                        {'name': 'teachers', 'fraction': 0.02},
+                        {'name': 'others', 'fraction': 0.9676}])
+
+
+def test_result_dict_round_trips_through_from_parameters():
+    problem = FitProblem(_partitioned_data())
+    x = np.array(problem.initial) * 1.1
+    parameters = json.loads(json.dumps(problem.result_dict(x)))
+
+    model = PartitionedModel.from_parameters(parameters)
+    np.testing.assert_allclose(model.initial_state_from_parameters(parameters),
+                               problem.initial_state(x) * problem.n / problem.total)
+    np.testing.assert_allclose(model.gamma_reductions, problem.model(x).gamma_reductions)
+    np.testing.assert_allclose(problem.vector(parameters), x)
+
+
+# Trained parameters files have no quarantine_2_duration, so their second phase never ends.
+def test_partitioned_prediction_of_the_trained_parameters(tmp_path):
+    output_path = tmp_path / 'prediction.png'
+    result = CliRunner().invoke(run_partitioned_model,
+                                ['--parameters-path', PARAMETERS_PATH, '--output-path', str(output_path)])
+
+    assert result.exit_code == 0, result.output
+    assert output_path.exists()
+
+
+def test_ensemble_bands_of_partitioned_data():
+    problem = FitProblem(_partitioned_data())
+    x = np.array(problem.initial)
+    bands = ensemble_bands(problem, gaussian_samples(problem, x, 8, seed=0), 60)
+
+    assert bands['members'] + bands['dropped'] == 8
+    assert bands['quarantined'].shape == (len(bands['quantiles']), 61)
+
+
+@pytest.mark.parametrize('piecewise', [False, True])
+def test_vectorized_rhs_reproduces_the_original_model(piecewise):
+    with open(PARAMETERS_PATH) as parameters_file:
+        parameters = dict(json.load(parameters_file), quarantine_2_duration=78)
+    model = PartitionedModel.from_parameters(parameters)
+    vectorized = model.vectorized()
+    initial_state = model.initial_state_from_parameters(parameters)
+
+    assert np.array_equal(model.solve(initial_state, 1000, piecewise=piecewise),
+                          vectorized.solve(initial_state, 1000, piecewise=piecewise))
+    durations = [duration for duration, _ in parameters['quarantine_2_duration_list']]
+    for scalar_branch, vectorized_branch in zip(
+            model.solve_last_phase_ends(initial_state, durations, 1000, piecewise=piecewise),
+            vectorized.solve_last_phase_ends(initial_state, durations, 1000, piecewise=piecewise)):
+        assert np.array_equal(scalar_branch.values, vectorized_branch.values, equal_nan=True)
+
+
+# The sensitivities of the quarantined and deceased series, which make up the gradient of the loss, against central
+# differences of the trajectory. The loss itself has kinks where a residual changes sign. Tight tolerances keep the
+# integration error out of the differences.
+@pytest.mark.parametrize('partitioned', [False, True])
+def test_sensitivities_match_finite_differences(partitioned):
+    if partitioned:
+        problem = FitProblem(_partitioned_data(), rtol=1e-11, atol=1e-14)
+    else:
+        problem = FitProblem.from_path(DATA_PATH, rtol=1e-11, atol=1e-14)
+    x = np.array(problem.initial)
+    columns = [COMPARTMENT_INDEX['quarantined'], COMPARTMENT_INDEX['deceased']]
+    _, sensitivities = problem.solve_sensitivity(x)
+
+    for k in range(x.size):
+        step = 1e-3 * max(abs(x[k]), 1e-2)
+        shift = np.zeros_like(x)
+        shift[k] = step
+        difference = (problem.solve(x + shift).values[:, columns]
+                      - problem.solve(x - shift).values[:, columns]) / (2 * step)
+        np.testing.assert_allclose(sensitivities[:, columns, k], difference, rtol=1e-4,
+                                   atol=1e-6 * np.abs(difference).max() + 1e-12, err_msg=f'parameter {k}')
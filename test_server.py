@@ -0,0 +1,69 @@
+import asyncio
+import functools
+import json
+import os
+
+import numpy as np
+
+from ode_solving import solve_ode
+from parameter_sets import solve_kwargs
+from server import PredictionService, handle_connection, load_parameter_sets
+
+# Paths are relative to this file, so the tests run from any directory.
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+
+# One HTTP/1.1 request over a kept-alive connection. Returns the status and the json payload.
+async def _request(reader, writer, method, path, payload=None):
+    body = json.dumps(payload).encode() if payload is not None else b''
+    writer.write(f'{method} {path} HTTP/1.1\r\nContent-Length: {len(body)}\r\n\r\n'.encode('latin-1') + body)
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line == b'\r\n':
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    return status, json.loads(await reader.readexactly(int(headers['content-length'])))
+
+
+# Queries go through the HTTP layer, a worker process and the response cache, on the shipped parameter sets.
+def test_serve_round_trip(tmp_path):
+    parameter_sets = load_parameter_sets(DATA_DIR)
+    assert 'spain' in parameter_sets
+    query = {'parameters': 'spain', 'overrides': {'quarantine_2_duration': 78}, 'simulation_duration': 60,
+             'compartments': ['quarantined', 'deceased']}
+
+    async def session():
+        service = PredictionService(parameter_sets, cache_size=8, cache_dir=None)
+        await service.start()
+        server = await asyncio.start_unix_server(functools.partial(handle_connection, service),
+                                                 path=str(tmp_path / 'serve.sock'))
+        try:
+            reader, writer = await asyncio.open_unix_connection(str(tmp_path / 'serve.sock'))
+            responses = [await _request(reader, writer, 'POST', '/solve', query),
+                         await _request(reader, writer, 'POST', '/solve', query),
+                         await _request(reader, writer, 'POST', '/solve', dict(query, parameters='nowhere')),
+                         await _request(reader, writer, 'PUT', '/parameters/copy', parameter_sets['spain']),
+                         await _request(reader, writer, 'GET', '/parameters'),
+                         await _request(reader, writer, 'GET', '/health')]
+            writer.close()
+            return responses
+        finally:
+            server.close()
+            await server.wait_closed()
+            await service.close()
+
+    first, second, unknown, put, listed, health = asyncio.run(session())
+
+    expected = solve_ode(**solve_kwargs(dict(parameter_sets['spain'], quarantine_2_duration=78), 60))
+    assert first[0] == 200 and first[1]['days'] == 61 and not first[1]['cached']
+    for compartment in query['compartments']:
+        np.testing.assert_array_equal(first[1]['series'][compartment], expected[compartment])
+    assert second == (200, dict(first[1], cached=True))
+    assert unknown[0] == 404
+    assert put == (200, {'name': 'copy'})
+    assert 'copy' in listed[1]['parameter_sets']
+    assert health[1]['cache']['hits'] == 1
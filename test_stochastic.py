@@ -0,0 +1,36 @@
+import json
+import os
+
+import numpy as np
+import pytest
+
+from stochastic import initial_counts, simulate_stochastic
+
+# Paths are relative to this file, so the tests run from any directory.
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+PARAMETERS_PATH = os.path.join(DATA_DIR, 'spain_trained_parameters.json')
+
+
+def test_initial_counts_keep_the_expected_state():
+    state0 = np.array([1000.2, 50, 3.5, 0.4, 0.6, 0, 0, 0])
+    counts = initial_counts(state0, 100000, np.random.default_rng(0))
+
+    assert np.all((counts == np.floor(state0)) | (counts == np.ceil(state0)))
+    np.testing.assert_allclose(counts.mean(axis=0), state0, atol=0.01)
+
+
+def test_extinction_probability_follows_fractional_initial_state():
+    with open(PARAMETERS_PATH) as parameters_file:
+        parameters = dict(json.load(parameters_file), exposed_initial=0.3, infected_initial=0.2,
+                          quarantined_initial=0)
+    results = simulate_stochastic(parameters, simulation_duration=5, realizations=20000, seed=0)
+
+    assert abs(results['extinction_probability'][0] - 0.7 * 0.8) < 0.02
+
+
+def test_partitioned_parameters_are_refused():
+    with open(PARAMETERS_PATH) as parameters_file:
+        parameters = dict(json.load(parameters_file), phase_durations=[14, 10, 1000],
+                          gamma_reductions=[[1.5, 1.2, 1.1]] * 3)
+    with pytest.raises(ValueError):
+        simulate_stochastic(parameters, simulation_duration=5, realizations=10, seed=0)
@@ -0,0 +1,45 @@
+import csv
+import os
+
+import pytest
+from click.testing import CliRunner
+
+from sweep import run_sweep
+
+# Paths are relative to this file, so the tests run from any directory.
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+PARAMETERS_PATH = os.path.join(DATA_DIR, 'spain_trained_parameters.json')
+
+
+def _sweep(output_dir, *args):
+    return CliRunner().invoke(run_sweep, ['--parameters-path', PARAMETERS_PATH, '--output-dir', str(output_dir),
+                                          '--simulation-duration', '30', *args])
+
+
+@pytest.mark.parametrize('args', [['--grid', 'beta=0.1,0.2'], ['--range', 'gamma_x=1:2', '--samples', '4'],
+                                  ['--grid', 'gt_data=1,2']])
+def test_unknown_names_are_rejected(tmp_path, args):
+    result = _sweep(tmp_path, *args)
+
+    assert result.exit_code == 2
+    assert 'cannot be swept' in result.output
+    assert not os.path.exists(tmp_path / 'scenarios.csv')
+
+
+def test_range_without_samples_is_rejected(tmp_path):
+    result = _sweep(tmp_path, '--range', 'alpha=0.1:0.2')
+
+    assert result.exit_code == 2
+    assert '--samples' in result.output
+
+
+def test_grid_and_range_write_every_scenario(tmp_path):
+    result = _sweep(tmp_path, '--grid', 'alpha=0.1,0.2', '--grid', 'quarantine_start=20:24:3',
+                    '--range', 'sigma=0.2:0.4', '--samples', '2')
+    assert result.exit_code == 0, result.output
+
+    with open(tmp_path / 'scenarios.csv') as csv_file:
+        rows = list(csv.DictReader(csv_file))
+    assert len(rows) == 2 * 3 * 2
+    assert sorted(int(row['scenario']) for row in rows) == list(range(12))
+    assert {float(row['quarantine_start']) for row in rows} == {20, 22, 24}
@@ -0,0 +1,49 @@
+import numpy as np
+
+from trajectory import COMPARTMENTS, BranchedTrajectory, Trajectory
+
+
+def _trajectory(days=5):
+    return Trajectory(np.arange(days * len(COMPARTMENTS), dtype=np.float64).reshape(days, len(COMPARTMENTS)))
+
+
+def test_columns_days_and_slices():
+    trajectory = _trajectory()
+
+    assert len(trajectory) == 5
+    np.testing.assert_array_equal(trajectory['quarantined'], trajectory.values[:, COMPARTMENTS.index('quarantined')])
+    np.testing.assert_array_equal(trajectory.deceased, trajectory['deceased'])
+    assert trajectory[2]['exposed'] == trajectory.values[2, COMPARTMENTS.index('exposed')]
+    assert list(trajectory[2]) == list(COMPARTMENTS)
+    # Slices share the memory of the trajectory.
+    assert np.shares_memory(trajectory[1:3].values, trajectory.values)
+
+
+# Old callers walk the trajectory as a list of dicts.
+def test_dict_view_round_trips():
+    trajectory = _trajectory()
+    dicts = trajectory.to_dicts()
+
+    assert dicts == [dict(day) for day in trajectory]
+    np.testing.assert_array_equal(Trajectory.from_dicts(dicts).values, trajectory.values)
+    partial = Trajectory.from_dicts([{'quarantined': 1.0}, {'deceased': 2.0, 'unknown': 3.0}])
+    assert partial[0]['quarantined'] == 1.0 and np.isnan(partial[0]['deceased'])
+
+
+def test_from_states_adds_the_susceptible_column():
+    states = np.arange(16, dtype=np.float64).reshape(2, 8) / 100
+    trajectory = Trajectory.from_states(states, 1000)
+
+    np.testing.assert_allclose(trajectory['susceptible'], states[:, :3].sum(axis=1) * 1000)
+    np.testing.assert_allclose(trajectory['deceased'], states[:, 7] * 1000)
+
+
+def test_branched_trajectory_reads_like_its_concatenation():
+    trajectory = _trajectory(6)
+    branched = BranchedTrajectory(trajectory[:4], trajectory[4:])
+
+    assert len(branched) == 6
+    np.testing.assert_array_equal(branched.values, trajectory.values)
+    np.testing.assert_array_equal(branched['infected'], trajectory['infected'])
+    assert dict(branched[-1]) == dict(trajectory[5])
+    assert branched.to_dicts() == trajectory.to_dicts()
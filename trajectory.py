@@ -0,0 +1,129 @@
+from collections.abc import Mapping
+from typing import Dict, Iterator, List, Optional, Union
+
+import numpy as np
+
+
+COMPARTMENTS = ('susceptible_medical', 'susceptible_essential_services', 'susceptible_others', 'susceptible',
+                'exposed', 'infected', 'quarantined', 'recovered', 'deceased')
+COMPARTMENT_INDEX = {name: index for index, name in enumerate(COMPARTMENTS)}
+
+
+# Read-only dict-like view over one day of a trajectory, kept for callers written against List[Dict[str, float]].
+class DayView(Mapping):
+    __slots__ = ('_row',)
+
+    def __init__(self, row: np.ndarray):
+        self._row = row
+
+    def __getitem__(self, key: str) -> float:
+        return float(self._row[COMPARTMENT_INDEX[key]])
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(COMPARTMENTS)
+
+    def __len__(self) -> int:
+        return len(COMPARTMENTS)
+
+    def __repr__(self) -> str:
+        return repr(dict(self))
+
+
+# Epidemic evolution stored as a (days, compartments) float64 array whose columns follow COMPARTMENTS.
+# trajectory['quarantined'] and trajectory.quarantined return a column, trajectory[day] a DayView and slicing over days
+# returns another Trajectory sharing the same memory. When the solver stopped on a termination event, event names it
+# and event_day is the day it happened.
+class Trajectory:
+    __slots__ = ('values', 'event_day', 'event')
+
+    def __init__(self, values: np.ndarray, event_day: Optional[int] = None, event: Optional[str] = None):
+        values = np.asarray(values, dtype=np.float64)
+        assert values.ndim == 2 and values.shape[1] == len(COMPARTMENTS)
+        self.values = values
+        self.event_day = event_day
+        self.event = event
+
+    # Build a trajectory from normalized (sm, se, so, e, i, q, r, d) states and the population size.
+    @classmethod
+    def from_states(cls, states: Union[np.ndarray, List[List[float]]], n: float, **kwargs) -> 'Trajectory':
+        states = np.asarray(states, dtype=np.float64).reshape(-1, 8) * n
+        values = np.empty((states.shape[0], len(COMPARTMENTS)))
+        values[:, :3] = states[:, :3]
+        values[:, 3] = states[:, :3].sum(axis=1)
+        values[:, 4:] = states[:, 3:]
+        return cls(values, **kwargs)
+
+    # Build a trajectory from a list of dicts such as the ground truth 'epidemic_evolution'. Missing keys become NaN.
+    @classmethod
+    def from_dicts(cls, dict_list: List[Dict[str, float]]) -> 'Trajectory':
+        values = np.full((len(dict_list), len(COMPARTMENTS)), np.nan)
+        for day, data_dict in enumerate(dict_list):
+            for key, val in data_dict.items():
+                if key in COMPARTMENT_INDEX:
+                    values[day, COMPARTMENT_INDEX[key]] = val
+        return cls(values)
+
+    def __len__(self) -> int:
+        return self.values.shape[0]
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return self.values[:, COMPARTMENT_INDEX[key]]
+        if isinstance(key, slice):
+            return Trajectory(self.values[key])
+        return DayView(self.values[key])
+
+    def __iter__(self) -> Iterator[DayView]:
+        for row in self.values:
+            yield DayView(row)
+
+    def to_dicts(self) -> List[Dict[str, float]]:
+        return [dict(zip(COMPARTMENTS, row.tolist())) for row in self.values]
+
+
+# Trajectory made of a prefix shared with other trajectories, such as the common trunk of a scenario sweep, followed by
+# its own suffix. The prefix is never copied; columns are concatenated when they are read.
+class BranchedTrajectory:
+    __slots__ = ('prefix', 'suffix')
+
+    def __init__(self, prefix: Trajectory, suffix: Trajectory):
+        self.prefix = prefix
+        self.suffix = suffix
+
+    @property
+    def values(self) -> np.ndarray:
+        return np.concatenate([self.prefix.values, self.suffix.values])
+
+    def __len__(self) -> int:
+        return len(self.prefix) + len(self.suffix)
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return np.concatenate([self.prefix[key], self.suffix[key]])
+        if isinstance(key, slice):
+            return Trajectory(self.values[key])
+        if key < 0:
+            key += len(self)
+        if key < len(self.prefix):
+            return self.prefix[key]
+        return self.suffix[key - len(self.prefix)]
+
+    def __iter__(self) -> Iterator[DayView]:
+        yield from self.prefix
+        yield from self.suffix
+
+    def to_dicts(self) -> List[Dict[str, float]]:
+        return self.prefix.to_dicts() + self.suffix.to_dicts()
+
+
+def _column_property(index: int) -> property:
+    return property(lambda self: self.values[:, index])
+
+
+def _branched_column_property(name: str) -> property:
+    return property(lambda self: self[name])
+
+
+for _index, _name in enumerate(COMPARTMENTS):
+    setattr(Trajectory, _name, _column_property(_index))
+    setattr(BranchedTrajectory, _name, _branched_column_property(_name))
@@ -1,39 +1,75 @@
-from typing import Dict, List, Optional, Tuple, Union
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Sequence, Tuple, Union
 
+import numpy as np
 from matplotlib import pyplot as plt
+from matplotlib.axes import Axes
+from matplotlib.figure import Figure
 
+from trajectory import Trajectory
 
-def show_results(result_list: List[Dict[str, float]],
+
+# Figure and axes of a new plot. Figures written to a file are built without pyplot, so they need no display, leave the
+# global pyplot state untouched and can be rendered concurrently; the format follows the file extension (png, svg, pdf).
+def new_figure(output_path: Optional[str] = None) -> Tuple[Figure, Axes]:
+    if output_path is None:
+        return plt.subplots()
+    figure = Figure()
+    return figure, figure.add_subplot()
+
+
+def finish_figure(figure: Figure, output_path: Optional[str] = None):
+    if output_path is None:
+        plt.show()
+    else:
+        figure.savefig(output_path)
+
+
+def show_results(result_list: Trajectory,
                  gt_data: Optional[List[Dict[str, float]]] = None,
                  title: str = 'Epidemic evolution fit',
                  infection_start_date: str = '02-20-2020',
-                 predict_len: int = 0):
-    x = [i for i in range(len(result_list))]
-    plt.clf()
+                 predict_len: int = 0,
+                 output_path: Optional[str] = None,
+                 bands: Optional[Dict] = None) -> Figure:
+    figure, ax = new_figure(output_path)
+    plot_results(ax, result_list, gt_data=gt_data, title=title, infection_start_date=infection_start_date,
+                 predict_len=predict_len, bands=bands)
+    finish_figure(figure, output_path)
+    return figure
+
+
+def plot_results(ax: Axes, result_list: Trajectory,
+                 gt_data: Optional[List[Dict[str, float]]] = None,
+                 title: str = 'Epidemic evolution fit',
+                 infection_start_date: str = '02-20-2020',
+                 predict_len: int = 0,
+                 bands: Optional[Dict] = None):
+    x = np.arange(len(result_list))
+    quarantined = result_list['quarantined']
+    deceased = result_list['deceased']
     if predict_len > 0:
-        plt.plot(x[:-predict_len], [data_dict['quarantined'] for data_dict in result_list[:-predict_len]],
-                 'r', color='blue', label='hospitalized')
-        plt.plot(x[:-predict_len], [data_dict['deceased'] for data_dict in result_list[:-predict_len]],
-                 'r', color='red', label='deceased')
-        plt.plot(x[-predict_len:], [data_dict['quarantined'] for data_dict in result_list[-predict_len:]],
-                 '.', color='blue', label='predicted hospitalized')
-        plt.plot(x[-predict_len:], [data_dict['deceased'] for data_dict in result_list[-predict_len:]],
-                 '.', color='red', label='predicted deceased')
+        ax.plot(x[:-predict_len], quarantined[:-predict_len], 'r', color='blue', label='hospitalized')
+        ax.plot(x[:-predict_len], deceased[:-predict_len], 'r', color='red', label='deceased')
+        ax.plot(x[-predict_len:], quarantined[-predict_len:], '.', color='blue', label='predicted hospitalized')
+        ax.plot(x[-predict_len:], deceased[-predict_len:], '.', color='red', label='predicted deceased')
     else:
-        plt.plot(x, [data_dict['quarantined'] for data_dict in result_list], 'r', color='blue', label='hospitalized')
-        plt.plot(x, [data_dict['deceased'] for data_dict in result_list], 'r', color='red', label='deceased')
-    # plt.plot(x, [data_dict['infected'] for data_dict in result_list], 'r', color='green', label='recovered')
-    # plt.plot(x, [data_dict['recovered'] for data_dict in result_list], 'r', color='green', label='recovered')
+        ax.plot(x, quarantined, 'r', color='blue', label='hospitalized')
+        ax.plot(x, deceased, 'r', color='red', label='deceased')
+    # ax.plot(x, result_list['infected'], 'r', color='green', label='recovered')
+    # ax.plot(x, result_list['recovered'], 'r', color='green', label='recovered')
+
+    if bands is not None:
+        draw_bands(ax, bands)
 
-    draw_gt_data(gt_data=gt_data)
-    plt.legend()
-    plt.title(title)
-    plt.ylabel('Number of individuals')
-    plt.xlabel(f'Days since infection start ({infection_start_date})')
-    plt.show()
+    draw_gt_data(gt_data=gt_data, ax=ax)
+    ax.legend()
+    ax.set_title(title)
+    ax.set_ylabel('Number of individuals')
+    ax.set_xlabel(f'Days since infection start ({infection_start_date})')
 
 
-def show_multiple_results(result_list: List[Tuple[List[Dict[str, float]], str, int]],
+def show_multiple_results(result_list: List[Tuple[Trajectory, str, int]],
                           offset: int = 0,
                           title: str = 'Infected depending on quarantine end',
                           # title: str = 'Effects of quarantine on evolution of infected individuals',
@@ -41,60 +77,101 @@ def show_multiple_results(result_list: List[Tuple[List[Dict[str, float]], str, i
                           # title: str = 'Predicted number of deaths',
                           infection_start_date: str = '02-20-2020',
                           start_days: int = 20, top_lim: Optional[int] = None, logarithmic: bool = False,
+                          gt_data: Optional[List[Dict[str, Union[int, float]]]] = None,
+                          output_path: Optional[str] = None) -> Figure:
+    figure, ax = new_figure(output_path)
+    plot_multiple_results(ax, result_list, offset=offset, title=title, infection_start_date=infection_start_date,
+                          start_days=start_days, top_lim=top_lim, logarithmic=logarithmic, gt_data=gt_data)
+    finish_figure(figure, output_path)
+    return figure
+
+
+def plot_multiple_results(ax: Axes, result_list: List[Tuple[Trajectory, str, int]],
+                          offset: int = 0,
+                          title: str = 'Infected depending on quarantine end',
+                          infection_start_date: str = '02-20-2020',
+                          start_days: int = 20, top_lim: Optional[int] = None, logarithmic: bool = False,
                           gt_data: Optional[List[Dict[str, Union[int, float]]]] = None):
-    plt.clf()
     max_y = 0
     for i, (results, result_name, end_day) in enumerate(result_list):
-        x = [i for i in range(len(results))][offset:]
-        y = []
-        disappeared = False
-        for day_number, data_dict in enumerate(results[offset:]):
-            day = day_number + offset
-            no_infected = data_dict['infected'] < 1 and data_dict['exposed'] < 1
-            if no_infected and day > start_days and not disappeared:
-                print(f'\nquarantine-end:\t{result_name}\ndeceased:{data_dict["deceased"]}')
-                disappeared = True
-
-            if disappeared:
-                val = 0
-            else:
-                val = data_dict['infected']
-
-            max_y = max(max_y, val)
-            y.append(val)
+        x = np.arange(len(results))[offset:]
+        y = results['infected'][offset:].copy()
+        no_infected = (results['infected'][offset:] < 1) & (results['exposed'][offset:] < 1) & (x > start_days)
+        if no_infected.any():
+            disappeared_day = int(np.argmax(no_infected))
+            print(f'\nquarantine-end:\t{result_name}\ndeceased:{results["deceased"][offset + disappeared_day]}')
+            y[disappeared_day:] = 0
+
+        if y.size > 0:
+            max_y = max(max_y, y.max())
 
         if logarithmic:
-            plt.semilogy(x, y, 'r', color=f'C{i}', label=f'{result_name} (day {end_day})')
+            ax.semilogy(x, y, 'r', color=f'C{i}', label=f'{result_name} (day {end_day})')
         else:
-            plt.plot(x, y, 'r', color=f'C{i}', label=f'{result_name} (day {end_day})')
+            ax.plot(x, y, 'r', color=f'C{i}', label=f'{result_name} (day {end_day})')
 
-        # plt.plot(x, [data_dict['infected'] for data_dict in results], 'r', color='orange', label='infected')
-        # plt.plot(x, [data_dict['exposed'] for data_dict in results], 'r', color='olive', label='exposed')
-        # plt.plot(x, [data_dict['quarantined'] for data_dict in results], 'r', color='blue', label='quarantined')
+        # ax.plot(x, results['infected'], 'r', color='orange', label='infected')
+        # ax.plot(x, results['exposed'], 'r', color='olive', label='exposed')
+        # ax.plot(x, results['quarantined'], 'r', color='blue', label='quarantined')
 
-        # total_infected = [data_dict['exposed'] + data_dict['infected'] + data_dict['quarantined'] +
-        #                   data_dict['recovered'] + data_dict['deceased'] for data_dict in results]
-        # plt.plot(x, total_infected, 'r', color='blue', label='total infected')
+        # total_infected = (results['exposed'] + results['infected'] + results['quarantined'] +
+        #                   results['recovered'] + results['deceased'])
+        # ax.plot(x, total_infected, 'r', color='blue', label='total infected')
 
-        # plt.plot(x, [data_dict['deceased'] for data_dict in results], 'r', color='red', label='deceased')
+        # ax.plot(x, results['deceased'], 'r', color='red', label='deceased')
 
-    draw_gt_data(gt_data=gt_data)
+    draw_gt_data(gt_data=gt_data, ax=ax)
 
-    plt.legend()
-    plt.title(title)
+    ax.legend()
+    ax.set_title(title)
     if top_lim is not None:
         if logarithmic:
-            plt.ylim(1, min(max_y, top_lim))
+            ax.set_ylim(1, min(max_y, top_lim))
         else:
-            plt.ylim(0, min(max_y, top_lim))
-    plt.ylabel('Number of individuals')
-    plt.xlabel(f'Days since infection start ({infection_start_date})')
-    plt.show()
+            ax.set_ylim(0, min(max_y, top_lim))
+    ax.set_ylabel('Number of individuals')
+    ax.set_xlabel(f'Days since infection start ({infection_start_date})')
 
 
-def draw_gt_data(gt_data: Optional[List[Dict[str, Union[int, float]]]] = None):
+def draw_gt_data(gt_data: Optional[List[Dict[str, Union[int, float]]]] = None, ax: Optional[Axes] = None):
     if gt_data is not None:
-        gt_x = [i for i in range(len(gt_data))]
-        plt.plot(gt_x, [data_dict['quarantined'] for data_dict in gt_data], '-.', color='blue', label='gt hospitalized')
-        # plt.plot(gt_x, [data_dict['recovered'] for data_dict in gt_data], '-.', color='green', label='gt recovered')
-        plt.plot(gt_x, [data_dict['deceased'] for data_dict in gt_data], '-.', color='red', label='gt deceased')
+        ax = ax if ax is not None else plt.gca()
+        gt_trajectory = Trajectory.from_dicts(gt_data)
+        gt_x = np.arange(len(gt_trajectory))
+        ax.plot(gt_x, gt_trajectory['quarantined'], '-.', color='blue', label='gt hospitalized')
+        # ax.plot(gt_x, gt_trajectory['recovered'], '-.', color='green', label='gt recovered')
+        ax.plot(gt_x, gt_trajectory['deceased'], '-.', color='red', label='gt deceased')
+
+
+# Shades the quantile bands of ensemble.ensemble_bands, the outer quantile pairs being the lightest.
+def draw_bands(ax: Axes, bands: Dict):
+    quantiles = bands['quantiles']
+    for series, color, label in (('quarantined', 'blue', 'hospitalized'), ('deceased', 'red', 'deceased')):
+        x = np.arange(bands[series].shape[1])
+        for lower in range(len(quantiles) // 2):
+            upper = len(quantiles) - 1 - lower
+            ax.fill_between(x, bands[series][lower], bands[series][upper], color=color, alpha=0.15, linewidth=0,
+                            label=f'{label} {quantiles[lower]:.0%}-{quantiles[upper]:.0%}')
+
+
+RENDERERS = {
+    'results': show_results,
+    'multiple_results': show_multiple_results,
+}
+
+
+def _render(kind: str, kwargs: Dict) -> str:
+    RENDERERS[kind](**kwargs)
+    return kwargs['output_path']
+
+
+# Renders figures to files, each job being a RENDERERS key and the keyword arguments of that function, output_path
+# included. Jobs are spread over worker processes when workers > 1. Returns the written paths in job order.
+def render_figures(jobs: Sequence[Tuple[str, Dict]], workers: int = 1) -> List[str]:
+    for kind, kwargs in jobs:
+        assert kind in RENDERERS, f'Unknown figure kind {kind}.'
+        assert kwargs.get('output_path') is not None, 'Figures rendered in batch need an output path.'
+    if workers <= 1 or len(jobs) <= 1:
+        return [_render(kind, kwargs) for kind, kwargs in jobs]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(_render, *zip(*jobs), chunksize=max(1, len(jobs) // (4 * workers))))